@@ -1,16 +1,14 @@
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 import datetime
-import getpass as gt
 import logging
 import os
-import platform
-from subprocess import run, PIPE
 import sys
 import time
 
 import boto3
 
 from agents.trolley_server.server_handler import ServerRequest
+from web.kubeconfig_handler.kubeconfig_utils import build_eks_kubeconfig
 from web.mongo_handler.mongo_objects import AWSEC2DataObject, AWSS3FilesObject, AWSS3BucketsObject, AWSEKSDataObject, \
     AWSObject
 from web.variables.variables import AWS
@@ -42,20 +40,6 @@ EKS_CLIENT = boto3.client('eks')
 ACCOUNT_ID = int(boto3.client('sts').get_caller_identity().get('Account'))
 TS = int(time.time())
 TS_IN_20_YEARS = TS + 60 * 60 * 24 * 365 * 20
-LOCAL_USER = gt.getuser()
-if 'Darwin' in platform.system():
-    KUBECONFIG_PATH = f'/Users/{LOCAL_USER}/.kube/config'  # path to the GCP credentials
-else:
-    KUBECONFIG_PATH = '/root/.kube/config'
-
-
-def generate_kubeconfig(cluster_name: str, cluster_region: str) -> str:
-    kubeconfig_generate_command = f'aws eks --region {cluster_region} update-kubeconfig --name {cluster_name}'
-    run(kubeconfig_generate_command, stdout=PIPE, stderr=PIPE, text=True, shell=True)
-    with open(KUBECONFIG_PATH, "r") as f:
-        kubeconfig = f.read()
-        logging.info(f'The kubeconfig content is: {kubeconfig}')
-        return kubeconfig
 
 
 def fetch_regions() -> list:
@@ -133,7 +117,7 @@ def fetch_eks_clusters():
                 cluster_object['region'] = cluster_data['cluster']['arn'].split(":")[3]
                 cluster_object['tags'] = cluster_data['cluster']['tags']
                 cluster_object['availability'] = True
-                cluster_object['kubeconfig'] = generate_kubeconfig(cluster_name=cluster_name, cluster_region=aws_region)
+                cluster_object['kubeconfig'] = build_eks_kubeconfig(cluster_data['cluster'])
                 cluster_object['nodes_names'] = []
                 cluster_object['nodes_ips'] = []
                 eks_clusters_object.append(cluster_object)
@@ -0,0 +1,160 @@
+import logging
+import threading
+import time
+
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+
+from agents.k8s_agent.k8s_objects.k8s_objects_handler import INVENTORY_KINDS, list_all_objects
+from web.variables.variables import AGENT_INVENTORY_KEY_FIELDS
+
+HTTP_GONE = 410
+WATCH_TIMEOUT_SECONDS = 300
+WATCH_RETRY_SECONDS = 5
+
+
+def build_row_key(section: str, row) -> tuple:
+    key_fields = AGENT_INVENTORY_KEY_FIELDS[section]
+    if not key_fields:
+        return row,
+    return tuple(row.get(key_field) for key_field in key_fields)
+
+
+def build_object_key(k8s_object) -> tuple:
+    return k8s_object.metadata.namespace, k8s_object.metadata.name
+
+
+class InventoryInformer:
+    """
+    Keeps an in-memory copy of the cluster inventory up to date with one list and watch per kind, resuming every
+    watch from the last seen resourceVersion (bookmarks included) and relisting only when it expired.
+    Every change is recorded as a per section delta that drain_deltas hands over to the server
+    """
+
+    def __init__(self, k8s_api, apis_api, watch_timeout: int = WATCH_TIMEOUT_SECONDS):
+        apis = {'core': k8s_api, 'apps': apis_api}
+        self.list_functions = {kind: (getattr(apis[api], list_function_name), build_rows)
+                               for kind, (api, list_function_name, build_rows) in INVENTORY_KINDS.items()}
+        self.watch_timeout = watch_timeout
+        self.lock = threading.Lock()
+        # kind -> object key -> section -> rows
+        self.objects = {kind: {} for kind in INVENTORY_KINDS}
+        # section -> {'upserted': row key -> row, 'deleted': row key -> row}
+        self.pending_deltas = {}
+        self.synced_events = {kind: threading.Event() for kind in INVENTORY_KINDS}
+
+    def start(self):
+        for kind in INVENTORY_KINDS:
+            threading.Thread(target=self.run_kind, args=(kind,), name=f'{kind}-informer', daemon=True).start()
+
+    def wait_for_sync(self, timeout: float = None) -> bool:
+        deadline = time.monotonic() + timeout if timeout else None
+        for synced_event in self.synced_events.values():
+            remaining = max(deadline - time.monotonic(), 0) if deadline else None
+            if not synced_event.wait(remaining):
+                return False
+        return True
+
+    def snapshot(self) -> dict:
+        """
+        @return: All the rows of every section. The pending deltas are dropped as the snapshot already holds them
+        """
+        with self.lock:
+            sections = {section: [] for section in AGENT_INVENTORY_KEY_FIELDS}
+            for kind_objects in self.objects.values():
+                for object_rows in kind_objects.values():
+                    for section, rows in object_rows.items():
+                        sections[section].extend(rows)
+            self.pending_deltas = {}
+        return sections
+
+    def snapshot_section(self, section: str) -> list:
+        with self.lock:
+            return [row for kind_objects in self.objects.values() for object_rows in kind_objects.values()
+                    for row in object_rows.get(section, [])]
+
+    def drain_deltas(self) -> dict:
+        """
+        @return: The upserted and deleted rows of every section that changed since the previous drain or snapshot
+        """
+        with self.lock:
+            deltas = {section: {'upserted': list(section_deltas['upserted'].values()),
+                                'deleted': list(section_deltas['deleted'].values())}
+                      for section, section_deltas in self.pending_deltas.items()
+                      if section_deltas['upserted'] or section_deltas['deleted']}
+            self.pending_deltas = {}
+        return deltas
+
+    def record(self, kind: str, object_key: tuple, object_rows: dict = None):
+        """
+        Stores the rows of an object, None for a deleted one, and records the rows that changed. Expects the lock
+        """
+        previous_object_rows = self.objects[kind].pop(object_key, {})
+        if object_rows is not None:
+            self.objects[kind][object_key] = object_rows
+        else:
+            object_rows = {}
+        for section in set(previous_object_rows) | set(object_rows):
+            previous_rows = {build_row_key(section, row): row for row in previous_object_rows.get(section, [])}
+            rows = {build_row_key(section, row): row for row in object_rows.get(section, [])}
+            section_deltas = self.pending_deltas.setdefault(section, {'upserted': {}, 'deleted': {}})
+            for row_key, row in rows.items():
+                if previous_rows.get(row_key) != row:
+                    section_deltas['deleted'].pop(row_key, None)
+                    section_deltas['upserted'][row_key] = row
+            for row_key in previous_rows.keys() - rows.keys():
+                section_deltas['upserted'].pop(row_key, None)
+                section_deltas['deleted'][row_key] = previous_rows[row_key]
+
+    def relist(self, kind: str) -> str:
+        """
+        Lists the kind page by page and records the difference from the stored objects
+        @return: The resourceVersion to watch the kind from
+        """
+        list_function, build_rows = self.list_functions[kind]
+        objects_list, resource_version = list_all_objects(list_function)
+        objects = {build_object_key(k8s_object): build_rows(k8s_object) for k8s_object in objects_list}
+        with self.lock:
+            for object_key in self.objects[kind].keys() - objects.keys():
+                self.record(kind, object_key)
+            for object_key, object_rows in objects.items():
+                self.record(kind, object_key, object_rows)
+        self.synced_events[kind].set()
+        logging.info(f'Listed {len(objects)} {kind} at resourceVersion {resource_version}')
+        return resource_version
+
+    def watch_kind(self, kind: str, resource_version: str):
+        """
+        Applies the watch events of the kind until its resourceVersion expires
+        """
+        list_function, build_rows = self.list_functions[kind]
+        watcher = watch.Watch()
+        while True:
+            try:
+                for event in watcher.stream(list_function, resource_version=resource_version,
+                                            allow_watch_bookmarks=True, timeout_seconds=self.watch_timeout):
+                    raw_object = event['raw_object']
+                    if event['type'] == 'ERROR':
+                        if raw_object.get('code') == HTTP_GONE:
+                            return
+                        raise ApiException(status=raw_object.get('code'), reason=raw_object.get('message'))
+                    resource_version = raw_object['metadata']['resourceVersion']
+                    if event['type'] == 'BOOKMARK':
+                        continue
+                    k8s_object = event['object']
+                    object_rows = None if event['type'] == 'DELETED' else build_rows(k8s_object)
+                    with self.lock:
+                        self.record(kind, build_object_key(k8s_object), object_rows)
+            except ApiException as e:
+                if e.status == HTTP_GONE:
+                    logging.info(f'The {kind} watch expired at resourceVersion {resource_version}, relisting')
+                    return
+                raise
+
+    def run_kind(self, kind: str):
+        while True:
+            try:
+                self.watch_kind(kind, self.relist(kind))
+            except Exception as e:
+                logging.error(f'The {kind} informer failed with: {e}, retrying in {WATCH_RETRY_SECONDS} seconds')
+                time.sleep(WATCH_RETRY_SECONDS)
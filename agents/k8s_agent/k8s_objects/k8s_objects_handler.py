@@ -1,121 +1,119 @@
-def fetch_namespaces_list(k8s_api) -> list:
-    namespaces_list = []
-    namespaces = k8s_api.list_namespace().items
-    for namespace in namespaces:
-        namespaces_list.append(namespace.metadata.name)
-    return namespaces_list
-
-
-def fetch_pods_list(k8s_api, namespaces_list) -> list:
-    pods_list = []
-    for namespace in namespaces_list:
-        pods = k8s_api.list_namespaced_pod(namespace).items
-        for pod in pods:
-            pods_list.append({'namespace': namespace,
-                              'pod': pod.metadata.name})
-    return pods_list
-
-
-def fetch_containers_list(k8s_api, namespaces_list: list = None) -> list:
-    containers_list = []
-    for namespace in namespaces_list:
-        pods = k8s_api.list_namespaced_pod(namespace).items
-        for pod in pods:
-            if len(pod.spec.containers) > 1:
-                for container in pod.spec.containers:
-                    log = k8s_api.read_namespaced_pod_log(name=pod.metadata.name, container=container.name,
-                                                          namespace=namespace)
-                    containers_list.append({'namespace': namespace,
-                                            'pod_name': pod.metadata.name,
-                                            'container_name': container.name,
-                                            'log': str(log)})
-            else:
-                log = k8s_api.read_namespaced_pod_log(name=pod.metadata.name,
-                                                      namespace=namespace)
-                containers_list.append({'namespace': namespace,
-                                        'pod': pod.metadata.name,
-                                        'container_name': pod.spec.containers[0].name,
-                                        'log': str(log)})
-    return containers_list
-
-
-def fetch_deployments_list(apis_api, namespaces_list: '') -> list:
-    deployments_list = []
-    for namespace in namespaces_list:
-        deployments = apis_api.list_namespaced_deployment(namespace)
-        if len(deployments.items) > 0:
-            if len(deployments.items) == 1:
-                deployment_data = apis_api.read_namespaced_deployment(name=deployments.items[0].metadata.name,
-                                                                      namespace=namespace)
-                deployments_list.append({'namespace': namespace, 'deployment':
-                    deployments.items[0].metadata.name,
-                                         'deployment_data': str(deployment_data)})
-            else:
-                for deployment in deployments.items:
-                    deployment_data = apis_api.read_namespaced_deployment(name=deployment.metadata.name,
-                                                                          namespace=namespace)
-                    deployments_list.append({'namespace': namespace,
-                                             'deployment': deployment.metadata.name,
-                                             'deployment_data': str(deployment_data)})
-    return deployments_list
-
-
-def fetch_daemonsets_list(apis_api, namespaces_list: '') -> list:
-    daemonsets_list = []
-    for namespace in namespaces_list:
-        daemonsets = apis_api.list_namespaced_daemon_set(namespace)
-        if len(daemonsets.items) > 0:
-            if len(daemonsets.items) == 1:
-                daemonset_data = apis_api.read_namespaced_daemon_set(name=daemonsets.items[0].metadata.name,
-                                                                     namespace=namespace)
-                daemonsets_list.append({'namespace': namespace, 'daemonsets':
-                    daemonsets.items[0].metadata.name, 'daemonset_data': str(daemonset_data)})
-            else:
-                for daemonset in daemonsets.items:
-                    daemonset_data = apis_api.read_namespaced_daemon_set(name=daemonset.metadata.name,
-                                                                         namespace=namespace)
-                    daemonsets_list.append({'namespace': namespace,
-                                            'daemonsets': daemonset.metadata.name,
-                                            'daemonset_data': str(daemonset_data)})
-    return daemonsets_list
-
-
-def fetch_services_list(k8s_api, namespaces_list: '') -> list:
-    services_list = []
-    for namespace in namespaces_list:
-        services = k8s_api.list_namespaced_service(namespace)
-        if len(services.items) > 0:
-            if len(services.items) == 1:
-                service_data = k8s_api.read_namespaced_service(name=services.items[0].metadata.name,
-                                                               namespace=namespace)
-                services_list.append({'namespace': namespace, 'deployment':
-                    services.items[0].metadata.name,
-                                      'service_data': str(service_data)})
-            else:
-                for service in services.items:
-                    service_data = k8s_api.read_namespaced_service(name=service.metadata.name,
-                                                                   namespace=namespace)
-                    services_list.append({'namespace': namespace,
-                                          'service': service.metadata.name,
-                                          'service_data': str(service_data)})
-    return services_list
-
-
-def fetch_stateful_sets_list(apis_api, namespaces_list):
-    stateful_sets_list = []
-    for namespace in namespaces_list:
-        stateful_sets = apis_api.list_namespaced_stateful_set(namespace)
-        if len(stateful_sets.items) > 0:
-            if len(stateful_sets.items) == 1:
-                stateful_set_data = apis_api.read_namespaced_stateful_set(name=stateful_sets.items[0].metadata.name,
-                                                                          namespace=namespace)
-                stateful_sets_list.append({'namespace': namespace, 'stateful_set':
-                    stateful_sets.items[0].metadata.name, 'stateful_set_data': str(stateful_set_data)})
-            else:
-                for stateful_set in stateful_sets.items:
-                    stateful_set_data = apis_api.read_namespaced_stateful_set(name=stateful_set.metadata.name,
-                                                                              namespace=namespace)
-                    stateful_sets_list.append({'namespace': namespace,
-                                               'stateful_set': stateful_set.metadata.name,
-                                               'stateful_set_data': str(stateful_set_data)})
-    return stateful_sets_list
+import logging
+
+from kubernetes.client import ApiClient
+from kubernetes.client.rest import ApiException
+
+from web.variables.variables import AGENT_INVENTORY_KEY_FIELDS
+
+LIST_PAGE_SIZE = 500
+
+# Only used for its sanitize_for_serialization, which doesn't talk to the API server
+serializer = ApiClient()
+
+
+def serialize_object(k8s_object) -> dict:
+    """
+    @return: The JSON ready dict of a Kubernetes model, as the API server would return it, without the managed fields
+    bookkeeping
+    """
+    k8s_object.metadata.managed_fields = None
+    return serializer.sanitize_for_serialization(k8s_object)
+
+
+# Every listed object maps to rows of one or more inventory sections
+def build_namespace_rows(namespace) -> dict:
+    return {'namespaces': [namespace.metadata.name]}
+
+
+def build_pod_rows(pod) -> dict:
+    pod_row = {'namespace': pod.metadata.namespace, 'pod': pod.metadata.name}
+    return {'pods': [pod_row],
+            'containers': [{**pod_row, 'container_name': container.name} for container in pod.spec.containers]}
+
+
+def build_deployment_rows(deployment) -> dict:
+    return {'deployments': [{'namespace': deployment.metadata.namespace, 'deployment': deployment.metadata.name,
+                             'deployment_data': serialize_object(deployment)}]}
+
+
+def build_daemonset_rows(daemonset) -> dict:
+    return {'daemonsets': [{'namespace': daemonset.metadata.namespace, 'daemonsets': daemonset.metadata.name,
+                            'daemonset_data': serialize_object(daemonset)}]}
+
+
+def build_stateful_set_rows(stateful_set) -> dict:
+    return {'stateful_sets': [{'namespace': stateful_set.metadata.namespace, 'stateful_set': stateful_set.metadata.name,
+                               'stateful_set_data': serialize_object(stateful_set)}]}
+
+
+def build_service_rows(service) -> dict:
+    return {'services': [{'namespace': service.metadata.namespace, 'service': service.metadata.name,
+                          'service_data': serialize_object(service)}]}
+
+
+# kind -> (api, cluster wide list function, row builder)
+INVENTORY_KINDS = {
+    'namespaces': ('core', 'list_namespace', build_namespace_rows),
+    'pods': ('core', 'list_pod_for_all_namespaces', build_pod_rows),
+    'deployments': ('apps', 'list_deployment_for_all_namespaces', build_deployment_rows),
+    'daemonsets': ('apps', 'list_daemon_set_for_all_namespaces', build_daemonset_rows),
+    'stateful_sets': ('apps', 'list_stateful_set_for_all_namespaces', build_stateful_set_rows),
+    'services': ('core', 'list_service_for_all_namespaces', build_service_rows),
+}
+
+
+def list_all_objects(list_function) -> tuple:
+    """
+    @param list_function: A cluster wide list function, called page by page
+    @return: All the listed objects and the resourceVersion of the list
+    """
+    objects = []
+    resource_version = ''
+    continue_token = ''
+    while True:
+        objects_list = list_function(limit=LIST_PAGE_SIZE, _continue=continue_token)
+        resource_version = resource_version or objects_list.metadata.resource_version
+        objects.extend(objects_list.items)
+        continue_token = objects_list.metadata._continue
+        if not continue_token:
+            return objects, resource_version
+
+
+def collect_inventory(k8s_api, apis_api) -> dict:
+    """
+    Lists every kind once for the whole cluster, the pods list provides both the pods and the containers sections
+    @return: The rows of every inventory section
+    """
+    apis = {'core': k8s_api, 'apps': apis_api}
+    sections = {section: [] for section in AGENT_INVENTORY_KEY_FIELDS}
+    for api, list_function_name, build_rows in INVENTORY_KINDS.values():
+        objects, _ = list_all_objects(getattr(apis[api], list_function_name))
+        for k8s_object in objects:
+            for section, rows in build_rows(k8s_object).items():
+                sections[section].extend(rows)
+    return sections
+
+
+def fetch_containers_logs(k8s_api, containers_list: list, since_seconds: int = 0, tail_lines: int = 500,
+                          limit_bytes: int = 262144) -> list:
+    """
+    @param containers_list: The rows of the containers inventory section
+    @param since_seconds: Only fetch the log lines of the last since_seconds seconds. All of them by default
+    @param tail_lines: The maximal amount of log lines to fetch per container
+    @param limit_bytes: The maximal size of the log to fetch per container
+    """
+    containers_logs = []
+    log_limits = {'tail_lines': tail_lines, 'limit_bytes': limit_bytes}
+    if since_seconds:
+        log_limits['since_seconds'] = since_seconds
+    for container in containers_list:
+        try:
+            log = k8s_api.read_namespaced_pod_log(name=container['pod'], container=container['container_name'],
+                                                  namespace=container['namespace'], **log_limits)
+        except ApiException as e:
+            # The container didn't start yet or the pod was deleted since it was listed
+            logging.warning(f'Failed to read the {container["container_name"]} container log: {e.reason}')
+            continue
+        if log:
+            containers_logs.append({**container, 'log': str(log)})
+    return containers_logs
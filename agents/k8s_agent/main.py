@@ -9,11 +9,10 @@ import platform
 
 from kubernetes import client
 
-from agents.k8s_agent.k8s_objects.k8s_objects_handler import fetch_namespaces_list, fetch_deployments_list, \
-    fetch_pods_list, \
-    fetch_containers_list, fetch_daemonsets_list, fetch_stateful_sets_list, fetch_services_list
+from agents.k8s_agent.k8s_objects.k8s_objects_handler import collect_inventory, fetch_containers_logs
 from agents.trolley_server.server_handler import ServerRequest
-from web.mongo_handler.mongo_objects import ClusterDataObject
+from agents.k8s_agent.k8s_objects.k8s_informer import InventoryInformer
+from web.mongo_handler.mongo_objects import ClusterDataObject, ClusterDataDeltaObject, ContainersLogsObject
 from web.mongo_handler.mongo_utils import retrieve_cluster_details
 
 from agents.k8s_agent.k8s_client.api_client import K8sApiClient
@@ -42,6 +41,15 @@ CLUSTER_NAME = os.environ.get('CLUSTER_NAME', 'pavelzagalsky-gke-qjeigibl')
 CONTEXT_NAME = os.environ.get('CONTEXT_NAME', 'minikube')
 CLUSTER_TYPE = os.environ.get('CLUSTER_TYPE', 'gke')
 FETCH_INTERVAL = int(os.environ.get('FETCH_INTERVAL', "5"))
+# Reading the logs costs an API call per container, so they are fetched on their own, slower interval
+LOGS_FETCH_INTERVAL = int(os.environ.get('LOGS_FETCH_INTERVAL', "60"))
+LOGS_TAIL_LINES = int(os.environ.get('LOGS_TAIL_LINES', "500"))
+LOGS_LIMIT_BYTES = int(os.environ.get('LOGS_LIMIT_BYTES', "262144"))
+WATCH_MODE = json.loads(os.environ.get('WATCH_MODE', 'true').lower())
+INFORMER_SYNC_TIMEOUT = int(os.environ.get('INFORMER_SYNC_TIMEOUT', "60"))
+
+# The containers logs are fetched since the previous fetch the server accepted, so every log line is shipped once
+last_logs_fetch_timestamp = 0
 
 logging.info(f'DEBUG_MODE is: {DEBUG_MODE}')
 logging.info(f'SERVER_URL is: {SERVER_URL}')
@@ -50,10 +58,17 @@ logging.info(f'CLUSTER_NAME is: {CLUSTER_NAME}')
 logging.info(f'CONTEXT_NAME is: {CONTEXT_NAME}')
 logging.info(f'CLUSTER_TYPE is: {CLUSTER_TYPE}')
 logging.info(f'FETCH_INTERVAL is: {FETCH_INTERVAL}')
+logging.info(f'LOGS_FETCH_INTERVAL is: {LOGS_FETCH_INTERVAL}')
+logging.info(f'LOGS_TAIL_LINES is: {LOGS_TAIL_LINES}')
+logging.info(f'LOGS_LIMIT_BYTES is: {LOGS_LIMIT_BYTES}')
+logging.info(f'WATCH_MODE is: {WATCH_MODE}')
 
 
-def main(debug_mode: bool, internal_cluster_mode: bool, cluster_name: str = None, context_name: str = None,
-         cluster_type: str = None, fetch_interval: int = 30, server_url: str = ''):
+def fetch_core_apis(debug_mode: bool, internal_cluster_mode: bool, cluster_name: str = None,
+                    context_name: str = None, cluster_type: str = None) -> tuple:
+    """
+    @return: The CoreV1Api and AppsV1Api clients of the cluster and its context name
+    """
     if not internal_cluster_mode:
         if not context_name:
             try:
@@ -63,6 +78,36 @@ def main(debug_mode: bool, internal_cluster_mode: bool, cluster_name: str = None
                     kubeconfig_file.write(cluster_object['kubeconfig'])
             except:
                 logging.error(f'{cluster_name} was not found in the system')
+    k8s_api_client = K8sApiClient(debug_mode, internal_cluster_mode, cluster_name, context_name)
+    api_client = k8s_api_client.fetch_api_client()
+    return client.CoreV1Api(api_client=api_client), client.AppsV1Api(api_client=api_client), context_name
+
+
+def send_containers_logs(debug_mode: bool, k8s_api, containers: list, timestamp: int, cluster_name: str,
+                         server_url: str) -> bool:
+    """
+    Fetches and sends the containers logs once LOGS_FETCH_INTERVAL passed since the previous fetch the server accepted.
+    A failed send is fetched again on the next call, from the same point on
+    @return: Whether the logs were sent
+    """
+    global last_logs_fetch_timestamp
+    if timestamp - last_logs_fetch_timestamp < LOGS_FETCH_INTERVAL:
+        return False
+    since_seconds = timestamp - last_logs_fetch_timestamp + 1 if last_logs_fetch_timestamp else 0
+    containers_logs = fetch_containers_logs(k8s_api, containers, since_seconds, LOGS_TAIL_LINES, LOGS_LIMIT_BYTES)
+    containers_logs_object = ContainersLogsObject(timestamp=timestamp, agent_type='k8s', cluster_name=cluster_name,
+                                                  containers_logs=containers_logs)
+    server_request = ServerRequest(debug_mode=debug_mode, cluster_data=containers_logs_object,
+                                   operation='insert_containers_logs', server_url=server_url)
+    if server_request.send_server_request() != 200:
+        logging.warning('Failed to send the containers logs, they are fetched again on the next interval')
+        return False
+    last_logs_fetch_timestamp = timestamp
+    return True
+
+
+def log_parameters(debug_mode: bool, internal_cluster_mode: bool, cluster_name: str, context_name: str,
+                   cluster_type: str, fetch_interval: int, server_url: str):
     logging.info(f'The debug_mode is: {debug_mode}')
     logging.info(f'The internal_cluster_mode is: {internal_cluster_mode}')
     logging.info(f'The cluster_name is: {cluster_name}')
@@ -71,31 +116,72 @@ def main(debug_mode: bool, internal_cluster_mode: bool, cluster_name: str = None
     logging.info(f'The fetch_interval is: {fetch_interval}')
     logging.info(f'The server_url is: {server_url}')
 
+
+def main(debug_mode: bool, internal_cluster_mode: bool, cluster_name: str = None, context_name: str = None,
+         cluster_type: str = None, fetch_interval: int = 30, server_url: str = ''):
+    k8s_api, apis_api, context_name = fetch_core_apis(debug_mode, internal_cluster_mode, cluster_name, context_name,
+                                                      cluster_type)
+    log_parameters(debug_mode, internal_cluster_mode, cluster_name, context_name, cluster_type, fetch_interval,
+                   server_url)
+
     timestamp = int(time.time())
-    k8s_api_client = K8sApiClient(debug_mode, internal_cluster_mode, cluster_name, context_name)
-    api_client = k8s_api_client.fetch_api_client()
-    k8s_api = client.CoreV1Api(api_client=api_client)
-    apis_api = client.AppsV1Api(api_client=api_client)
-    namespaces = fetch_namespaces_list(k8s_api)
-    deployments = fetch_deployments_list(apis_api, namespaces)
-    pods = fetch_pods_list(k8s_api, namespaces)
-    containers = fetch_containers_list(k8s_api, namespaces)
-    daemonsets = fetch_daemonsets_list(apis_api, namespaces)
-    stateful_sets = fetch_stateful_sets_list(apis_api, namespaces)
-    services = fetch_services_list(k8s_api, namespaces)
+    sections = collect_inventory(k8s_api, apis_api)
 
     cluster_data_object = ClusterDataObject(timestamp=timestamp, agent_type='k8s', cluster_name=cluster_name,
-                                             context_name=context_name, namespaces=namespaces,
-                                             deployments=deployments, stateful_sets=stateful_sets, pods=pods,
-                                             containers=containers, daemonsets=daemonsets, services=services)
+                                             context_name=context_name, **sections)
     server_request = ServerRequest(debug_mode=debug_mode, cluster_data=cluster_data_object,
                                    operation='insert_cluster_data', server_url=server_url)
-    server_request.send_server_request()
+    server_request.send_sections_request()
+
+    send_containers_logs(debug_mode, k8s_api, sections['containers'], timestamp, cluster_name, server_url)
     logging.info(f'Taking a {fetch_interval} sleep time between fetches')
     time.sleep(fetch_interval)
 
 
+def watch_main(debug_mode: bool, internal_cluster_mode: bool, cluster_name: str = None, context_name: str = None,
+               cluster_type: str = None, fetch_interval: int = 30, server_url: str = ''):
+    """
+    The informer mode: the inventory is kept up to date by the Kubernetes watch API and only the rows that changed
+    are sent every fetch_interval. A full inventory is sent first, and again whenever the server lost track of it
+    """
+    k8s_api, apis_api, context_name = fetch_core_apis(debug_mode, internal_cluster_mode, cluster_name, context_name,
+                                                      cluster_type)
+    log_parameters(debug_mode, internal_cluster_mode, cluster_name, context_name, cluster_type, fetch_interval,
+                   server_url)
+    inventory_informer = InventoryInformer(k8s_api, apis_api)
+    inventory_informer.start()
+    while not inventory_informer.wait_for_sync(timeout=INFORMER_SYNC_TIMEOUT):
+        logging.warning(f'The inventory is not synced after {INFORMER_SYNC_TIMEOUT} seconds, still waiting')
+    is_server_synced = False
+    while True:
+        timestamp = int(time.time())
+        if not is_server_synced:
+            sections = inventory_informer.snapshot()
+            cluster_data_object = ClusterDataObject(timestamp=timestamp, agent_type='k8s', cluster_name=cluster_name,
+                                                     context_name=context_name, **sections)
+            server_request = ServerRequest(debug_mode=debug_mode, cluster_data=cluster_data_object,
+                                           operation='insert_cluster_data', server_url=server_url)
+            is_server_synced = server_request.send_sections_request() == 200
+        else:
+            changes = inventory_informer.drain_deltas()
+            if changes:
+                logging.info(f'Sending the changed rows of the {", ".join(changes)} sections')
+                cluster_data_delta_object = ClusterDataDeltaObject(timestamp=timestamp, agent_type='k8s',
+                                                                   cluster_name=cluster_name,
+                                                                   context_name=context_name, changes=changes)
+                server_request = ServerRequest(debug_mode=debug_mode, cluster_data=cluster_data_delta_object,
+                                               operation='insert_cluster_data', server_url=server_url)
+                # A lost delta can't be replayed on top of the newer ones, the full inventory is resent instead
+                is_server_synced = server_request.send_server_request() == 200
+        send_containers_logs(debug_mode, k8s_api, inventory_informer.snapshot_section('containers'), timestamp,
+                             cluster_name, server_url)
+        time.sleep(fetch_interval)
+
+
 if __name__ == '__main__':
     parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+    if WATCH_MODE:
+        watch_main(DEBUG_MODE, INTERNAL_CLUSTER_MODE, CLUSTER_NAME, CONTEXT_NAME, CLUSTER_TYPE, FETCH_INTERVAL,
+                   SERVER_URL)
     while True:
         main(DEBUG_MODE, INTERNAL_CLUSTER_MODE, CLUSTER_NAME, CONTEXT_NAME, CLUSTER_TYPE, FETCH_INTERVAL, SERVER_URL)
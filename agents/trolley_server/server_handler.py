@@ -1,10 +1,18 @@
+import gzip
+import hashlib
+import json
 import logging
 import os
 import platform
 import sys
 from dataclasses import asdict
 
-from requests import post, exceptions
+from requests import Session, exceptions
+
+from web.variables.variables import AGENT_INVENTORY_KEY_FIELDS
+
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', "1024"))
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', "6"))
 
 if 'macOS' in platform.platform():
     log_path = f'{os.getcwd()}'
@@ -23,14 +31,23 @@ logging.basicConfig(
 )
 
 
+# One keep-alive connection to the server, shared by all the requests of the agent
+server_session = Session()
+
+
+def build_section_hash(rows: list) -> str:
+    return hashlib.sha256(json.dumps(rows, sort_keys=True, default=str).encode()).hexdigest()
+
+
 class ServerRequest:
     def __init__(self, debug_mode: bool = True, timeout: int = 60, cluster_data: any = None, operation: str = None,
-                 server_url: str = None):
+                 server_url: str = None, is_compressed: bool = True):
         self.debug_mode = debug_mode
         self.timeout = timeout
         self.cluster_data = cluster_data
         self.operation = operation
         self.server_url = server_url
+        self.is_compressed = is_compressed
 
     @staticmethod
     def build_request_url(self):
@@ -39,10 +56,46 @@ class ServerRequest:
         else:
             return f'{self.server_url}/{self.operation}'
 
-    def send_server_request(self):
-        headers = {'request-source': 'kubernetes'}
-        request_url = self.build_request_url(self)
+    def post_json(self, payload: dict):
+        """
+        Posts the payload as JSON, gzipped above COMPRESSION_MIN_SIZE bytes
+        @return: The server response, None when the request failed
+        """
+        headers = {'request-source': 'kubernetes', 'Content-Type': 'application/json'}
+        body = json.dumps(payload, default=str).encode()
+        if self.is_compressed and len(body) > COMPRESSION_MIN_SIZE:
+            body = gzip.compress(body, compresslevel=COMPRESSION_LEVEL)
+            headers['Content-Encoding'] = 'gzip'
         try:
-            post(url=request_url, json=asdict(self.cluster_data), headers=headers)
+            return server_session.post(url=self.build_request_url(self), data=body, headers=headers,
+                                       timeout=self.timeout)
         except exceptions.RequestException as e:
             logging.error(f'post request failed with the following message: {e}')
+            return None
+
+    def send_server_request(self) -> int:
+        """
+        @return: The status code of the server response, 0 when the request failed
+        """
+        response = self.post_json(asdict(self.cluster_data))
+        return response.status_code if response is not None else 0
+
+    def send_sections_request(self) -> int:
+        """
+        Sends the inventory sections of the cluster data in two steps: their hashes first, and then only the sections
+        the server answered it doesn't hold. An unchanged inventory costs a few hundred bytes
+        @return: The status code of the last server response, 0 when a request failed
+        """
+        payload = asdict(self.cluster_data)
+        sections = {section: payload.pop(section) for section in AGENT_INVENTORY_KEY_FIELDS if section in payload}
+        payload['section_hashes'] = {section: build_section_hash(rows) for section, rows in sections.items()}
+        response = self.post_json(payload)
+        if response is None or response.status_code != 200:
+            return response.status_code if response is not None else 0
+        missing_sections = response.json().get('missing_sections', [])
+        if not missing_sections:
+            return response.status_code
+        logging.info(f'Sending the changed {", ".join(missing_sections)} sections')
+        payload.update({section: sections[section] for section in missing_sections if section in sections})
+        response = self.post_json(payload)
+        return response.status_code if response is not None else 0
@@ -10,4 +10,51 @@ db.createUser(
         ]
     }
 );
-db.createCollection("test"); //MongoDB creates the database when you first store data in that database
\ No newline at end of file
+db.createCollection("test"); //MongoDB creates the database when you first store data in that database
+
+// Indexes backing the hot queries of the app. Keep in sync with build_indexes_list in web/mongo_handler/mongo_utils.py
+// createIndex is idempotent, so this is safe to run against an existing database
+const trolleyDb = db.getSiblingDB("trolley"); // Substitute with your PROJECT_NAME
+// A deleted cluster is kept as unavailable, so only a single available cluster per name is enforced
+trolleyDb.clusters.createIndex({cluster_type: 1, discovered: 1, cluster_name: 1},
+    {name: "available_cluster_name", unique: true, partialFilterExpression: {availability: true}});
+trolleyDb.clusters.createIndex({cluster_type: 1, availability: 1, user_name: 1});
+trolleyDb.clusters.createIndex({cluster_type: 1, availability: 1, client_name: 1});
+trolleyDb.users.createIndex({user_email: 1}, {unique: true});
+trolleyDb.users.createIndex({user_name: 1});
+trolleyDb.invited_users.createIndex({user_email: 1});
+trolleyDb.teams.createIndex({team_name: 1});
+trolleyDb.clients_data.createIndex({client_name: 1}, {unique: true});
+trolleyDb.clients_data.createIndex({availability: 1});
+trolleyDb.providers_data.createIndex({provider: 1, user_email: 1}, {unique: true});
+trolleyDb.github_data.createIndex({user_email: 1}, {unique: true});
+trolleyDb.deployment_yamls.createIndex({cluster_type: 1, cluster_name: 1});
+trolleyDb.k8s_agent_data.createIndex({cluster_name: 1}, {unique: true});
+// Capped, so the oldest container logs are dropped once AGENT_LOGS_COLLECTION_SIZE (512MB by default) is reached
+if (!trolleyDb.getCollectionNames().includes("k8s_agent_logs")) {
+    trolleyDb.createCollection("k8s_agent_logs", {capped: true, size: 512 * 1024 * 1024});
+}
+trolleyDb.k8s_agent_logs.createIndex({cluster_name: 1, namespace: 1, pod: 1, container_name: 1, _id: 1});
+trolleyDb.aws_discovered_ec2_instances.createIndex({instance_name: 1});
+trolleyDb.aws_discovered_ec2_instances.createIndex({instance_id: 1});
+trolleyDb.aws_discovered_ec2_instances.createIndex({availability: 1, user_name: 1});
+trolleyDb.aws_discovered_ec2_instances.createIndex({availability: 1, client_name: 1});
+trolleyDb.gcp_discovered_vm_instances.createIndex({instance_name: 1});
+trolleyDb.gcp_discovered_vm_instances.createIndex({availability: 1, user_name: 1});
+trolleyDb.gcp_discovered_vm_instances.createIndex({availability: 1, client_name: 1});
+trolleyDb.aws_discovered_s3_files.createIndex({account_id: 1}, {unique: true});
+trolleyDb.aws_discovered_s3_buckets.createIndex({account_id: 1}, {unique: true});
+trolleyDb.gcp_discovered_files.createIndex({project_name: 1}, {unique: true});
+trolleyDb.gcp_discovered_buckets.createIndex({project_name: 1}, {unique: true});
+trolleyDb.gke_machines_cache.createIndex({region: 1}, {unique: true});
+trolleyDb.gke_machines_types_cache.createIndex({region: 1});
+trolleyDb.gke_zones_and_series_cache.createIndex({zone: 1}, {unique: true});
+trolleyDb.gke_series_and_machine_types_cache.createIndex({machine_series: 1});
+trolleyDb.aws_machines_cache.createIndex({region: 1}, {unique: true});
+trolleyDb.aws_regions_and_series_cache.createIndex({region: 1}, {unique: true});
+trolleyDb.aws_series_and_machine_types_cache.createIndex({machine_series: 1});
+// A single pending job per dedup key, the finished ones are kept as the jobs history
+trolleyDb.jobs.createIndex({dedup_key: 1}, {unique: true, partialFilterExpression: {status: "pending"}});
+trolleyDb.jobs.createIndex({status: 1, priority: 1, _id: 1});
+trolleyDb.jobs.createIndex({status: 1, heartbeat_at: 1});
+trolleyDb.jobs.createIndex({requested_by: 1, _id: 1});
@@ -1,7 +1,5 @@
 #!/bin/sh
-/bin/sh ./aws_discovery.sh
-/bin/sh ./gcp_discovery.sh
-/bin/sh ./aws_cache.sh
-/bin/sh ./gcp_cache.sh
 python3 web/deployment.py
-python3 web/main.py
\ No newline at end of file
+# The gunicorn master also runs jobs_worker.py, which runs the queued jobs and schedules the discovery and caching
+# runs, and restarts it if it dies
+exec gunicorn --config web/gunicorn.conf.py --pythonpath web main:app
\ No newline at end of file
@@ -0,0 +1,97 @@
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+import time
+
+# The production serving mode of the web app: gunicorn --config web/gunicorn.conf.py --pythonpath web main:app
+# A SIGHUP to the master replaces the workers gracefully. With WEB_PRELOAD_APP the code is loaded once in the master,
+# so a code change needs a restart rather than a SIGHUP. mongo_utils creates a MongoClient per process on first use,
+# so the workers never share the client the master used while preloading the app
+
+bind = f"0.0.0.0:{os.getenv('WEB_PORT', '80')}"
+workers = int(os.getenv('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', 4))
+preload_app = os.getenv('WEB_PRELOAD_APP', 'true').lower() == 'true'
+timeout = int(os.getenv('WEB_TIMEOUT', 120))
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('WEB_KEEPALIVE', 5))
+# Recycling the workers bounds the memory of the in-process caches
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', 5000))
+max_requests_jitter = int(os.getenv('WEB_MAX_REQUESTS_JITTER', 500))
+accesslog = '-'
+errorlog = '-'
+# The discovery and caching jobs run in a jobs_worker.py process the master starts, restarts once it dies and stops
+# on exit. JOBS_WORKER_PROCESS=false when it runs elsewhere. When set, every web worker also runs
+# JOBS_IN_PROCESS_WORKERS of them, none of them reserved for the jobs users asked for
+JOBS_WORKER_PROCESS = os.getenv('JOBS_WORKER_PROCESS', 'true').lower() == 'true'
+JOBS_WORKER_RESTART_DELAY = int(os.getenv('JOBS_WORKER_RESTART_DELAY', 5))
+# Mongo may come up after the app, so the indexes are ensured in the background, retried with a growing delay
+ENSURE_INDEXES_ATTEMPTS = int(os.getenv('ENSURE_INDEXES_ATTEMPTS', 6))
+ENSURE_INDEXES_RETRY_DELAY = int(os.getenv('ENSURE_INDEXES_RETRY_DELAY', 5))
+JOBS_IN_PROCESS_WORKERS = int(os.getenv('JOBS_IN_PROCESS_WORKERS', 0))
+# The scripts sit in the root of the Docker image
+JOBS_WORKER_MODULE = 'jobs_worker' if os.getenv('DOCKER_ENV') else 'web.scripts.jobs_worker'
+jobs_worker = {'process': None}
+jobs_worker_lock = threading.Lock()
+jobs_worker_stopped = threading.Event()
+
+
+def supervise_jobs_worker(server):
+    while True:
+        with jobs_worker_lock:
+            if jobs_worker_stopped.is_set():
+                return
+            jobs_worker['process'] = subprocess.Popen([sys.executable, '-m', JOBS_WORKER_MODULE])
+            process = jobs_worker['process']
+        server.log.info(f'Started the jobs worker process {process.pid}')
+        # The master may reap it first, reporting a 0 exit code
+        return_code = process.wait()
+        if jobs_worker_stopped.is_set():
+            return
+        server.log.error(f'The jobs worker process {process.pid} exited with {return_code}, restarting it in '
+                         f'{JOBS_WORKER_RESTART_DELAY} seconds')
+        if jobs_worker_stopped.wait(JOBS_WORKER_RESTART_DELAY):
+            return
+
+
+def ensure_indexes_with_retries(server):
+    from mongo_handler.mongo_utils import ensure_indexes
+    for attempt in range(1, ENSURE_INDEXES_ATTEMPTS + 1):
+        if ensure_indexes():
+            return
+        if attempt < ENSURE_INDEXES_ATTEMPTS:
+            retry_delay = ENSURE_INDEXES_RETRY_DELAY * 2 ** (attempt - 1)
+            server.log.warning(f'Not all the indexes were ensured, retrying in {retry_delay} seconds')
+            time.sleep(retry_delay)
+    server.log.error(f'Not all the indexes were ensured after {ENSURE_INDEXES_ATTEMPTS} attempts')
+
+
+def when_ready(server):
+    # Once per deployment rather than on every import of the app, so importing it doesn't need a reachable Mongo
+    threading.Thread(target=ensure_indexes_with_retries, args=(server,), name='ensure-indexes', daemon=True).start()
+    if JOBS_WORKER_PROCESS:
+        threading.Thread(target=supervise_jobs_worker, args=(server,), name='jobs-worker-supervisor',
+                         daemon=True).start()
+
+
+def post_worker_init(worker):
+    if JOBS_IN_PROCESS_WORKERS:
+        from scripts.jobs_worker import start_workers
+        start_workers(JOBS_IN_PROCESS_WORKERS, user_lane_workers=0)
+
+
+def on_exit(server):
+    with jobs_worker_lock:
+        jobs_worker_stopped.set()
+        process = jobs_worker['process']
+    if process and process.poll() is None:
+        # Its running jobs are requeued by the other workers once their heartbeats stop
+        process.terminate()
+        try:
+            process.wait(timeout=graceful_timeout)
+        except subprocess.TimeoutExpired:
+            server.log.warning(f'The jobs worker process {process.pid} did not stop in time, killing it')
+            process.kill()
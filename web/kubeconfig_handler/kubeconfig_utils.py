@@ -0,0 +1,58 @@
+import yaml
+
+EXEC_CREDENTIALS_API_VERSION = 'client.authentication.k8s.io/v1beta1'
+
+
+def build_kubeconfig(context_name: str, server: str, certificate_authority_data: str, user_exec: dict) -> str:
+    """
+    @param context_name: The name used for the cluster, the user and the context entries
+    @param server: The https URL of the cluster API server
+    @param certificate_authority_data: The base64 encoded CA certificate of the cluster
+    @param user_exec: The exec credentials plugin the client runs to fetch a token
+    @return: A single cluster kubeconfig. Nothing is written to disk, so kubeconfigs can be built in parallel
+    """
+    kubeconfig = {
+        'apiVersion': 'v1',
+        'kind': 'Config',
+        'preferences': {},
+        'clusters': [{'name': context_name,
+                      'cluster': {'server': server,
+                                  'certificate-authority-data': certificate_authority_data}}],
+        'users': [{'name': context_name, 'user': {'exec': user_exec}}],
+        'contexts': [{'name': context_name, 'context': {'cluster': context_name, 'user': context_name}}],
+        'current-context': context_name
+    }
+    return yaml.safe_dump(kubeconfig, default_flow_style=False)
+
+
+def build_gke_kubeconfig(project_name: str, cluster: dict) -> str:
+    """
+    @param project_name: The GCP project of the cluster
+    @param cluster: A cluster object as returned by the GKE clusters list/get API
+    @return: The kubeconfig `gcloud container clusters get-credentials` would have written for the cluster
+    """
+    context_name = f"gke_{project_name}_{cluster['zone']}_{cluster['name']}"
+    user_exec = {'apiVersion': EXEC_CREDENTIALS_API_VERSION,
+                 'command': 'gke-gcloud-auth-plugin',
+                 'installHint': 'Install gke-gcloud-auth-plugin for use with kubectl by following '
+                                'https://cloud.google.com/blog/products/containers-kubernetes/'
+                                'kubectl-auth-changes-in-gke',
+                 'provideClusterInfo': True}
+    return build_kubeconfig(context_name=context_name, server=f"https://{cluster['endpoint']}",
+                            certificate_authority_data=cluster['masterAuth']['clusterCaCertificate'],
+                            user_exec=user_exec)
+
+
+def build_eks_kubeconfig(cluster: dict) -> str:
+    """
+    @param cluster: The cluster object of an EKS describe_cluster response
+    @return: The kubeconfig `aws eks update-kubeconfig` would have written for the cluster
+    """
+    cluster_region = cluster['arn'].split(":")[3]
+    user_exec = {'apiVersion': EXEC_CREDENTIALS_API_VERSION,
+                 'command': 'aws',
+                 'args': ['--region', cluster_region, 'eks', 'get-token', '--cluster-name', cluster['name'],
+                          '--output', 'json']}
+    return build_kubeconfig(context_name=cluster['arn'], server=cluster['endpoint'],
+                            certificate_authority_data=cluster['certificateAuthority']['data'],
+                            user_exec=user_exec)
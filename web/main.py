@@ -1,6 +1,10 @@
-import codecs
+import gzip
+import hashlib
+import io
+import mimetypes
 import sys
 import time
+import zlib
 
 from dotenv import load_dotenv
 import inspect
@@ -9,7 +13,6 @@ import logging
 import os
 import datetime
 from functools import wraps
-from threading import Thread
 
 from dataclasses import asdict
 
@@ -17,11 +20,13 @@ from cryptography.fernet import Fernet
 from flask import request, Response, Flask, session, redirect, url_for, render_template, jsonify
 from flask_caching import Cache
 from itsdangerous import URLSafeTimedSerializer
-from jwt import encode, InvalidTokenError
+from jwt import encode, decode, ExpiredSignatureError, InvalidTokenError
 from PIL import Image
 import yaml
 from werkzeug.datastructures import FileStorage
 from werkzeug.security import generate_password_hash, check_password_hash
+from bson import ObjectId
+from bson.errors import InvalidId
 
 DOCKER_ENV = os.getenv('DOCKER_ENV', False)
 
@@ -50,6 +55,11 @@ EMAIL_AUTHENTICATION = os.getenv('MAIL_AUTHENTICATION', False)
 GMAIL_USER = os.getenv('GMAIL_USER', "trolley_user")
 GMAIL_PASSWORD = os.getenv('GMAIL_PASSWORD', "trolley_password")
 PROJECT_NAME = os.getenv('PROJECT_NAME', "trolley-dev")
+PROFILE_IMAGE_THUMBNAIL_SIZE = (192, 192)
+PROFILE_IMAGE_MAX_AGE = 60 * 60 * 24 * 365
+JSON_COMPRESSION_MIN_SIZE = int(os.getenv('JSON_COMPRESSION_MIN_SIZE', 1024))
+JSON_COMPRESSION_LEVEL = int(os.getenv('JSON_COMPRESSION_LEVEL', 6))
+MAX_AGENT_PAYLOAD_SIZE = int(os.getenv('MAX_AGENT_PAYLOAD_SIZE', 64 * 1024 * 1024))
 
 logger.info(f'App runs in the DOCKER_ENV: {DOCKER_ENV}')
 import mongo_handler.mongo_utils
@@ -59,11 +69,11 @@ from variables.variables import POST, GET, EKS, \
     APPLICATION_JSON, CLUSTER_TYPE, GKE, AKS, DELETE, USER_NAME, REGIONS_LIST, \
     ZONES_LIST, GKE_VERSIONS_LIST, GKE_IMAGE_TYPES, LOCATIONS_DICT, \
     CLUSTER_NAME, AWS, PROVIDER, GCP, AZ, PUT, OK, FAILURE, OBJECT_TYPE, CLUSTER, INSTANCE, TEAM_NAME, ZONE_NAMES, \
-    NAMES, REGION_NAME, CLIENT_NAME, AVAILABILITY, GCP_PROJECT_ID, GITHUB_REPOSITORY, GITHUB_ACTIONS_TOKEN
+    NAMES, REGION_NAME, CLIENT_NAME, AVAILABILITY, GCP_PROJECT_ID, GITHUB_REPOSITORY, GITHUB_ACTIONS_TOKEN, \
+    AWS_DISCOVERY_JOB, GCP_DISCOVERY_JOB, JOB_PRIORITY_USER
 
 from mail_handler import MailSender
 from utils import random_string, apply_yaml
-from scripts import gcp_discovery_script, aws_discovery_script, gcp_caching_script, aws_caching_script
 
 key = os.getenv('SECRET_KEY').encode()
 crypter = Fernet(key)
@@ -78,6 +88,34 @@ app.config['UPLOAD_FOLDER'] = ''
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
 
 
+@app.after_request
+def revalidate_and_compress_json(response: Response) -> Response:
+    """
+    Tags every successful JSON GET response with a weak ETag of its body and answers a matching If-None-Match with
+    an empty 304. Bodies above JSON_COMPRESSION_MIN_SIZE are gzipped for clients that accept it
+    """
+    if request.method != GET or response.status_code != 200 or response.mimetype != APPLICATION_JSON \
+            or response.direct_passthrough or response.content_encoding:
+        return response
+    body = response.get_data()
+    etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        not_modified_response = Response(status=304)
+        not_modified_response.set_etag(etag, weak=True)
+        not_modified_response.vary.add('Accept-Encoding')
+        not_modified_response.cache_control.private = True
+        not_modified_response.cache_control.no_cache = True
+        return not_modified_response
+    response.set_etag(etag, weak=True)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    if len(body) >= JSON_COMPRESSION_MIN_SIZE and 'gzip' in request.accept_encodings:
+        response.set_data(gzip.compress(body, compresslevel=JSON_COMPRESSION_LEVEL))
+        response.content_encoding = 'gzip'
+    return response
+
+
 def generate_confirmation_token(email) -> str:
     serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'])
     return serializer.dumps(email, salt=app.config['SECURITY_PASSWORD_SALT'])
@@ -96,6 +134,23 @@ def confirm_token(token, expiration=3600) -> str:
     return email
 
 
+def generate_profile_image_thumbnail(profile_image_filename: str = '') -> ObjectId:
+    """
+    This function generates a thumbnail of the profile image once and saves it into GridFS
+    """
+    try:
+        with Image.open(profile_image_filename) as image:
+            image.thumbnail(PROFILE_IMAGE_THUMBNAIL_SIZE)
+            thumbnail = io.BytesIO()
+            image.save(thumbnail, format='PNG')
+    except Exception as e:
+        logger.error(f'Failed to generate a thumbnail for {profile_image_filename} with error: {e}')
+        return None
+    thumbnail_filename = f'thumbnail_{os.path.splitext(os.path.basename(profile_image_filename))[0]}.png'
+    return mongo_handler.mongo_utils.insert_file_content(thumbnail.getvalue(), filename=thumbnail_filename,
+                                                         content_type='image/png')
+
+
 def user_registration(first_name: str = '', last_name: str = '', password: str = '',
                       user_email: str = '', user_type: str = 'user', team_name: str = '',
                       profile_image_filename: str = '',
@@ -113,13 +168,15 @@ def user_registration(first_name: str = '', last_name: str = '', password: str =
     user_name = f'{first_name.lower()}-{last_name.lower()}'
     hashed_password = generate_password_hash(password, method='sha256')
     profile_image_id = mongo_handler.mongo_utils.insert_file(profile_image_filename)
-    if mongo_handler.mongo_utils.retrieve_user(user_email):
+    profile_image_thumbnail_id = generate_profile_image_thumbnail(profile_image_filename)
+    if mongo_handler.mongo_utils.retrieve_user(user_email, projection={'_id': 1}):
         mongo_handler.mongo_utils.delete_user(user_email=user_email)
     user_object = UserObject(first_name=first_name, last_name=last_name, user_name=user_name, user_email=user_email,
                              team_name=team_name, hashed_password=hashed_password, confirmation_url=confirmation_url,
                              registration_status=registration_status, user_type=user_type,
                              profile_image_filename=f'static/img/{profile_image_filename}', availability=True,
-                             profile_image_id=profile_image_id, created_timestamp=int(time.time()))
+                             profile_image_id=profile_image_id, profile_image_thumbnail_id=profile_image_thumbnail_id,
+                             created_timestamp=int(time.time()))
     if mongo_handler.mongo_utils.insert_user(asdict(user_object)):
         if 'trolley' in profile_image_filename:
             return True
@@ -167,11 +224,10 @@ def login_processor(user_email: str = "", password: str = "", new: bool = False)
             password = request.form['user_password']
     logger.info(f'The request comes with {user_email} email')
     user_object = mongo_handler.mongo_utils.retrieve_user(user_email)
-    logger.info(f'user_object is: {user_object}')
-    session["registration_status"] = user_object['registration_status']
     if not user_object:
         logger.error('failed here')
         return '', {'user_email': user_email}
+    session["registration_status"] = user_object['registration_status']
     session['user_email'] = user_email
     session['user_password'] = password
     logger.info(f'user_email is: {user_email}')
@@ -210,11 +266,37 @@ def login_processor(user_email: str = "", password: str = "", new: bool = False)
                                          f' please try again'))
 
 
+def verify_access_token():
+    """
+    This function validates the x-access-token kept in the session and returns the matching user object.
+    None is returned when the token is missing, expired or invalid and a full login_processor run is needed.
+    """
+    token = session.get('x-access-token')
+    if not token:
+        return None
+    try:
+        payload = decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
+    except ExpiredSignatureError:
+        logger.info(f'The x-access-token has expired')
+        return None
+    except InvalidTokenError as error:
+        logger.warning(f'The x-access-token is invalid: {error}')
+        return None
+    user_object = mongo_handler.mongo_utils.retrieve_user_by_id(payload['user_id'])
+    if not user_object or not user_object.get(AVAILABILITY):
+        return None
+    if user_object['user_email'] != session.get('user_email'):
+        return None
+    session['registration_status'] = user_object['registration_status']
+    return user_object
+
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         try:
-            login_processor()
+            if not verify_access_token():
+                login_processor()
             return f(*args, **kwargs)
         except Exception as e:
             logger.error(f'login_processor has failed with {e}')
@@ -244,18 +326,20 @@ def validate_provider_data(content: dict) -> bool:
             return True
 
 
-def render_page(page_name: str = '', cluster_name: str = '', client_name: str = ''):
+def render_page(page_name: str = '', cluster_name: str = '', client_name: str = '', user_object: dict = None):
     try:
-        token, user_object = login_processor()
-        base64_data = codecs.encode(user_object['profile_image'].read(), 'base64')
+        if not user_object:
+            user_object = verify_access_token()
+        if not user_object:
+            token, user_object = login_processor()
+        profile_image_id = user_object.get('profile_image_thumbnail_id') or user_object['profile_image_id']
         is_login_pass = True
     except:
         is_login_pass = False
     if is_login_pass:
         data = {'user_name': user_object['user_name'], 'first_name': user_object['first_name'],
-                'cluster_name': cluster_name, 'client_name': client_name}
-        profile_image = base64_data.decode('utf-8')
-        return render_template(page_name, data=data, image=profile_image)
+                'user_type': user_object['user_type'], 'cluster_name': cluster_name, 'client_name': client_name}
+        return render_template(page_name, data=data, image=str(profile_image_id))
     else:
         return render_template('login.html')
 
@@ -294,32 +378,75 @@ def aws_caching(project_name: str, aws_access_key_id: str, aws_secret_access_key
         return False
 
 
+def parse_listing_args() -> dict:
+    """
+    Parses the limit, cursor, sort and comma separated fields query parameters of the listing endpoints
+    """
+    try:
+        limit = max(int(request.args.get('limit', 0)), 0)
+    except ValueError:
+        limit = 0
+    fields = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()]
+    return {'limit': limit, 'cursor': request.args.get('cursor', ''), 'sort': request.args.get('sort', ''),
+            'fields': fields}
+
+
 @app.route('/get_clusters_data', methods=[GET])
 @login_required
 # @cache.cached(timeout=180)
 def get_clusters_data():
     """
     Ths endpoint allows providing basic clusters data that was gathered upon the clusters' creation.
+    The listing is paged with the limit/cursor/sort/fields parameters, the next page cursor is sent in the
+    X-Next-Cursor header. The kubeconfig is served by /get_cluster_details
     """
     cluster_type = request.args.get(CLUSTER_TYPE)
     client_name = request.args.get(CLIENT_NAME.lower())
     user_name = request.args.get(USER_NAME.lower())
-    clusters_list = mongo_handler.mongo_utils.retrieve_available_clusters(cluster_type, client_name, user_name)
-    return Response(json.dumps(clusters_list), status=200, mimetype=APPLICATION_JSON)
+    clusters_list, next_cursor = mongo_handler.mongo_utils.retrieve_available_clusters_page(
+        cluster_type, client_name, user_name, **parse_listing_args())
+    response = Response(json.dumps(clusters_list), status=200, mimetype=APPLICATION_JSON)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+
+@app.route('/get_cluster_details', methods=[GET])
+@login_required
+def get_cluster_details():
+    """
+    This endpoint provides a single cluster with the fields the clusters listing leaves out, like its kubeconfig
+    """
+    cluster_type = request.args.get(CLUSTER_TYPE)
+    cluster_name = request.args.get(CLUSTER_NAME.lower())
+    fields = parse_listing_args()['fields']
+    cluster_object = mongo_handler.mongo_utils.retrieve_cluster_details(cluster_type, cluster_name, fields=fields)
+    if not cluster_object:
+        cluster_object = mongo_handler.mongo_utils.retrieve_cluster_details(cluster_type, cluster_name,
+                                                                            discovered=True, fields=fields)
+    if not cluster_object:
+        return Response(json.dumps(FAILURE), status=404, mimetype=APPLICATION_JSON)
+    return Response(json.dumps(cluster_object), status=200, mimetype=APPLICATION_JSON)
 
 
 @app.route('/get_instances_data', methods=[GET])
 @login_required
-@cache.cached(timeout=180)
+@cache.cached(timeout=180, query_string=True)
 def get_instances_data():
     """
     Ths endpoint allows providing basic instances data that was gathered.
+    The listing is paged with the limit/cursor/sort/fields parameters, the next page cursor is sent in the
+    X-Next-Cursor header
     """
     provider_type = request.args.get(PROVIDER)
     client_name = request.args.get(CLIENT_NAME.lower())
     user_name = request.args.get(USER_NAME.lower())
-    instances_list = mongo_handler.mongo_utils.retrieve_instances(provider_type, client_name, user_name)
-    return Response(json.dumps(instances_list), status=200, mimetype=APPLICATION_JSON)
+    instances_list, next_cursor = mongo_handler.mongo_utils.retrieve_instances_page(
+        provider_type, client_name, user_name, **parse_listing_args())
+    response = Response(json.dumps(instances_list), status=200, mimetype=APPLICATION_JSON)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
 
 
 @app.route('/get_agent_cluster_data', methods=[GET])
@@ -334,26 +461,97 @@ def get_agent_cluster_data():
     return Response(json.dumps(cluster_object), status=200, mimetype=APPLICATION_JSON)
 
 
+@app.route('/get_agent_containers_logs', methods=[GET])
+@login_required
+def get_agent_containers_logs():
+    """
+    This endpoint pages through the containers logs collected by the deployed Trolley Agent, the newest first.
+    The namespace/pod/container_name parameters narrow the logs down, the next page cursor is sent in the
+    X-Next-Cursor header
+    """
+    listing_args = parse_listing_args()
+    logs_list, next_cursor = mongo_handler.mongo_utils.retrieve_containers_logs_page(
+        cluster_name=request.args.get(CLUSTER_NAME.lower()), namespace=request.args.get('namespace', ''),
+        pod=request.args.get('pod', ''), container_name=request.args.get('container_name', ''),
+        limit=listing_args['limit'], cursor=listing_args['cursor'], fields=listing_args['fields'])
+    response = Response(json.dumps(logs_list), status=200, mimetype=APPLICATION_JSON)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+
 @app.route('/trigger_cloud_provider_discovery', methods=[POST])
 @login_required
 def trigger_cloud_provider_discovery():
     """
-    This endpoint allows triggering a cloud provider discovery
+    This endpoint queues a cloud provider discovery for the jobs workers, see scripts/jobs_worker.py.
+    An identical discovery that is still pending is not queued twice. The queued job is sent back with a 202,
+    its progress is served by /get_job_status
     """
     content = request.get_json()
     function_name = inspect.stack()[0][3]
     logger.info(f'A request for {function_name} was requested with the following parameters: {content}')
     if AWS in content[PROVIDER]:
-        if content[OBJECT_TYPE] == CLUSTER:
-            Thread(target=aws_discovery_script.main, args=(False, False, False, True)).start()
-        if content[OBJECT_TYPE] == INSTANCE:
-            Thread(target=aws_discovery_script.main, args=(False, False, True, False)).start()
+        job_type = AWS_DISCOVERY_JOB
+        job_args = {}
     elif GCP in content[PROVIDER]:
-        if content[OBJECT_TYPE] == CLUSTER:
-            Thread(target=gcp_discovery_script.main, args=(False, False, False, True, session['user_email'])).start()
-        if content[OBJECT_TYPE] == INSTANCE:
-            Thread(target=gcp_discovery_script.main, args=(False, False, True, False, session['user_email'])).start()
-    return Response(json.dumps(OK), status=200, mimetype=APPLICATION_JSON)
+        job_type = GCP_DISCOVERY_JOB
+        job_args = {'user_email': session['user_email']}
+    else:
+        return Response(json.dumps(FAILURE), status=400, mimetype=APPLICATION_JSON)
+    if content[OBJECT_TYPE] == CLUSTER:
+        job_args['is_fetching_eks_clusters' if job_type == AWS_DISCOVERY_JOB else 'is_fetching_gke_clusters'] = True
+    elif content[OBJECT_TYPE] == INSTANCE:
+        job_args['is_fetching_ec2_instances' if job_type == AWS_DISCOVERY_JOB else 'is_fetching_vm_instances'] = True
+    else:
+        return Response(json.dumps(FAILURE), status=400, mimetype=APPLICATION_JSON)
+    job, is_deduplicated = mongo_handler.mongo_utils.enqueue_job(job_type, job_args, JOB_PRIORITY_USER,
+                                                                 requested_by=session['user_email'])
+    return Response(json.dumps({'job_id': job['job_id'], 'status': job['status'],
+                                'is_deduplicated': is_deduplicated}),
+                    status=202, mimetype=APPLICATION_JSON,
+                    headers={'Location': f'/get_job_status?job_id={job["job_id"]}'})
+
+
+@app.route('/get_job_status', methods=[GET])
+@login_required
+def get_job_status():
+    """
+    This endpoint serves the status, stage and timings of a queued job
+    """
+    job = mongo_handler.mongo_utils.retrieve_job(request.args.get('job_id', ''))
+    if not job:
+        return Response(json.dumps(FAILURE), status=404, mimetype=APPLICATION_JSON)
+    return Response(json.dumps(job), status=200, mimetype=APPLICATION_JSON)
+
+
+@app.route('/get_schedules', methods=[GET])
+@login_required
+def get_schedules():
+    """
+    This endpoint serves the next run of every scheduled discovery/caching task and the job of its last run.
+    The runs history is served by /get_jobs?requested_by=scheduler
+    """
+    return Response(json.dumps(mongo_handler.mongo_utils.retrieve_schedules()), status=200,
+                    mimetype=APPLICATION_JSON)
+
+
+@app.route('/get_jobs', methods=[GET])
+@login_required
+def get_jobs():
+    """
+    This endpoint pages through the queued jobs, the newest first. The status/job_type/requested_by parameters
+    narrow the jobs down, the next page cursor is sent in the X-Next-Cursor header
+    """
+    listing_args = parse_listing_args()
+    jobs_list, next_cursor = mongo_handler.mongo_utils.retrieve_jobs_page(
+        status=request.args.get('status', ''), job_type=request.args.get('job_type', ''),
+        requested_by=request.args.get('requested_by', ''), limit=listing_args['limit'],
+        cursor=listing_args['cursor'], fields=listing_args['fields'])
+    response = Response(json.dumps(jobs_list), status=200, mimetype=APPLICATION_JSON)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
 
 
 @app.route('/deploy_yaml_on_cluster', methods=[POST])
@@ -495,16 +693,44 @@ def delete_cluster():
     return Response(json.dumps(OK), status=200, mimetype=APPLICATION_JSON)
 
 
+def read_agent_json():
+    """
+    Reads the JSON body the Trolley Agents send, gzipped above a small size
+    @return: The body, None when it decompresses to more than MAX_AGENT_PAYLOAD_SIZE bytes
+    """
+    if request.content_encoding != 'gzip':
+        return request.get_json()
+    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    body = decompressor.decompress(request.get_data(), MAX_AGENT_PAYLOAD_SIZE)
+    if decompressor.unconsumed_tail:
+        logger.error(f'An agent payload larger than {MAX_AGENT_PAYLOAD_SIZE} bytes was rejected')
+        return None
+    return json.loads(body)
+
+
 @app.route('/insert_cluster_data', methods=[POST])
 @login_required
 def insert_cluster_data():
     """
-    This endpoint inserts data provided by a Trolley Agent
+    This endpoint inserts data provided by a Trolley Agent. A k8s agent in watch mode sends only the changed rows,
+    409 asks it for the whole inventory. A k8s agent sending section_hashes is answered with the missing_sections
+    it has to send
     """
-    content = request.get_json()
+    content = read_agent_json()
+    if content is None:
+        return Response(json.dumps(FAILURE), status=413, mimetype=APPLICATION_JSON)
     function_name = inspect.stack()[0][3]
     logger.info(f'A request for {function_name} was requested')
-    if content['agent_type'] == 'k8s':
+    if content['agent_type'] == 'k8s' and 'section_hashes' in content:
+        missing_sections = mongo_handler.mongo_utils.upsert_cluster_data_sections(content)
+        return Response(json.dumps({'missing_sections': missing_sections}), status=200, mimetype=APPLICATION_JSON)
+    elif content['agent_type'] == 'k8s' and content.get('delta'):
+        if mongo_handler.mongo_utils.merge_cluster_data_delta(content):
+            return Response(json.dumps(OK), status=200, mimetype=APPLICATION_JSON)
+        else:
+            # The agent resends the whole inventory
+            return Response(json.dumps(FAILURE), status=409, mimetype=APPLICATION_JSON)
+    elif content['agent_type'] == 'k8s':
         if mongo_handler.mongo_utils.insert_cluster_data_object(content):
             return Response(json.dumps(OK), status=200, mimetype=APPLICATION_JSON)
         else:
@@ -516,6 +742,24 @@ def insert_cluster_data():
             return Response(json.dumps(FAILURE), status=400, mimetype=APPLICATION_JSON)
 
 
+@app.route('/insert_containers_logs', methods=[POST])
+@login_required
+def insert_containers_logs():
+    """
+    This endpoint inserts the containers logs provided by a Trolley Agent
+    """
+    content = read_agent_json()
+    if content is None:
+        return Response(json.dumps(FAILURE), status=413, mimetype=APPLICATION_JSON)
+    function_name = inspect.stack()[0][3]
+    logger.info(f'A request for {function_name} was requested')
+    if mongo_handler.mongo_utils.insert_containers_logs(content[CLUSTER_NAME.lower()], content['containers_logs'],
+                                                        content['timestamp']):
+        return Response(json.dumps(OK), status=200, mimetype=APPLICATION_JSON)
+    else:
+        return Response(json.dumps(FAILURE), status=400, mimetype=APPLICATION_JSON)
+
+
 @app.route('/settings', methods=[GET, POST])
 @login_required
 def settings():
@@ -700,6 +944,33 @@ def teams():
             return Response(json.dumps(FAILURE), status=400, mimetype=APPLICATION_JSON)
 
 
+@app.route('/profile_image/<file_id>', methods=[GET])
+@login_required
+def profile_image(file_id):
+    """
+    This endpoint streams a profile image from GridFS.
+    The GridFS id is part of the URL and never changes for a stored file, so it is used as a strong ETag
+    and the image may be cached by the browser for a long time.
+    """
+    if request.if_none_match.contains(file_id):
+        response = Response(status=304)
+    else:
+        try:
+            grid_out = mongo_handler.mongo_utils.retrieve_profile_image(ObjectId(file_id))
+        except InvalidId:
+            grid_out = None
+        if not grid_out:
+            return Response(json.dumps(FAILURE), status=404, mimetype=APPLICATION_JSON)
+        content_type = grid_out.content_type or mimetypes.guess_type(grid_out.filename or '')[0] or 'image/png'
+        response = Response(iter(grid_out), mimetype=content_type, direct_passthrough=True)
+        response.content_length = grid_out.length
+    response.set_etag(file_id)
+    response.cache_control.private = True
+    response.cache_control.max_age = PROFILE_IMAGE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
 @app.route('/healthz', methods=[GET, POST])
 def healthz():
     logger.info('A request was received')
@@ -718,7 +989,6 @@ def index():
 
 @app.route('/fetch_regions', methods=[GET])
 @login_required
-# @cache.cached(timeout=180)
 def fetch_regions():
     cluster_type = request.args.get(CLUSTER_TYPE)
     logger.info(f'A request to fetch regions for {cluster_type} has arrived')
@@ -738,7 +1008,6 @@ def fetch_regions():
 
 @app.route('/fetch_machine_series', methods=[GET])
 @login_required
-# @cache.cached(timeout=180)
 def fetch_machine_series():
     cluster_type = request.args.get(CLUSTER_TYPE)
     region_name = request.args.get(REGION_NAME.lower())
@@ -750,7 +1019,6 @@ def fetch_machine_series():
 
 @app.route('/fetch_machine_types', methods=[GET])
 @login_required
-# @cache.cached(timeout=180)
 def fetch_machine_types():
     cluster_type = request.args.get(CLUSTER_TYPE)
     machine_series = request.args.get('machine_series')
@@ -762,7 +1030,6 @@ def fetch_machine_types():
 
 @app.route('/fetch_zones', methods=[GET])
 @login_required
-@cache.cached(timeout=180)
 def fetch_zones():
     cluster_type = request.args.get(CLUSTER_TYPE)
     region_name = request.args.get(REGION_NAME.lower())
@@ -787,7 +1054,6 @@ def fetch_zones():
 
 @app.route('/fetch_subnets', methods=[GET])
 @login_required
-@cache.cached(timeout=180)
 def fetch_subnets():
     cluster_type = request.args.get(CLUSTER_TYPE)
     zone_names = request.args.get(ZONE_NAMES.lower())
@@ -820,7 +1086,6 @@ def fetch_client_name_per_cluster():
 
 @app.route('/fetch_gke_versions', methods=[GET])
 @login_required
-@cache.cached(timeout=180)
 def fetch_gke_versions():
     gke_versions_list = mongo_handler.mongo_utils.retrieve_cache(cache_type=GKE_VERSIONS_LIST, provider=GKE)
     return jsonify(gke_versions_list)
@@ -828,7 +1093,6 @@ def fetch_gke_versions():
 
 @app.route('/fetch_gke_image_types', methods=[GET])
 @login_required
-@cache.cached(timeout=180)
 def fetch_gke_image_types():
     logger.info(f'A request to fetch available GKE image types has arrived')
     gke_image_types_list = mongo_handler.mongo_utils.retrieve_cache(cache_type=GKE_IMAGE_TYPES, provider=GKE)
@@ -891,7 +1155,7 @@ def register():
                                    error_message=f'Dear {first_name}, your password was not entered correctly. '
                                                  f'Please try again')
         else:
-            if not mongo_handler.mongo_utils.retrieve_user(user_email):
+            if not mongo_handler.mongo_utils.retrieve_user(user_email, projection={'_id': 1}):
                 token = generate_confirmation_token(user_email)
                 logger.info(f'token is: {token}')
                 confirmation_url = str(url_for('confirmation_email', token=token, _external=True))
@@ -934,15 +1198,8 @@ def confirmation_email(token):
 def login():
     if request.method == 'POST':
         token, user_object = login_processor(new=True)
-        base64_data = codecs.encode(user_object['profile_image'].read(), 'base64')
-        profile_image = base64_data.decode('utf-8')
         if token:
-            user_email = user_object['user_email']
-            user_type = mongo_handler.mongo_utils.check_user_type(user_email)
-            data = {'user_name': user_object['user_name'], 'first_name': user_object['first_name'],
-                    'user_type': user_type}
-            logger.info(f'data content is: {data}')
-            return render_template('index.html', data=data, image=profile_image)
+            return render_page('index.html', user_object=user_object)
         else:
             user_email = user_object['user_email']
             logger.info(f'user_email is: {user_email}')
@@ -1094,5 +1351,7 @@ def logout():
 
 
 if __name__ == "__main__":
+    # gunicorn ensures the indexes once in its master, see gunicorn.conf.py
+    mongo_handler.mongo_utils.ensure_indexes()
     app.run(host='0.0.0.0', port=80, debug=True)
     # app.run(host='0.0.0.0', port=8080, debug=True)
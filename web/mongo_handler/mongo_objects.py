@@ -17,6 +17,7 @@ class UserObject:
     availability: bool
     created_timestamp: int
     profile_image_id: ObjectId = ObjectId()
+    profile_image_thumbnail_id: ObjectId = None
 
 
 @dataclass
@@ -300,6 +301,25 @@ class ClusterDataObject:
     services: list
 
 
+@dataclass
+class ClusterDataDeltaObject:
+    timestamp: int
+    agent_type: str
+    cluster_name: str
+    context_name: str
+    # section -> {'upserted': rows, 'deleted': rows}
+    changes: dict
+    delta: bool = True
+
+
+@dataclass
+class ContainersLogsObject:
+    timestamp: int
+    agent_type: str
+    cluster_name: str
+    containers_logs: list
+
+
 @dataclass
 class AWSEC2DataObject:
     timestamp: int
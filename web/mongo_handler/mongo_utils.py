@@ -1,16 +1,26 @@
+import base64
+import hashlib
+import json
 import logging
+import mimetypes
 import os
 import platform
+import re
 import sys
 import time
-from dataclasses import asdict
+import uuid
+from dataclasses import asdict, is_dataclass
+from threading import Event, Lock, Thread
 from typing import Any, Mapping
 
 import gridfs
-from bson import ObjectId
+from bson import ObjectId, json_util
+from bson.errors import InvalidId
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, ReturnDocument, UpdateOne
 from pymongo.collection import Collection
+from pymongo.errors import CollectionInvalid, ConnectionFailure, DuplicateKeyError, PyMongoError
 
 DOCKER_ENV = os.getenv('DOCKER_ENV', False)
 
@@ -48,11 +58,13 @@ except:
 if 'Darwin' in platform.system() or run_env == 'github':
     from web.variables.variables import GKE, GKE_AUTOPILOT, CLUSTER_NAME, AVAILABILITY, EKS, AKS, EXPIRATION_TIMESTAMP, \
         USER_NAME, USER_EMAIL, HELM, CLUSTER_TYPE, ACCOUNT_ID, CLIENT_NAME, AWS, GCP, AZ, INSTANCE_NAME, TEAM_NAME, \
-        ADMIN, USER, CLIENT, TEAM_ADDITIONAL_INFO, PROVIDER
+        ADMIN, USER, CLIENT, TEAM_ADDITIONAL_INFO, PROVIDER, KUBECONFIG, AGENT_INVENTORY_KEY_FIELDS, \
+        JOB_PENDING, JOB_RUNNING, JOB_SUCCEEDED, JOB_FAILED, JOB_PRIORITY_USER
 else:
     from variables.variables import GKE, GKE_AUTOPILOT, CLUSTER_NAME, AVAILABILITY, EKS, AKS, EXPIRATION_TIMESTAMP, \
         USER_NAME, USER_EMAIL, HELM, CLUSTER_TYPE, ACCOUNT_ID, CLIENT_NAME, AWS, GCP, AZ, INSTANCE_NAME, TEAM_NAME, \
-        ADMIN, USER, CLIENT, TEAM_ADDITIONAL_INFO, PROVIDER
+        ADMIN, USER, CLIENT, TEAM_ADDITIONAL_INFO, PROVIDER, KUBECONFIG, AGENT_INVENTORY_KEY_FIELDS, \
+        JOB_PENDING, JOB_RUNNING, JOB_SUCCEEDED, JOB_FAILED, JOB_PRIORITY_USER
 
 project_folder = os.path.expanduser(os.getcwd())
 load_dotenv(os.path.join(project_folder, '.env'))
@@ -63,109 +75,322 @@ MONGO_PASSWORD = os.environ['MONGO_PASSWORD']
 MONGO_USER = os.environ['MONGO_USER']
 MONGO_URL = os.environ['MONGO_URL']
 MONGO_PORT = int(os.getenv('MONGO_PORT', 27017))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 300))
+USER_CACHE_MAX_SIZE = int(os.getenv('USER_CACHE_MAX_SIZE', 1024))
+CACHES_CATALOGUE_CHECK_INTERVAL = int(os.getenv('CACHES_CATALOGUE_CHECK_INTERVAL', 30))
+USERS_GENERATION_CHECK_INTERVAL = int(os.getenv('USERS_GENERATION_CHECK_INTERVAL', 5))
+BULK_WRITE_BATCH_SIZE = int(os.getenv('BULK_WRITE_BATCH_SIZE', 1000))
+MAX_LISTING_LIMIT = int(os.getenv('MAX_LISTING_LIMIT', 500))
+AGENT_LOGS_COLLECTION_SIZE = int(os.getenv('AGENT_LOGS_COLLECTION_SIZE', 512 * 1024 * 1024))
+AGENT_LOGS_PAGE_SIZE = int(os.getenv('AGENT_LOGS_PAGE_SIZE', 50))
+JOBS_PAGE_SIZE = int(os.getenv('JOBS_PAGE_SIZE', 50))
+# A crashed lease holder is taken over once LEASE_TTL seconds passed since its last renewal
+LEASE_TTL = int(os.getenv('LEASE_TTL', 30))
 logger.info(f'MONGO_USER is: {MONGO_USER}')
 logger.info(f'MONGO_URL is: {MONGO_URL}')
 logger.info(f'MONGO_PORT is: {MONGO_PORT}')
 
 ATLAS_FULL_URL = f"mongodb+srv://admin:{MONGO_PASSWORD}@{MONGO_URL}/?retryWrites=true&w=majority"
 
-if "mongodb.net" in MONGO_URL:
-    print('mongodb.net was chosen')
-    logger.info(f'ATLAS_FULL_URL is: {ATLAS_FULL_URL}')
-    print(f'ATLAS_FULL_URL is: {ATLAS_FULL_URL}')
-    client = MongoClient(ATLAS_FULL_URL)
-else:
-    print('mongodb.net was not chosen')
-    client = MongoClient(host=MONGO_URL, port=MONGO_PORT, connect=False, username=MONGO_USER, password=MONGO_PASSWORD)
-    logger.info(f'succeeded connecting to mongodb client with {MONGO_URL} url')
-db = client[PROJECT_NAME]
-
-gke_clusters: Collection = db.gke_clusters
-gke_autopilot_clusters: Collection = db.gke_autopilot_clusters
-eks_clusters: Collection = db.eks_clusters
-
-aws_discovered_eks_clusters: Collection = db.aws_discovered_eks_clusters
-aws_discovered_ec2_instances: Collection = db.aws_discovered_ec2_instances
-aws_discovered_s3_files: Collection = db.aws_discovered_s3_files
-aws_discovered_s3_buckets: Collection = db.aws_discovered_s3_buckets
-
-gcp_discovered_gke_clusters: Collection = db.gcp_discovered_gke_clusters
-gcp_discovered_vm_instances: Collection = db.gcp_discovered_vm_instances
-gcp_discovered_buckets: Collection = db.gcp_discovered_buckets
-gcp_discovered_files: Collection = db.gcp_discovered_files
-
-az_discovered_aks_clusters: Collection = db.az_discovered_aks_clusters
-az_discovered_vm_instances: Collection = db.az_discovered_vm_instances
-az_discovered_buckets: Collection = db.az_discovered_buckets
-az_discovered_files: Collection = db.az_discovered_files
-
-aks_clusters: Collection = db.aks_clusters
-invited_users: Collection = db.invited_users
-teams: Collection = db.teams
-users: Collection = db.users
-deployment_yamls: Collection = db.deployment_yamls
-aks_cache: Collection = db.aks_cache
-gke_cache: Collection = db.gke_cache
-gke_machines_cache: Collection = db.gke_machines_cache
-gke_machines_types_cache: Collection = db.gke_machines_types_cache
-gke_machines_series_cache: Collection = db.gke_machines_series_cache
-gke_zones_and_series_cache: Collection = db.gke_zones_and_series_cache
-gke_series_and_machine_types_cache: Collection = db.gke_series_and_machine_types_cache
-helm_cache: Collection = db.helm_cache
-aws_cache: Collection = db.aws_cache
-aws_machines_cache: Collection = db.aws_machines_cache
-aws_regions_and_series_cache: Collection = db.aws_regions_and_series_cache
-aws_series_and_machine_types_cache: Collection = db.aws_series_and_machine_types_cache
-fs = gridfs.GridFS(db)
-
-k8s_agent_data: Collection = db.k8s_agent_data
-
-providers_data: Collection = db.providers_data
-github_data: Collection = db.github_data
-clients_data: Collection = db.clients_data
+# The MongoClient is created on first use in every process. A client is not fork safe, so a worker forked from a
+# preloaded app creates its own client instead of inheriting the connection pool and monitors of its parent
+mongo_client_state = {'pid': None, 'client': None, 'gridfs': None}
+mongo_client_lock = Lock()
 
-logger.info(f'PROJECT_NAME is: {PROJECT_NAME}')
-logger.info(f'Listing all the collections')
-logger.info(db.list_collection_names())
 
+def build_mongo_client() -> MongoClient:
+    if "mongodb.net" in MONGO_URL:
+        logger.info(f'mongodb.net was chosen, connecting to {ATLAS_FULL_URL}')
+        return MongoClient(ATLAS_FULL_URL, connect=False)
+    logger.info(f'mongodb.net was not chosen, connecting to {MONGO_URL}')
+    return MongoClient(host=MONGO_URL, port=MONGO_PORT, connect=False, username=MONGO_USER, password=MONGO_PASSWORD)
 
-def insert_gke_deployment(cluster_type: str = '', gke_deployment_object: dict = None) -> bool:
+
+def fetch_mongo_client() -> MongoClient:
     """
-    @param cluster_type: The type of the cluster we want to add to the DB. Ex: GKE/GKE Autopilot
-    @param gke_deployment_object: The dictionary with all the cluster data.
+    @return: The MongoClient of the current process
+    """
+    if mongo_client_state['pid'] != os.getpid():
+        with mongo_client_lock:
+            if mongo_client_state['pid'] != os.getpid():
+                mongo_client_state['client'] = build_mongo_client()
+                mongo_client_state['gridfs'] = None
+                mongo_client_state['pid'] = os.getpid()
+    return mongo_client_state['client']
+
+
+def fetch_gridfs() -> gridfs.GridFS:
+    if mongo_client_state['gridfs'] is None or mongo_client_state['pid'] != os.getpid():
+        mongo_client_state['gridfs'] = gridfs.GridFS(fetch_mongo_client()[PROJECT_NAME])
+    return mongo_client_state['gridfs']
+
+
+class LazyDatabase:
+    """
+    Stands for the project database of the current process' MongoClient
+    """
+
+    def __getattr__(self, attribute_name: str):
+        return getattr(fetch_mongo_client()[PROJECT_NAME], attribute_name)
+
+    def __getitem__(self, collection_name: str) -> Collection:
+        return fetch_mongo_client()[PROJECT_NAME][collection_name]
+
+
+class LazyCollection:
     """
-    if cluster_type == GKE:
+    Stands for a collection of the current process' MongoClient, so the module level collections can be imported
+    before the client exists
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __getattr__(self, attribute_name: str):
+        return getattr(fetch_mongo_client()[PROJECT_NAME][self.name], attribute_name)
+
+
+db = LazyDatabase()
+
+clusters: Collection = LazyCollection('clusters')
+
+# legacy per type collections, kept for the clusters_migration_script
+gke_clusters: Collection = LazyCollection('gke_clusters')
+gke_autopilot_clusters: Collection = LazyCollection('gke_autopilot_clusters')
+eks_clusters: Collection = LazyCollection('eks_clusters')
+
+aws_discovered_eks_clusters: Collection = LazyCollection('aws_discovered_eks_clusters')
+aws_discovered_ec2_instances: Collection = LazyCollection('aws_discovered_ec2_instances')
+aws_discovered_s3_files: Collection = LazyCollection('aws_discovered_s3_files')
+aws_discovered_s3_buckets: Collection = LazyCollection('aws_discovered_s3_buckets')
+
+gcp_discovered_gke_clusters: Collection = LazyCollection('gcp_discovered_gke_clusters')
+gcp_discovered_vm_instances: Collection = LazyCollection('gcp_discovered_vm_instances')
+gcp_discovered_buckets: Collection = LazyCollection('gcp_discovered_buckets')
+gcp_discovered_files: Collection = LazyCollection('gcp_discovered_files')
+
+az_discovered_aks_clusters: Collection = LazyCollection('az_discovered_aks_clusters')
+az_discovered_vm_instances: Collection = LazyCollection('az_discovered_vm_instances')
+az_discovered_buckets: Collection = LazyCollection('az_discovered_buckets')
+az_discovered_files: Collection = LazyCollection('az_discovered_files')
+
+aks_clusters: Collection = LazyCollection('aks_clusters')
+invited_users: Collection = LazyCollection('invited_users')
+teams: Collection = LazyCollection('teams')
+users: Collection = LazyCollection('users')
+deployment_yamls: Collection = LazyCollection('deployment_yamls')
+aks_cache: Collection = LazyCollection('aks_cache')
+gke_cache: Collection = LazyCollection('gke_cache')
+gke_machines_cache: Collection = LazyCollection('gke_machines_cache')
+gke_machines_types_cache: Collection = LazyCollection('gke_machines_types_cache')
+gke_machines_series_cache: Collection = LazyCollection('gke_machines_series_cache')
+gke_zones_and_series_cache: Collection = LazyCollection('gke_zones_and_series_cache')
+gke_series_and_machine_types_cache: Collection = LazyCollection('gke_series_and_machine_types_cache')
+helm_cache: Collection = LazyCollection('helm_cache')
+aws_cache: Collection = LazyCollection('aws_cache')
+aws_machines_cache: Collection = LazyCollection('aws_machines_cache')
+aws_regions_and_series_cache: Collection = LazyCollection('aws_regions_and_series_cache')
+aws_series_and_machine_types_cache: Collection = LazyCollection('aws_series_and_machine_types_cache')
+caches_generation: Collection = LazyCollection('caches_generation')
+
+k8s_agent_data: Collection = LazyCollection('k8s_agent_data')
+# capped, created by ensure_agent_logs_collection
+k8s_agent_logs: Collection = LazyCollection('k8s_agent_logs')
+
+providers_data: Collection = LazyCollection('providers_data')
+github_data: Collection = LazyCollection('github_data')
+clients_data: Collection = LazyCollection('clients_data')
+jobs: Collection = LazyCollection('jobs')
+schedules: Collection = LazyCollection('schedules')
+# Expired leases are kept, and taken over, rather than removed by a TTL index, as their token must keep growing
+leases: Collection = LazyCollection('leases')
+
+logger.info(f'PROJECT_NAME is: {PROJECT_NAME}')
+
+CLUSTERS_TYPES = [GKE, GKE_AUTOPILOT, EKS, AKS]
+DISCOVERED = 'discovered'
+# Served only by the cluster details endpoint, never by the clusters listing
+CLUSTERS_LISTING_EXCLUDED_FIELDS = [KUBECONFIG, 'node_pools']
+LISTING_FIELD_PATTERN = re.compile(r'^[A-Za-z0-9_]+$')
+CONTAINER_LOG_KEY_FIELDS = [CLUSTER_NAME.lower(), 'namespace', 'pod', 'container_name']
+
+# verified user records keyed by the user id that is carried inside the x-access-token. invalidate_user_cache bumps
+# the users generation, which every process polls at most every USERS_GENERATION_CHECK_INTERVAL seconds and drops
+# its users cache when it changed, so a deleted or updated user isn't served from the cache of another worker
+USERS_GENERATION_ID = 'users'
+users_cache = TTLCache(maxsize=USER_CACHE_MAX_SIZE, ttl=USER_CACHE_TTL)
+users_cache_state = {'generation': None, 'checked_at': 0.0}
+users_cache_lock = Lock()
+
+# In-process copy of the build form caches. insert_cache_objects bumps the generation stored in the
+# caches_generation collection, which the catalogue polls at most every CACHES_CATALOGUE_CHECK_INTERVAL seconds
+CACHES_GENERATION_ID = 'caches'
+caches_catalogue = {'generation': None, 'checked_at': 0.0, 'caches': None}
+caches_catalogue_lock = Lock()
+
+
+def build_indexes_list() -> list:
+    """
+    This function lists the indexes backing the queries the app runs, as (collection, keys, unique) tuples with
+    optional create_index options. Unique indexes are set where the code already assumes a single document per key.
+    """
+    return [
+        # A deleted cluster is kept as unavailable, so only a single available cluster per name is enforced
+        (clusters, [(CLUSTER_TYPE, ASCENDING), (DISCOVERED, ASCENDING), (CLUSTER_NAME.lower(), ASCENDING)], True,
+         {'name': 'available_cluster_name', 'partialFilterExpression': {AVAILABILITY: True}}),
+        (clusters, [(CLUSTER_TYPE, ASCENDING), (AVAILABILITY, ASCENDING), (USER_NAME.lower(), ASCENDING)], False),
+        (clusters, [(CLUSTER_TYPE, ASCENDING), (AVAILABILITY, ASCENDING), (CLIENT_NAME.lower(), ASCENDING)], False),
+        (users, [(USER_EMAIL, ASCENDING)], True),
+        (users, [(USER_NAME.lower(), ASCENDING)], False),
+        (invited_users, [(USER_EMAIL, ASCENDING)], False),
+        (teams, [(TEAM_NAME.lower(), ASCENDING)], False),
+        (clients_data, [(CLIENT_NAME.lower(), ASCENDING)], True),
+        (clients_data, [(AVAILABILITY, ASCENDING)], False),
+        (providers_data, [(PROVIDER, ASCENDING), (USER_EMAIL, ASCENDING)], True),
+        (github_data, [(USER_EMAIL, ASCENDING)], True),
+        (deployment_yamls, [(CLUSTER_TYPE, ASCENDING), (CLUSTER_NAME.lower(), ASCENDING)], False),
+        (k8s_agent_data, [(CLUSTER_NAME.lower(), ASCENDING)], True),
+        (k8s_agent_logs, [*[(field, ASCENDING) for field in CONTAINER_LOG_KEY_FIELDS], ('_id', ASCENDING)], False),
+        (aws_discovered_ec2_instances, [(INSTANCE_NAME.lower(), ASCENDING)], False),
+        (aws_discovered_ec2_instances, [('instance_id', ASCENDING)], False),
+        (aws_discovered_ec2_instances, [(AVAILABILITY, ASCENDING), (USER_NAME.lower(), ASCENDING)], False),
+        (aws_discovered_ec2_instances, [(AVAILABILITY, ASCENDING), (CLIENT_NAME.lower(), ASCENDING)], False),
+        (gcp_discovered_vm_instances, [(INSTANCE_NAME.lower(), ASCENDING)], False),
+        (gcp_discovered_vm_instances, [(AVAILABILITY, ASCENDING), (USER_NAME.lower(), ASCENDING)], False),
+        (gcp_discovered_vm_instances, [(AVAILABILITY, ASCENDING), (CLIENT_NAME.lower(), ASCENDING)], False),
+        (aws_discovered_s3_files, [(ACCOUNT_ID.lower(), ASCENDING)], True),
+        (aws_discovered_s3_buckets, [(ACCOUNT_ID.lower(), ASCENDING)], True),
+        (gcp_discovered_files, [('project_name', ASCENDING)], True),
+        (gcp_discovered_buckets, [('project_name', ASCENDING)], True),
+        (gke_machines_cache, [('region', ASCENDING)], True),
+        (gke_machines_types_cache, [('region', ASCENDING)], False),
+        (gke_zones_and_series_cache, [('zone', ASCENDING)], True),
+        (gke_series_and_machine_types_cache, [('machine_series', ASCENDING)], False),
+        (aws_machines_cache, [('region', ASCENDING)], True),
+        (aws_regions_and_series_cache, [('region', ASCENDING)], True),
+        (aws_series_and_machine_types_cache, [('machine_series', ASCENDING)], False),
+        # A single pending job per dedup key, the finished ones are kept as the jobs history
+        (jobs, [('dedup_key', ASCENDING)], True, {'partialFilterExpression': {'status': JOB_PENDING}}),
+        (jobs, [('status', ASCENDING), ('priority', ASCENDING), ('_id', ASCENDING)], False),
+        (jobs, [('status', ASCENDING), ('heartbeat_at', ASCENDING)], False),
+        (jobs, [('requested_by', ASCENDING), ('_id', ASCENDING)], False),
+    ]
+
+
+def build_obsolete_indexes_list() -> list:
+    """
+    This function lists the (collection, index name) of the indexes build_indexes_list replaced
+    """
+    return [
+        (clusters, 'cluster_type_1_discovered_1_cluster_name_1'),
+    ]
+
+
+def ensure_indexes() -> bool:
+    """
+    This function idempotently creates all the indexes from build_indexes_list, once the obsolete ones were dropped.
+    An index that can't be built, e.g. a unique index over existing duplicates, is logged and skipped.
+    An unreachable Mongo stops it right away, since every other index would wait out the server selection timeout.
+    """
+    all_created = ensure_agent_logs_collection()
+    for collection, index_name in build_obsolete_indexes_list():
         try:
-            mongo_response = gke_clusters.insert_one(gke_deployment_object)
-            logger.info(mongo_response.acknowledged)
-            logger.info(f'Inserted ID for Mongo DB is: {mongo_response.inserted_id}')
-            return True
-        except Exception as e:
-            logger.error(f'failure to insert data into gke_clusters table with error: {e}')
+            if index_name in collection.index_information():
+                collection.drop_index(index_name)
+                logger.info(f'Dropped the obsolete {index_name} index of the {collection.name} collection')
+        except ConnectionFailure as e:
+            logger.error(f'Failed to reach Mongo to ensure the indexes with error: {e}')
             return False
-    elif cluster_type == GKE_AUTOPILOT:
+        except PyMongoError as e:
+            all_created = False
+            logger.error(f'Failed to drop the {index_name} index of the {collection.name} collection with error: {e}')
+    for collection, keys, unique, *index_options in build_indexes_list():
         try:
-            gke_autopilot_clusters.insert_one(gke_deployment_object)
-            return True
-        except Exception as e:
-            logger.error(f'failure to insert data into gke_autopilot_clusters table with error: {e}')
+            index_name = collection.create_index(keys, unique=unique, **(index_options[0] if index_options else {}))
+            logger.info(f'Ensured the {index_name} index on the {collection.name} collection')
+        except ConnectionFailure as e:
+            logger.error(f'Failed to reach Mongo to ensure the indexes with error: {e}')
             return False
+        except PyMongoError as e:
+            all_created = False
+            logger.error(f'Failed to create the {keys} index on the {collection.name} collection with error: {e}')
+    return all_created
+
+
+def ensure_agent_logs_collection() -> bool:
+    """
+    This function creates the capped collection the agents' container logs are written to, so the oldest logs are
+    dropped once AGENT_LOGS_COLLECTION_SIZE bytes are reached
+    """
+    try:
+        if k8s_agent_logs.name in db.list_collection_names():
+            return True
+        db.create_collection(k8s_agent_logs.name, capped=True, size=AGENT_LOGS_COLLECTION_SIZE)
+        logger.info(f'Created the {k8s_agent_logs.name} capped collection of {AGENT_LOGS_COLLECTION_SIZE} bytes')
+    except CollectionInvalid:
+        # Another worker created it in the meantime
+        pass
+    except PyMongoError as e:
+        logger.error(f'Failed to create the {k8s_agent_logs.name} capped collection with error: {e}')
+        return False
+    return True
+
+
+def build_cluster_query(cluster_type: str = '', cluster_name: str = '', discovered: bool = False) -> dict:
+    """
+    @param cluster_type: The type of the cluster. Unknown types fall back to GKE
+    @param cluster_name: The name of the cluster
+    @param discovered: Whether the cluster was found out scanning the cloud provider or not
+    """
+    if cluster_type not in CLUSTERS_TYPES:
+        cluster_type = GKE
+    return {CLUSTER_TYPE: cluster_type, DISCOVERED: discovered, CLUSTER_NAME.lower(): cluster_name}
+
+
+def insert_cluster_deployment(cluster_type: str = '', cluster_deployment_object: dict = None) -> bool:
+    """
+    @param cluster_type: The type of the cluster we want to add to the DB. Ex: GKE/GKE Autopilot/EKS/AKS
+    @param cluster_deployment_object: The dictionary with all the cluster data.
+    A deleted cluster of the same name is replaced in place, so a name keeps a single document. A name that an
+    available cluster still uses fails on the unique index
+    """
+    cluster_deployment_object[CLUSTER_TYPE] = cluster_type
+    cluster_deployment_object[DISCOVERED] = False
+    mongo_query = build_cluster_query(cluster_type, cluster_deployment_object.get(CLUSTER_NAME.lower(), ''))
+    try:
+        mongo_response = clusters.replace_one({**mongo_query, AVAILABILITY: {'$ne': True}},
+                                              cluster_deployment_object, upsert=True)
+        logger.info(mongo_response.acknowledged)
+        if mongo_response.upserted_id:
+            logger.info(f'Inserted ID for Mongo DB is: {mongo_response.upserted_id}')
+        else:
+            logger.info(f'Replaced the deleted {cluster_type} cluster of the same name')
+        return True
+    except Exception as e:
+        logger.error(f'failure to insert {cluster_type} data into clusters table with error: {e}')
+        return False
+
+
+def insert_gke_deployment(cluster_type: str = '', gke_deployment_object: dict = None) -> bool:
+    """
+    @param cluster_type: The type of the cluster we want to add to the DB. Ex: GKE/GKE Autopilot
+    @param gke_deployment_object: The dictionary with all the cluster data.
+    """
+    return insert_cluster_deployment(cluster_type=cluster_type, cluster_deployment_object=gke_deployment_object)
 
 
 def insert_eks_deployment(eks_deployment_object: dict = None) -> bool:
     """
     @param eks_deployment_object: The dictionary with all the cluster data.
     """
-    eks_clusters.insert_one(eks_deployment_object)
-    return True
+    return insert_cluster_deployment(cluster_type=EKS, cluster_deployment_object=eks_deployment_object)
 
 
 def insert_aks_deployment(aks_deployment_object: dict = None) -> bool:
     """
     @param aks_deployment_object: The dictionary with all the cluster data.
     """
-    aks_clusters.insert_one(aks_deployment_object)
-    return True
+    return insert_cluster_deployment(cluster_type=AKS, cluster_deployment_object=aks_deployment_object)
 
 
 def set_cluster_availability(cluster_type: str = '', cluster_name: str = '', discovered: bool = False,
@@ -179,162 +404,194 @@ def set_cluster_availability(cluster_type: str = '', cluster_name: str = '', dis
     @return:
     """
 
-    myquery = {CLUSTER_NAME.lower(): cluster_name}
+    myquery = build_cluster_query(cluster_type, cluster_name, discovered)
     newvalues = {"$set": {AVAILABILITY: availability}}
-    if cluster_type == GKE:
-        if discovered:
-            result = gcp_discovered_gke_clusters.update_one(myquery, newvalues)
-        else:
-            result = gke_clusters.update_one(myquery, newvalues)
-    elif cluster_type == GKE_AUTOPILOT:
-        result = gke_autopilot_clusters.update_one(myquery, newvalues)
-    elif cluster_type == EKS:
-        if discovered:
-            result = aws_discovered_eks_clusters.update_one(myquery, newvalues)
-        else:
-            result = eks_clusters.update_one(myquery, newvalues)
-    elif cluster_type == AKS:
-        result = aks_clusters.update_one(myquery, newvalues)
-    else:
-        result = gke_clusters.update_one(myquery, newvalues)
+    result = clusters.update_one(myquery, newvalues)
     return result.raw_result['updatedExisting']
 
 
-def retrieve_available_clusters(cluster_type: str, client_name: str = '', user_name: str = '') -> list:
-    logger.info(f'A request to fetch {cluster_type} clusters for {user_name} was received')
-    all_clusters_object = []
-    discovered_clusters_object = []
-    if cluster_type == GKE:
-        if not user_name and not client_name:
-            return []
-            # clusters_object = gke_clusters.find({AVAILABILITY: True})
-        elif is_admin(user_name):
-            discovered_clusters_object = gcp_discovered_gke_clusters.find({AVAILABILITY: True})
-            clusters_object = gke_clusters.find({AVAILABILITY: True})
-        else:
-            if user_name:
-                clusters_object = gke_clusters.find({AVAILABILITY: True, USER_NAME.lower(): user_name})
-                discovered_clusters_object = gcp_discovered_gke_clusters.find(
-                    {AVAILABILITY: True, USER_NAME.lower(): user_name})
-            elif client_name:
-                clusters_object = gke_clusters.find({AVAILABILITY: True, CLIENT_NAME.lower(): client_name})
-                discovered_clusters_object = gcp_discovered_gke_clusters.find(
-                    {AVAILABILITY: True, CLIENT_NAME.lower(): client_name})
-    elif cluster_type == GKE_AUTOPILOT:
-        if not user_name or is_admin(user_name):
-            clusters_object = gke_autopilot_clusters.find({AVAILABILITY: True})
-        else:
-            clusters_object = gke_autopilot_clusters.find({AVAILABILITY: True, USER_NAME.lower(): user_name})
-    elif cluster_type == EKS:
-        if not user_name and not client_name:
-            clusters_object = eks_clusters.find({AVAILABILITY: True})
-        elif is_admin(user_name):
-            discovered_clusters_object = aws_discovered_eks_clusters.find({AVAILABILITY: True})
-            clusters_object = eks_clusters.find({AVAILABILITY: True})
-        else:
-            if user_name:
-                clusters_object = eks_clusters.find({AVAILABILITY: True, USER_NAME.lower(): user_name})
-                discovered_clusters_object = aws_discovered_eks_clusters.find(
-                    {AVAILABILITY: True, USER_NAME.lower(): user_name})
-            elif client_name:
-                clusters_object = eks_clusters.find({AVAILABILITY: True, CLIENT_NAME.lower(): client_name})
-                discovered_clusters_object = aws_discovered_eks_clusters.find(
-                    {AVAILABILITY: True, CLIENT_NAME.lower(): client_name})
-    elif cluster_type == AKS:
-        if not user_name and not client_name:
-            clusters_object = aks_clusters.find({AVAILABILITY: True})
-        elif is_admin(user_name):
-            discovered_clusters_object = az_discovered_aks_clusters.find({AVAILABILITY: True})
-            clusters_object = aks_clusters.find({AVAILABILITY: True})
+def encode_listing_cursor(listing_object: dict, sort_field: str) -> str:
+    """
+    The sort value is kept as typed Extended JSON, since Mongo only compares it to the values of the same BSON type,
+    e.g. a datetime to the datetimes rather than to its string
+    """
+    cursor_object = {'value': listing_object.get(sort_field), 'id': listing_object['_id']}
+    return base64.urlsafe_b64encode(
+        json_util.dumps(cursor_object, json_options=json_util.CANONICAL_JSON_OPTIONS).encode()).decode()
+
+
+def decode_listing_cursor(cursor: str) -> dict:
+    try:
+        cursor_object = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return {'value': cursor_object['value'], 'id': ObjectId(cursor_object['id'])}
+    except Exception as e:
+        logger.warning(f'The {cursor} listing cursor is invalid and is ignored: {e}')
+        return {}
+
+
+def build_listing_stages(limit: int = 0, cursor: str = '', sort: str = '', fields: list = None,
+                         excluded_fields: list = None) -> tuple:
+    """
+    @param limit: The page size. 0 returns all the matching documents, up to MAX_LISTING_LIMIT when paginating
+    @param cursor: The opaque cursor of the previous page
+    @param sort: The field to sort by, prefixed with - for a descending sort
+    @param fields: The fields to return. All the fields but the excluded ones are returned by default
+    @param excluded_fields: Fields that are never returned by the listing
+    @return: The aggregation stages that page, sort and project the listing, and the field it's sorted by
+    """
+    excluded_fields = excluded_fields or []
+    sort_direction = -1 if sort.startswith('-') else 1
+    sort_field = sort.lstrip('-')
+    if not LISTING_FIELD_PATTERN.match(sort_field) or sort_field in excluded_fields:
+        sort_field = '_id'
+    stages = []
+    cursor_object = decode_listing_cursor(cursor) if cursor else {}
+    if cursor_object:
+        comparison = '$lt' if sort_direction == -1 else '$gt'
+        if sort_field == '_id':
+            stages.append({'$match': {'_id': {comparison: cursor_object['id']}}})
         else:
-            if user_name:
-                clusters_object = aks_clusters.find({AVAILABILITY: True, USER_NAME.lower(): user_name})
-                discovered_clusters_object = az_discovered_aks_clusters.find(
-                    {AVAILABILITY: True, USER_NAME.lower(): user_name})
-            elif client_name:
-                clusters_object = aks_clusters.find({AVAILABILITY: True, CLIENT_NAME.lower(): client_name})
-                discovered_clusters_object = az_discovered_aks_clusters.find(
-                    {AVAILABILITY: True, CLIENT_NAME.lower(): client_name})
-        # if not user_name or is_admin(user_name):
-        #     clusters_object = aks_clusters.find({AVAILABILITY: True})
-        # else:
-        #     clusters_object = aks_clusters.find({AVAILABILITY: True, USER_NAME.lower(): user_name})
+            # Null and missing values sort before all the others and match neither $gt nor $lt, so they are paged
+            # by _id on their own
+            if cursor_object['value'] is None:
+                following_objects = [{sort_field: None, '_id': {comparison: cursor_object['id']}}]
+                if sort_direction == 1:
+                    following_objects.append({sort_field: {'$ne': None}})
+            else:
+                following_objects = [{sort_field: {comparison: cursor_object['value']}},
+                                     {sort_field: cursor_object['value'], '_id': {comparison: cursor_object['id']}}]
+                if sort_direction == -1:
+                    following_objects.append({sort_field: None})
+            stages.append({'$match': {'$or': following_objects}})
+    if sort or limit or cursor:
+        sort_stage = {sort_field: sort_direction}
+        if sort_field != '_id':
+            sort_stage['_id'] = sort_direction
+        stages.append({'$sort': sort_stage})
+    if limit:
+        # One extra document tells whether there is a next page
+        stages.append({'$limit': min(limit, MAX_LISTING_LIMIT) + 1})
+    fields = [field for field in fields or [] if LISTING_FIELD_PATTERN.match(field) and field not in excluded_fields]
+    if fields:
+        # _id is kept for the next page cursor and removed by page_listing
+        stages.append({'$project': {'_id': 1, sort_field: 1, **{field: 1 for field in fields}}})
+    elif excluded_fields:
+        stages.append({'$project': {field: 0 for field in excluded_fields}})
+    return stages, sort_field
+
+
+def page_listing(listing_objects: list, limit: int, sort_field: str, fields: list = None) -> tuple:
+    """
+    @return: The listing page without the _id fields and the cursor of the next page, empty on the last page
+    """
+    next_cursor = ''
+    if limit and len(listing_objects) > min(limit, MAX_LISTING_LIMIT):
+        listing_objects = listing_objects[:min(limit, MAX_LISTING_LIMIT)]
+        next_cursor = encode_listing_cursor(listing_objects[-1], sort_field)
+    for listing_object in listing_objects:
+        del listing_object['_id']
+        if fields and sort_field not in fields:
+            listing_object.pop(sort_field, None)
+    return listing_objects, next_cursor
+
+
+def retrieve_available_clusters_page(cluster_type: str, client_name: str = '', user_name: str = '', limit: int = 0,
+                                     cursor: str = '', sort: str = '', fields: list = None) -> tuple:
+    """
+    @param cluster_type: The type of the clusters to list
+    @param client_name: List the clusters assigned to the client
+    @param user_name: List the clusters of the user, all of them for an admin
+    @param limit: The page size. All the clusters are returned by default
+    @param cursor: The cursor returned with the previous page
+    @param sort: The field to sort by, prefixed with - for a descending sort
+    @param fields: The fields to return. kubeconfig and node_pools are only served by retrieve_cluster_details
+    @return: A page of clusters and the cursor of the next page
+    """
+    logger.info(f'A request to fetch {cluster_type} clusters for {user_name} was received')
+    if cluster_type not in CLUSTERS_TYPES:
+        return [], ''
+    mongo_query = {CLUSTER_TYPE: cluster_type, AVAILABILITY: True}
+    if cluster_type == GKE_AUTOPILOT:
+        if user_name and not is_admin(user_name):
+            mongo_query[USER_NAME.lower()] = user_name
+    elif not user_name and not client_name:
+        if cluster_type == GKE:
+            return [], ''
+        mongo_query[DISCOVERED] = False
+    elif is_admin(user_name):
+        pass
+    elif user_name:
+        mongo_query[USER_NAME.lower()] = user_name
     else:
-        clusters_object = []
-    for cluster in clusters_object:
-        del cluster['_id']
-        cluster['discovered'] = False
-        all_clusters_object.append(cluster)
-        if 'client_name' not in cluster.keys():
-            cluster['client_name'] = ''
-        if 'tags' not in cluster.keys():
-            cluster['tags'] = []
-    if discovered_clusters_object:
-        for cluster in discovered_clusters_object:
-            del cluster['_id']
-            cluster['discovered'] = True
-            all_clusters_object.append(cluster)
-            if 'client_name' not in cluster.keys():
-                cluster['client_name'] = ''
-            if 'tags' not in cluster.keys():
-                cluster['tags'] = []
-    return all_clusters_object
-
-
-def retrieve_instances(provider_type: str, client_name: str = '', user_name: str = "") -> list:
+        mongo_query[CLIENT_NAME.lower()] = client_name
+    listing_stages, sort_field = build_listing_stages(limit, cursor, sort, fields,
+                                                      excluded_fields=CLUSTERS_LISTING_EXCLUDED_FIELDS)
+    pipeline = [
+        {'$match': mongo_query},
+        *listing_stages,
+        {'$addFields': {DISCOVERED: {'$ifNull': ['$' + DISCOVERED, False]},
+                        CLIENT_NAME.lower(): {'$ifNull': ['$' + CLIENT_NAME.lower(), '']},
+                        'tags': {'$ifNull': ['$tags', []]}}}
+    ]
+    return page_listing(list(clusters.aggregate(pipeline)), limit, sort_field, fields)
+
+
+def retrieve_available_clusters(cluster_type: str, client_name: str = '', user_name: str = '', limit: int = 0,
+                                cursor: str = '', sort: str = '', fields: list = None) -> list:
+    return retrieve_available_clusters_page(cluster_type, client_name, user_name, limit, cursor, sort, fields)[0]
+
+
+def retrieve_instances_page(provider_type: str, client_name: str = '', user_name: str = "", limit: int = 0,
+                            cursor: str = '', sort: str = '', fields: list = None) -> tuple:
+    """
+    @param provider_type: aws/gcp/azure
+    @param client_name: List the instances assigned to the client
+    @param user_name: List the instances of the user, all of them for an admin
+    @param limit: The page size. All the instances are returned by default
+    @param cursor: The cursor returned with the previous page
+    @param sort: The field to sort by, prefixed with - for a descending sort
+    @param fields: The fields to return. All the fields are returned by default
+    @return: A page of instances and the cursor of the next page
+    """
     logger.info(f'A request to fetch instance for {provider_type} provider was received')
-    instances_list = []
     if provider_type == AWS:
-        if not user_name and not client_name:
-            instances_object = aws_discovered_ec2_instances.find({AVAILABILITY: True})
-        elif is_admin(user_name):
-            instances_object = aws_discovered_ec2_instances.find({AVAILABILITY: True})
-        else:
-            if user_name:
-                instances_object = aws_discovered_ec2_instances.find({AVAILABILITY: True, USER_NAME.lower(): user_name})
-            elif client_name:
-                instances_object = aws_discovered_ec2_instances.find(
-                    {AVAILABILITY: True, CLIENT_NAME.lower(): client_name.lower()})
+        instances_collection = aws_discovered_ec2_instances
     elif provider_type == GCP:
-        if not user_name and not client_name:
-            instances_object = gcp_discovered_vm_instances.find({AVAILABILITY: True})
-        elif is_admin(user_name):
-            instances_object = gcp_discovered_vm_instances.find({AVAILABILITY: True})
-        else:
-            if user_name:
-                instances_object = gcp_discovered_vm_instances.find({AVAILABILITY: True, USER_NAME.lower(): user_name})
-            elif client_name:
-                instances_object = gcp_discovered_vm_instances.find(
-                    {AVAILABILITY: True, CLIENT_NAME.lower(): client_name.lower()})
+        instances_collection = gcp_discovered_vm_instances
     elif provider_type == AZ:
-        instances_object = az_discovered_vm_instances.find()
+        instances_collection = az_discovered_vm_instances
     else:
-        instances_object = {}
-    for instance in instances_object:
-        del instance['_id']
-        instances_list.append(instance)
-    return instances_list
+        return [], ''
+    mongo_query = {AVAILABILITY: True}
+    if provider_type == AZ:
+        mongo_query = {}
+    elif not user_name and not client_name:
+        pass
+    elif is_admin(user_name):
+        pass
+    elif user_name:
+        mongo_query[USER_NAME.lower()] = user_name
+    else:
+        mongo_query[CLIENT_NAME.lower()] = client_name.lower()
+    listing_stages, sort_field = build_listing_stages(limit, cursor, sort, fields)
+    pipeline = [{'$match': mongo_query}, *listing_stages]
+    return page_listing(list(instances_collection.aggregate(pipeline)), limit, sort_field, fields)
+
+
+def retrieve_instances(provider_type: str, client_name: str = '', user_name: str = "", limit: int = 0,
+                       cursor: str = '', sort: str = '', fields: list = None) -> list:
+    return retrieve_instances_page(provider_type, client_name, user_name, limit, cursor, sort, fields)[0]
 
 
-def retrieve_cluster_details(cluster_type: str, cluster_name: str, discovered: bool = False) -> dict:
+def retrieve_cluster_details(cluster_type: str, cluster_name: str, discovered: bool = False,
+                             fields: list = None) -> dict:
     logger.info(f'A request to fetch {cluster_name} details was received')
-    if cluster_type == GKE:
-        if discovered:
-            cluster_object = gcp_discovered_gke_clusters.find_one({CLUSTER_NAME.lower(): cluster_name})
-        else:
-            cluster_object = gke_clusters.find_one({CLUSTER_NAME.lower(): cluster_name})
-    elif cluster_type == GKE_AUTOPILOT:
-        cluster_object = gke_autopilot_clusters.find_one({CLUSTER_NAME.lower(): cluster_name})
-    elif cluster_type == EKS:
-        if discovered:
-            cluster_object = aws_discovered_eks_clusters.find_one({CLUSTER_NAME.lower(): cluster_name})
-        else:
-            cluster_object = eks_clusters.find_one({CLUSTER_NAME.lower(): cluster_name})
-    elif cluster_type == AKS:
-        cluster_object = aks_clusters.find_one({CLUSTER_NAME.lower(): cluster_name})
-    else:
-        cluster_object = []
-    del cluster_object['_id']
+    projection = {'_id': 0}
+    if fields:
+        projection.update({field: 1 for field in fields if LISTING_FIELD_PATTERN.match(field)})
+    cluster_object = clusters.find_one(build_cluster_query(cluster_type, cluster_name, discovered), projection)
+    if not cluster_object:
+        return {}
     return cluster_object
 
 
@@ -349,202 +606,204 @@ def retrieve_agent_cluster_details(cluster_name: str) -> list:
     return [cluster_object]
 
 
+def retrieve_containers_logs_page(cluster_name: str, namespace: str = '', pod: str = '', container_name: str = '',
+                                  limit: int = 0, cursor: str = '', fields: list = None) -> tuple:
+    """
+    @param cluster_name: The cluster the Trolley Agent runs on
+    @param namespace: Narrow the logs down to a namespace
+    @param pod: Narrow the logs down to a pod
+    @param container_name: Narrow the logs down to a container
+    @param limit: The page size, AGENT_LOGS_PAGE_SIZE by default
+    @param cursor: The cursor returned with the previous page
+    @param fields: The fields to return. All the fields are returned by default
+    @return: A page of log chunks, the newest first, and the cursor of the next page
+    """
+    logger.info(f'A request to fetch {cluster_name} containers logs was received')
+    mongo_query = {CLUSTER_NAME.lower(): cluster_name}
+    for field, value in (('namespace', namespace), ('pod', pod), ('container_name', container_name)):
+        if value:
+            mongo_query[field] = value
+    limit = limit or AGENT_LOGS_PAGE_SIZE
+    listing_stages, sort_field = build_listing_stages(limit, cursor, '-_id', fields)
+    pipeline = [{'$match': mongo_query}, *listing_stages]
+    return page_listing(list(k8s_agent_logs.aggregate(pipeline)), limit, sort_field, fields)
+
+
 def retrieve_expired_clusters(cluster_type: str) -> list:
     current_time = int(time.time())
-    expired_clusters_list = []
-    mongo_query = {"$and": [{EXPIRATION_TIMESTAMP: {"$lt": current_time}},
-                            {AVAILABILITY: True}]}
-    if cluster_type == GKE:
-        clusters_objects = gke_clusters.find(mongo_query)
-        for object in clusters_objects:
-            expired_clusters_list.append(object)
-            logger.info(expired_clusters_list)
-    elif cluster_type == GKE_AUTOPILOT:
-        autopilot_clusters_objects = gke_autopilot_clusters.find(mongo_query)
-        for object in autopilot_clusters_objects:
-            expired_clusters_list.append(object)
-            logger.info(expired_clusters_list)
-    elif cluster_type == EKS:
-        eks_clusters_objects = eks_clusters.find(mongo_query)
-        for object in eks_clusters_objects:
-            expired_clusters_list.append(object)
-            logger.info(expired_clusters_list)
-    elif cluster_type == AKS:
-        aks_clusters_objects = aks_clusters.find(mongo_query)
-        for object in aks_clusters_objects:
-            expired_clusters_list.append(object)
-            logger.info(expired_clusters_list)
+    if cluster_type not in CLUSTERS_TYPES:
+        return []
+    mongo_query = {CLUSTER_TYPE: cluster_type, DISCOVERED: False, AVAILABILITY: True,
+                   EXPIRATION_TIMESTAMP: {"$lt": current_time}}
+    expired_clusters_list = list(clusters.find(mongo_query))
+    logger.info(expired_clusters_list)
     return expired_clusters_list
 
 
-def insert_cache_object(caching_object: dict = None, provider: str = None, machine_types: bool = False,
-                        gke_full_cache: bool = False, gke_machine_series: bool = False,
-                        gke_series_and_machine_types: bool = False, aws_series_and_machine_types: bool = False,
-                        gke_zones_and_series: bool = False, aws_regions_and_series: bool = False) -> bool:
+def build_content_hash(caching_object: dict) -> str:
     """
-    @param caching_object: The dictionary with all the cluster data.
-    @param provider: The dictionary with all the cluster data.
-    @param gke_full_cache: The full GKE cache
-    @param gke_machine_series: The list of all the available machine series
-    @param gke_series_and_machine_types: The list of all the available machine types per machine series
-    @param gke_zones_and_series: The list of all the available zones and the available machine series
+    @param caching_object: A cache document, without its _id and content_hash fields
+    @return: A stable hash of the document content, used to skip rewriting unchanged cache documents
+    """
+    content = json.dumps(caching_object, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def resolve_cache_collection(provider: str = None, machine_types: bool = False, gke_full_cache: bool = False,
+                             gke_machine_series: bool = False, gke_series_and_machine_types: bool = False,
+                             aws_series_and_machine_types: bool = False, gke_zones_and_series: bool = False,
+                             aws_regions_and_series: bool = False) -> tuple:
+    """
+    @return: The cache collection of the cache kind and the key fields of its documents.
+    The key fields are empty for the single document caches
     """
-    logger.info(f'inserting cache_object of {provider} provider')
     if provider == GKE:
         if machine_types:
-            try:
-                myquery = {"region": caching_object['region']}
-                if gke_machines_cache.find_one(myquery):
-                    newvalues = {"$set": {'machines_list': caching_object['machines_list'],
-                                          'region': caching_object['region']}}
-                    mongo_response = gke_machines_cache.update_one(myquery, newvalues)
-                    logger.info(mongo_response.acknowledged)
-                else:
-                    values = {'machines_list': caching_object['machines_list'],
-                              'region': caching_object['region']}
-                    mongo_response = gke_machines_cache.insert_one(values)
-                    logger.info(mongo_response.acknowledged)
-                return True
-            except Exception as e:
-                logger.error(f'failure to insert data into gke_machines_cache table with error: {e}')
-                return False
+            return gke_machines_cache, ['region']
         elif gke_full_cache:
-            gke_cache.drop()
-            try:
-                mongo_response = gke_cache.insert_one(caching_object)
-                logger.info(mongo_response.acknowledged)
-                logger.info(f'Inserted ID for Mongo DB is: {mongo_response.inserted_id}')
-                return True
-            except Exception as e:
-                logger.error(f'failure to insert data into gke_cache table with error: {e}')
-                return False
-        if gke_series_and_machine_types:
-            try:
-                myquery = {'series': caching_object['machine_series']}
-                if gke_series_and_machine_types_cache.find_one(myquery):
-                    newvalues = {"$set": {'series': caching_object['machine_series'],
-                                          'machines_list': caching_object['machines_list']}}
-                    mongo_response = gke_series_and_machine_types_cache.update_one(myquery, newvalues)
-                    logger.info(mongo_response.acknowledged)
-                else:
-                    mongo_response = gke_series_and_machine_types_cache.insert_one(caching_object)
-                    logger.info(mongo_response.acknowledged)
-                return True
-            except Exception as e:
-                logger.error(f'failure to insert data into gke_series_and_machine_types_cache table with error: {e}')
-                return False
+            return gke_cache, []
+        elif gke_series_and_machine_types:
+            return gke_series_and_machine_types_cache, ['machine_series']
         elif gke_zones_and_series:
-            try:
-                myquery = {'zone': caching_object['zone']}
-                if gke_zones_and_series_cache.find_one(myquery):
-                    newvalues = {"$set": {'zone': caching_object['zone'],
-                                          'series_list': caching_object['series_list']}}
-                    mongo_response = gke_zones_and_series_cache.update_one(myquery, newvalues)
-                    logger.info(mongo_response.acknowledged)
-                else:
-                    mongo_response = gke_zones_and_series_cache.insert_one(caching_object)
-                    logger.info(mongo_response.acknowledged)
-                return True
-            except Exception as e:
-                logger.error(f'failure to insert data into gke_zones_and_series_cache table with error: {e}')
-                return False
+            return gke_zones_and_series_cache, ['zone']
         elif gke_machine_series:
-            try:
-                myquery = {"zone": caching_object['zone'], 'machine_type': caching_object}
-                if gke_machines_series_cache.find_one(myquery):
-                    newvalues = {"$set": {'machine_type': caching_object['machine_type'],
-                                          'series_type': caching_object['series_type'],
-                                          'vCPU': caching_object['vCPU'],
-                                          'memory': caching_object['memory'],
-                                          'zone': caching_object['zone']}}
-                    mongo_response = gke_machines_series_cache.update_one(myquery, newvalues)
-                    logger.info(mongo_response.acknowledged)
-                else:
-                    mongo_response = gke_machines_series_cache.insert_one(caching_object)
-                    logger.info(mongo_response.acknowledged)
-                return True
-            except Exception as e:
-                logger.error(f'failure to insert data into gke_machines_cache table with error: {e}')
-                return False
-        else:
-            pass
+            return gke_machines_series_cache, ['zone', 'machine_type']
     elif provider == EKS:
         if machine_types:
-            try:
-                myquery = {"region": caching_object['region']}
-                if aws_machines_cache.find_one(myquery):
-                    newvalues = {"$set": {'machines_list': caching_object['machines_list'],
-                                          'region': caching_object['region']}}
-                    mongo_response = aws_machines_cache.update_one(myquery, newvalues)
-                    logger.info(mongo_response.acknowledged)
-                else:
-                    values = {'machines_list': caching_object['machines_list'],
-                              'region': caching_object['region']}
-                    mongo_response = aws_machines_cache.insert_one(values)
-                    logger.info(mongo_response.acknowledged)
-                return True
-            except Exception as e:
-                logger.error(f'failure to insert data into gke_machines_cache table with error: {e}')
-                return False
+            return aws_machines_cache, ['region']
         elif aws_regions_and_series:
-            try:
-                myquery = {'region': caching_object['region']}
-                if aws_regions_and_series_cache.find_one(myquery):
-                    newvalues = {"$set": {'region': caching_object['region'],
-                                          'series_list': caching_object['series_list']}}
-                    mongo_response = aws_regions_and_series_cache.update_one(myquery, newvalues)
-                    logger.info(mongo_response.acknowledged)
-                else:
-                    mongo_response = aws_regions_and_series_cache.insert_one(caching_object)
-                    logger.info(mongo_response.acknowledged)
-                return True
-            except Exception as e:
-                logger.error(f'failure to insert data into aws_zones_and_series_cache table with error: {e}')
-                return False
+            return aws_regions_and_series_cache, ['region']
         elif aws_series_and_machine_types:
-            try:
-                myquery = {'series': caching_object['machine_series']}
-                if aws_series_and_machine_types_cache.find_one(myquery):
-                    newvalues = {"$set": {'series': caching_object['machine_series'],
-                                          'machines_list': caching_object['machines_list']}}
-                    mongo_response = aws_series_and_machine_types_cache.update_one(myquery, newvalues)
-                    logger.info(mongo_response.acknowledged)
-                else:
-                    mongo_response = aws_series_and_machine_types_cache.insert_one(caching_object)
-                    logger.info(mongo_response.acknowledged)
-                return True
-            except Exception as e:
-                logger.error(f'failure to insert data into aws_series_and_machine_types_cache table with error: {e}')
-                return False
-        # aws_cache.drop()
-        try:
-            mongo_response = aws_cache.insert_one(caching_object)
-            logger.info(mongo_response.acknowledged)
-            logger.info(f'Inserted ID for Mongo DB is: {mongo_response.inserted_id}')
-            return True
-        except Exception as e:
-            logger.error(f'failure to insert data into aws_cache table with error: {e}')
-            return False
+            return aws_series_and_machine_types_cache, ['machine_series']
+        return aws_cache, []
     elif provider == AKS:
-        aks_cache.drop()
-        try:
-            mongo_response = aks_cache.insert_one(caching_object)
-            logger.info(mongo_response.acknowledged)
-            logger.info(f'Inserted ID for Mongo DB is: {mongo_response.inserted_id}')
-            return True
-        except Exception as e:
-            logger.error(f'failure to insert data into aks_cache table with error: {e}')
-            return False
+        return aks_cache, []
     elif provider == HELM:
-        helm_cache.drop()
-        try:
-            mongo_response = helm_cache.insert_one(caching_object)
-            logger.info(mongo_response.acknowledged)
-            logger.info(f'Inserted ID for Mongo DB is: {mongo_response.inserted_id}')
+        return helm_cache, []
+    return None, []
+
+
+def bulk_upsert_cache_objects(collection: Collection, caching_objects: list, key_fields: list) -> int:
+    """
+    @param collection: The cache collection to write to
+    @param caching_objects: The cache documents, all of the cache kind. The documents of the keys missing from them
+    are deleted, e.g. the retired regions, zones and machine series
+    @param key_fields: The fields that identify a document in the collection
+    @return: The amount of written and deleted documents. Documents whose content_hash didn't change are skipped
+    """
+    current_hashes = {}
+    duplicated_ids = []
+    keys_query = {'$or': [{key_field: caching_object[key_field] for key_field in key_fields}
+                          for caching_object in caching_objects]}
+    projection = {'content_hash': 1, **{key_field: 1 for key_field in key_fields}}
+    for current_object in collection.find(keys_query, projection):
+        current_key = tuple(current_object.get(key_field) for key_field in key_fields)
+        if current_key in current_hashes:
+            # Duplicates left over from the former find_one/insert_one writes
+            duplicated_ids.append(current_object['_id'])
+            continue
+        current_hashes[current_key] = current_object.get('content_hash')
+    if duplicated_ids:
+        collection.delete_many({'_id': {'$in': duplicated_ids}})
+    requests = []
+    for caching_object in caching_objects:
+        caching_object = {key: value for key, value in caching_object.items() if key not in ('_id', 'content_hash')}
+        caching_object['content_hash'] = build_content_hash(caching_object)
+        caching_object_key = tuple(caching_object[key_field] for key_field in key_fields)
+        if current_hashes.get(caching_object_key) == caching_object['content_hash']:
+            continue
+        mongo_query = {key_field: caching_object[key_field] for key_field in key_fields}
+        requests.append(UpdateOne(mongo_query, {'$set': caching_object}, upsert=True))
+    for index in range(0, len(requests), BULK_WRITE_BATCH_SIZE):
+        collection.bulk_write(requests[index:index + BULK_WRITE_BATCH_SIZE], ordered=False)
+    deleted_count = collection.delete_many({'$nor': keys_query['$or']}).deleted_count
+    logger.info(f'{collection.name}: {len(requests)} out of {len(caching_objects)} cache documents were written, '
+                f'the rest were unchanged. {deleted_count} retired documents were deleted')
+    return len(requests) + deleted_count
+
+
+def replace_single_cache_object(collection: Collection, caching_object: dict) -> bool:
+    """
+    Replaces the document of a single document cache in place, so readers never see an empty or a stale cache.
+    Documents left over from the former insert only writes are removed
+    @param collection: The single document cache collection
+    @param caching_object: The new cache document
+    """
+    caching_object = {key: value for key, value in caching_object.items() if key not in ('_id', 'content_hash')}
+    caching_object['content_hash'] = build_content_hash(caching_object)
+    current_object = collection.find_one({}, {'content_hash': 1})
+    if not current_object:
+        current_id = collection.insert_one(caching_object).inserted_id
+    else:
+        current_id = current_object['_id']
+        if current_object.get('content_hash') != caching_object['content_hash']:
+            collection.replace_one({'_id': current_id}, caching_object)
+        else:
+            logger.info(f'{collection.name} is unchanged')
+    collection.delete_many({'_id': {'$ne': current_id}})
+    return True
+
+
+def bump_caches_generation(generation_id: str = CACHES_GENERATION_ID) -> int:
+    """
+    Lets the web processes know that a cache collection changed and their caches catalogue has to be reloaded
+    @param generation_id: The generation to bump, USERS_GENERATION_ID for the users caches
+    """
+    generation_object = caches_generation.find_one_and_update({'_id': generation_id},
+                                                              {'$inc': {'generation': 1}},
+                                                              upsert=True, return_document=ReturnDocument.AFTER)
+    return generation_object['generation']
+
+
+def insert_cache_objects(caching_objects: list = None, provider: str = None, machine_types: bool = False,
+                         gke_full_cache: bool = False, gke_machine_series: bool = False,
+                         gke_series_and_machine_types: bool = False, aws_series_and_machine_types: bool = False,
+                         gke_zones_and_series: bool = False, aws_regions_and_series: bool = False) -> bool:
+    """
+    @param caching_objects: The cache documents of a single cache kind, written with one bulk write
+    @param provider: The provider of the cache. Ex: gke/eks/aks/helm
+    @param machine_types: The list of all the machine types per region/zone
+    @param gke_full_cache: The full GKE cache
+    @param gke_machine_series: The list of all the available machine series
+    @param gke_series_and_machine_types: The list of all the available machine types per machine series
+    @param aws_series_and_machine_types: The list of all the available machine types per machine series
+    @param gke_zones_and_series: The list of all the available zones and the available machine series
+    @param aws_regions_and_series: The list of all the available regions and the available machine series
+    """
+    collection, key_fields = resolve_cache_collection(provider, machine_types, gke_full_cache, gke_machine_series,
+                                                      gke_series_and_machine_types, aws_series_and_machine_types,
+                                                      gke_zones_and_series, aws_regions_and_series)
+    if collection is None or not caching_objects:
+        logger.error(f'No cache objects of the requested {provider} cache kind were passed')
+        return False
+    logger.info(f'inserting {len(caching_objects)} cache objects of {provider} provider into {collection.name}')
+    try:
+        if not key_fields:
+            replace_single_cache_object(collection, caching_objects[-1])
+        elif not bulk_upsert_cache_objects(collection, caching_objects, key_fields):
             return True
-        except Exception as e:
-            logger.error(f'failure to insert data into helm_cache table with error: {e}')
-            return False
+        bump_caches_generation()
+        return True
+    except Exception as e:
+        logger.error(f'failure to insert data into {collection.name} table with error: {e}')
+        return False
+
+
+def insert_cache_object(caching_object: dict = None, provider: str = None, machine_types: bool = False,
+                        gke_full_cache: bool = False, gke_machine_series: bool = False,
+                        gke_series_and_machine_types: bool = False, aws_series_and_machine_types: bool = False,
+                        gke_zones_and_series: bool = False, aws_regions_and_series: bool = False) -> bool:
+    """
+    @param caching_object: The dictionary with all the cluster data.
+    @param provider: The dictionary with all the cluster data.
+    @param gke_full_cache: The full GKE cache
+    @param gke_machine_series: The list of all the available machine series
+    @param gke_series_and_machine_types: The list of all the available machine types per machine series
+    @param gke_zones_and_series: The list of all the available zones and the available machine series
+    """
+    return insert_cache_objects([caching_object], provider, machine_types, gke_full_cache, gke_machine_series,
+                                gke_series_and_machine_types, aws_series_and_machine_types, gke_zones_and_series,
+                                aws_regions_and_series)
 
 
 def retrieve_clients_data() -> list:
@@ -561,110 +820,191 @@ def retrieve_clients_data() -> list:
 
 
 def retrieve_client_per_cluster_name(cluster_type: str = '', cluster_name: str = '') -> list:
-    mongo_query = {CLUSTER_NAME.lower(): cluster_name}
-    if cluster_type == GKE:
-        client_name = gke_clusters.find_one(mongo_query)
-    elif cluster_type == EKS:
-        client_name = eks_clusters.find_one(mongo_query)
-    elif cluster_type == AKS:
-        client_name = aks_clusters.find_one(mongo_query)
-    else:
-        client_name = gke_clusters.find_one(mongo_query)
+    mongo_query = build_cluster_query(cluster_type, cluster_name)
+    client_name = clusters.find_one(mongo_query, {CLIENT_NAME.lower(): 1})
     return client_name[CLIENT_NAME.lower()]
 
 
+def load_caches_catalogue() -> dict:
+    """
+    Reads all the build form caches with a query per cache collection
+    @return: provider -> {'cache': the single document cache, 'machine_series': zone/region -> series list,
+    'machine_types': series -> machine types list}
+    """
+    catalogue = {}
+    for provider, cache_collection in ((GKE, gke_cache), (EKS, aws_cache), (AKS, aks_cache), (HELM, helm_cache)):
+        catalogue[provider] = {'cache': cache_collection.find_one({}, {'_id': 0}) or {},
+                               'machine_series': {}, 'machine_types': {}}
+    for provider, series_collection, location_field in ((GKE, gke_zones_and_series_cache, 'zone'),
+                                                        (EKS, aws_regions_and_series_cache, 'region')):
+        for series_object in series_collection.find({}, {'_id': 0, location_field: 1, 'series_list': 1}):
+            catalogue[provider]['machine_series'][series_object.get(location_field)] = series_object.get(
+                'series_list', [])
+    for provider, machine_types_collection in ((GKE, gke_series_and_machine_types_cache),
+                                               (EKS, aws_series_and_machine_types_cache)):
+        for machine_types_object in machine_types_collection.find({}, {'_id': 0, 'machine_series': 1,
+                                                                       'machines_list': 1}):
+            catalogue[provider]['machine_types'][machine_types_object.get('machine_series')] = \
+                machine_types_object.get('machines_list', [])
+    return catalogue
+
+
+def retrieve_caches_catalogue() -> dict:
+    """
+    @return: The in-process caches catalogue. The caches generation is checked at most every
+    CACHES_CATALOGUE_CHECK_INTERVAL seconds and the catalogue is reloaded only when it changed
+    """
+    with caches_catalogue_lock:
+        if caches_catalogue['caches'] is not None and \
+                time.monotonic() - caches_catalogue['checked_at'] < CACHES_CATALOGUE_CHECK_INTERVAL:
+            return caches_catalogue['caches']
+        generation_object = caches_generation.find_one({'_id': CACHES_GENERATION_ID}) or {}
+        generation = generation_object.get('generation', 0)
+        if caches_catalogue['caches'] is None or generation != caches_catalogue['generation']:
+            logger.info(f'Loading the caches catalogue of generation {generation}')
+            caches_catalogue['caches'] = load_caches_catalogue()
+            caches_catalogue['generation'] = generation
+        caches_catalogue['checked_at'] = time.monotonic()
+        return caches_catalogue['caches']
+
+
 def retrieve_cache(cache_type: str = '', provider: str = '') -> list:
-    if provider == GKE:
-        cache_object = gke_cache.find()[0]
-    elif provider == EKS:
-        cache_object = aws_cache.find()[0]
-    elif provider == AKS:
-        cache_object = aks_cache.find()[0]
-    elif provider == HELM:
-        return helm_cache.find()[0]['helms_installs']
-    else:
-        cache_object = gke_cache.find()[0]
-    return cache_object[cache_type]
+    if provider not in (GKE, EKS, AKS, HELM):
+        provider = GKE
+    cache_object = retrieve_caches_catalogue()[provider]['cache']
+    if provider == HELM:
+        return cache_object.get('helms_installs', [])
+    return cache_object.get(cache_type, [])
 
 
 def retrieve_machine_series(region_name: str = '', cluster_type: str = '') -> list:
-    if cluster_type == GKE:
-        mongo_query = {'zone': region_name}
-        machine_series_object = gke_zones_and_series_cache.find_one(mongo_query)
-    elif cluster_type == EKS:
-        mongo_query = {'region': region_name}
-        machine_series_object = aws_regions_and_series_cache.find_one(mongo_query)
-    elif cluster_type == AKS:
-        pass
-    else:
-        mongo_query = {'zone': region_name}
-        machine_series_object = gke_zones_and_series_cache.find_one(mongo_query)
-    return machine_series_object['series_list']
+    if cluster_type == AKS:
+        return []
+    if cluster_type != EKS:
+        cluster_type = GKE
+    return retrieve_caches_catalogue()[cluster_type]['machine_series'].get(region_name, [])
 
 
 def retrieve_machine_types(machine_series: str = '', cluster_type: str = '') -> list:
-    if cluster_type == GKE:
-        mongo_query = {'machine_series': machine_series}
-        machine_types_object = gke_series_and_machine_types_cache.find_one(mongo_query)
-    elif cluster_type == EKS:
-        mongo_query = {'machine_series': machine_series}
-        machine_types_object = aws_series_and_machine_types_cache.find_one(mongo_query)
-    elif cluster_type == AKS:
-        pass
-    else:
-        mongo_query = {'machine_series': machine_series}
-        machine_types_object = gke_series_and_machine_types_cache.find_one(mongo_query)
-    try:
-        machines_list = machine_types_object['machines_list']
-        return machines_list
-    except:
+    if cluster_type == AKS:
         return []
+    if cluster_type != EKS:
+        cluster_type = GKE
+    return retrieve_caches_catalogue()[cluster_type]['machine_types'].get(machine_series, [])
+
+
+def retrieve_machine_types_index(provider: str = '', region_name: str = '') -> dict:
+    """
+    @param provider: The provider of the machines cache to index. Ex: gke/eks
+    @param region_name: Index only the machine types cached for this region/zone. All the regions are indexed by default
+    @return: A machine_type -> {'vCPU', 'memory'} dictionary built with a single read of the machines cache
+    """
+    if provider == EKS:
+        machines_cache = aws_machines_cache
+    else:
+        machines_cache = gke_machines_cache
+    mongo_query = {'region': region_name} if region_name else {}
+    machine_types_index = {}
+    for cache_object in machines_cache.find(mongo_query, {'_id': 0, 'machines_list': 1}):
+        for machine in cache_object.get('machines_list', []):
+            machine_types_index.setdefault(machine['machine_type'], {'vCPU': machine['vCPU'],
+                                                                     'memory': machine['memory']})
+    logger.info(f'Indexed {len(machine_types_index)} {provider} machine types')
+    return machine_types_index
 
 
 def retrieve_compute_per_machine_type(provider: str = '', machine_type: str = '', region_name: str = '') -> dict:
-    if provider == GKE:
-        mongo_query = {'region': region_name}
-        cache_object = gke_machines_types_cache.find_one(mongo_query)
-    elif provider == EKS:
-        cache_object = aws_cache.find()[0]
-    elif provider == AKS:
-        cache_object = aks_cache.find()[0]
-    elif provider == HELM:
+    if provider == HELM:
         return helm_cache.find()[0]['helms_installs']
-    else:
-        cache_object = gke_cache.find()[0]
-    machines_list = cache_object['machines_list']
-    for machine in machines_list:
-        if machine['machine_type'] == machine_type:
-            return machine
+    return retrieve_machine_types_index(provider, region_name).get(machine_type)
 
 
-def retrieve_user(user_email: str):
+def retrieve_user(user_email: str, projection: dict = None, with_profile_image: bool = False):
     """
     @param user_email:  retrieve a returning user data
+    @param projection: The fields of the user document to fetch. The whole document is fetched by default
+    @param with_profile_image: Whether to attach the GridFS profile image to the returned user object
     @return:
     """
-    print(f'Listing all the collections')
-    logger.info(f'Listing all the collections')
-    print(db.list_collection_names())
-    logger.info(db.list_collection_names())
     mongo_query = {USER_EMAIL: user_email}
-    logger.info(f'Running the {mongo_query}')
-    user_object = users.find_one(mongo_query)
-    logger.info(f'The result of the query is: {user_object}')
+    user_object = users.find_one(mongo_query, projection)
     if not user_object:
-        logger.warning(f'Nothing was found in the users db')
+        logger.warning(f'{user_email} was not found in the users db')
         return None
+    if with_profile_image:
+        try:
+            user_object['profile_image'] = retrieve_profile_image(user_object['profile_image_id'])
+        except Exception as e:
+            logger.error(f'Failed to fetch the profile image of {user_email}: {e}')
+    return user_object
+
+
+def retrieve_user_by_id(user_id: str):
+    """
+    @param user_id: The id of the user that was encoded into the x-access-token
+    @return: The user document, served from the in-process users cache when possible
+    """
+    with users_cache_lock:
+        sync_users_cache()
+        user_object = users_cache.get(user_id)
+    if user_object:
+        return user_object
     try:
-        profile_image_id = user_object['profile_image_id']
-        file = fs.find_one({"_id": profile_image_id})
-        user_object['profile_image'] = file
-        logger.info(f'The result of the query is: {user_object}')
-    except:
-        logger.error(f'There was a problem here')
+        user_object = users.find_one({'_id': ObjectId(user_id)})
+    except Exception as e:
+        logger.error(f'Failed to fetch the user with {user_id} id: {e}')
+        return None
+    if not user_object:
+        logger.warning(f'{user_id} user_id was not found in the users db')
+        return None
+    with users_cache_lock:
+        users_cache[user_id] = user_object
     return user_object
 
 
+def sync_users_cache():
+    """
+    Drops the users cache when another process invalidated a user. Expects users_cache_lock to be held
+    """
+    if time.monotonic() - users_cache_state['checked_at'] < USERS_GENERATION_CHECK_INTERVAL:
+        return
+    try:
+        generation_object = caches_generation.find_one({'_id': USERS_GENERATION_ID}) or {}
+        generation = generation_object.get('generation', 0)
+    except Exception as e:
+        # The invalidations can't be seen, so the cached users aren't trusted
+        logger.error(f'Failed to fetch the users generation: {e}')
+        users_cache.clear()
+        return
+    if generation != users_cache_state['generation']:
+        users_cache.clear()
+        users_cache_state['generation'] = generation
+    users_cache_state['checked_at'] = time.monotonic()
+
+
+def invalidate_user_cache(user_email: str = '', user_name: str = ''):
+    """
+    @param user_email: The email of the user whose cached record should be dropped
+    @param user_name: The user_name of the user whose cached record should be dropped
+    """
+    with users_cache_lock:
+        for user_id, user_object in list(users_cache.items()):
+            if (user_email and user_object.get(USER_EMAIL) == user_email) or \
+                    (user_name and user_object.get(USER_NAME.lower()) == user_name):
+                del users_cache[user_id]
+    try:
+        bump_caches_generation(USERS_GENERATION_ID)
+    except Exception as e:
+        logger.error(f'Failed to bump the users generation, other processes may serve a stale user: {e}')
+
+
+def retrieve_profile_image(profile_image_id: ObjectId):
+    """
+    @param profile_image_id: The GridFS id of the user's profile image
+    """
+    return fetch_gridfs().find_one({"_id": profile_image_id})
+
+
 def retrieve_users_data(logged_user_name: str = ""):
     """
     This endpoint retrieves data for all the available users
@@ -707,7 +1047,7 @@ def update_user(user_email: str, update_type: str, update_value: str) -> bool:
             newvalues = {"$set": {update_type: update_value}}
             # result = users.replace_one(existing_user_object, existing_user_object)
             result = users.update_one(mongo_query, newvalues)
-
+            invalidate_user_cache(user_email=user_email)
             return True
     except:
         print("dsf")
@@ -766,6 +1106,7 @@ def delete_user(user_email: str = "", user_name: str = ""):
         myquery = {USER_EMAIL: user_email}
         newvalues = {"$set": {'availability': False}}
         result = users.update_one(myquery, newvalues)
+    invalidate_user_cache(user_email=user_email, user_name=user_name)
     return result.raw_result['updatedExisting']
 
 
@@ -827,6 +1168,7 @@ def update_user_registration_status(user_email: str = "", registration_status: s
     myquery = {"user_email": user_email}
     newvalues = {"$set": {'registration_status': registration_status}}
     result = users.update_one(myquery, newvalues)
+    invalidate_user_cache(user_email=user_email)
     logger.info(f'users_data_object was updated properly')
     return result.raw_result['updatedExisting']
 
@@ -835,7 +1177,7 @@ def is_users() -> bool:
     """
     This function checks if there are any users in the DB
     """
-    if len(list(users.find())) > 0:
+    if users.find_one({}, {'_id': 1}):
         return True
     else:
         return False
@@ -848,7 +1190,7 @@ def is_admin(user_name: str = "") -> bool:
     if not user_name:
         return False
     mongo_query = {USER_NAME.lower(): user_name}
-    user_object = users.find_one(mongo_query)
+    user_object = users.find_one(mongo_query, {'user_type': 1})
     if user_object['user_type'] == ADMIN:
         return True
     else:
@@ -860,7 +1202,7 @@ def check_user_type(user_email: str = "") -> str:
     This function checks the user_type of provided email
     """
     mongo_query = {USER_EMAIL.lower(): user_email}
-    user_object = users.find_one(mongo_query)
+    user_object = users.find_one(mongo_query, {'user_type': 1})
     if user_object:
         return user_object['user_type']
     else:
@@ -874,7 +1216,17 @@ def insert_file(profile_image_filename: str = '') -> ObjectId:
     with open(profile_image_filename, 'rb') as f:
         contents = f.read()
 
-    return fs.put(contents, filename=profile_image_filename)
+    return fetch_gridfs().put(contents, filename=profile_image_filename,
+                  content_type=mimetypes.guess_type(profile_image_filename)[0])
+
+
+def insert_file_content(contents: bytes, filename: str = '', content_type: str = '') -> ObjectId:
+    """
+    @param contents: The bytes of the file to save
+    @param filename: The filename to store the contents under
+    @param content_type: The mimetype of the contents
+    """
+    return fetch_gridfs().put(contents, filename=filename, content_type=content_type)
 
 
 def insert_deployment_yaml(deployment_yaml_object: dict):
@@ -887,46 +1239,520 @@ def insert_deployment_yaml(deployment_yaml_object: dict):
 
 def insert_cluster_data_object(cluster_data_object: dict) -> bool:
     """
-    @param cluster_data_object: The filename of the image to save
-    """
+    @param cluster_data_object: The cluster inventory sent by a Trolley Agent. Container logs sent along by older
+    agents are moved to the k8s_agent_logs collection, so the inventory document stays small
+    """
+    cluster_name = cluster_data_object[CLUSTER_NAME.lower()]
+    containers_logs = []
+    containers = []
+    for container in cluster_data_object.get('containers', []):
+        container = dict(container)
+        if 'pod_name' in container:
+            container['pod'] = container.pop('pod_name')
+        if 'log' in container:
+            containers_logs.append(dict(container))
+            del container['log']
+        containers.append(container)
+    cluster_data_object['containers'] = containers
+    if containers_logs:
+        insert_containers_logs(cluster_name, containers_logs, cluster_data_object.get('timestamp', int(time.time())))
     try:
-        mongo_query = {CLUSTER_NAME.lower(): cluster_data_object[CLUSTER_NAME.lower()]}
-        existing_cluster_data_object = k8s_agent_data.find_one(mongo_query)
-        if existing_cluster_data_object:
-            result = k8s_agent_data.replace_one(existing_cluster_data_object, cluster_data_object)
-            logger.info(f'cluster_data_object was updated properly')
-            return result.raw_result['updatedExisting']
-        else:
-            result = k8s_agent_data.insert_one(cluster_data_object)
-            if result.inserted_id:
-                logger.info(f'cluster_data_object was inserted properly')
-                return True
-            else:
-                logger.error(f'cluster_data_object was not inserted properly')
-                return False
+        mongo_query = {CLUSTER_NAME.lower(): cluster_name}
+        result = k8s_agent_data.replace_one(mongo_query, cluster_data_object, upsert=True)
+        logger.info(f'cluster_data_object was upserted properly')
+        return result.acknowledged
     except:
         logger.error(f'cluster_data_object was not inserted properly')
+        return False
+
+
+def build_inventory_row_key(section: str, row) -> tuple:
+    key_fields = AGENT_INVENTORY_KEY_FIELDS[section]
+    if not key_fields:
+        return row,
+    return tuple(row.get(key_field) for key_field in key_fields)
 
 
-def insert_aws_instances_object(aws_ec2_instances_object: list) -> bool:
+def merge_cluster_data_delta(cluster_data_delta_object: dict) -> bool:
     """
-    @param aws_ec2_instances_object: The aws ec2 instances to save to DB
+    @param cluster_data_delta_object: The upserted and deleted rows of every changed inventory section, sent by a
+    Trolley Agent in watch mode
+    @return: False when there's no inventory to merge the delta into, the agent sends the full inventory then
     """
-    logger.info(f'{aws_ec2_instances_object}')
+    mongo_query = {CLUSTER_NAME.lower(): cluster_data_delta_object[CLUSTER_NAME.lower()]}
+    changed_sections = [section for section in cluster_data_delta_object.get('changes', {})
+                        if section in AGENT_INVENTORY_KEY_FIELDS]
+    cluster_data_object = k8s_agent_data.find_one(mongo_query, {section: 1 for section in changed_sections})
+    if not cluster_data_object:
+        logger.warning(f'There is no inventory of {mongo_query} to merge a delta into')
+        return False
+    updated_fields = {'timestamp': cluster_data_delta_object['timestamp'],
+                      'context_name': cluster_data_delta_object.get('context_name')}
+    for section in changed_sections:
+        section_changes = cluster_data_delta_object['changes'][section]
+        upserted_rows = section_changes.get('upserted', [])
+        replaced_keys = {build_inventory_row_key(section, row)
+                         for row in upserted_rows + section_changes.get('deleted', [])}
+        updated_fields[section] = [row for row in cluster_data_object.get(section, [])
+                                   if build_inventory_row_key(section, row) not in replaced_keys] + upserted_rows
+    # The agent's hashes of the merged sections are stale, so they are sent again on the next hashes negotiation
+    stale_hashes = {f'section_hashes.{section}': '' for section in changed_sections}
+    mongo_update = {'$set': updated_fields}
+    if stale_hashes:
+        mongo_update['$unset'] = stale_hashes
+    result = k8s_agent_data.update_one({'_id': cluster_data_object['_id']}, mongo_update)
+    logger.info(f'Merged the changed {", ".join(changed_sections)} sections into the inventory of {mongo_query}')
+    return result.acknowledged
+
+
+def upsert_cluster_data_sections(cluster_data_object: dict) -> list:
+    """
+    @param cluster_data_object: The cluster data sent by a Trolley Agent with the section_hashes of its whole
+    inventory, and the sections the server was missing if it already asked for them
+    @return: The sections whose hash doesn't match the stored one, the agent sends them next
+    """
+    mongo_query = {CLUSTER_NAME.lower(): cluster_data_object[CLUSTER_NAME.lower()]}
+    section_hashes = cluster_data_object.pop('section_hashes')
+    sent_sections = [section for section in AGENT_INVENTORY_KEY_FIELDS if section in cluster_data_object]
+    stored_object = k8s_agent_data.find_one(mongo_query, {'section_hashes': 1}) or {}
+    stored_hashes = stored_object.get('section_hashes') or {}
+    updated_fields = dict(cluster_data_object)
+    for section in sent_sections:
+        updated_fields[f'section_hashes.{section}'] = section_hashes.get(section)
+    k8s_agent_data.update_one(mongo_query, {'$set': updated_fields}, upsert=True)
+    missing_sections = [section for section, section_hash in section_hashes.items()
+                        if section in AGENT_INVENTORY_KEY_FIELDS and section not in sent_sections
+                        and stored_hashes.get(section) != section_hash]
+    logger.info(f'Updated the {sent_sections} sections of {mongo_query}, missing the {missing_sections} sections')
+    return missing_sections
+
+
+def insert_containers_logs(cluster_name: str, containers_logs: list, timestamp: int) -> bool:
+    """
+    @param cluster_name: The cluster the Trolley Agent runs on
+    @param containers_logs: The namespace, pod, container_name and log of every container with new log lines
+    @param timestamp: The time the logs were fetched at
+    """
+    log_objects = [{CLUSTER_NAME.lower(): cluster_name, 'namespace': container_log.get('namespace', ''),
+                    'pod': container_log.get('pod', ''), 'container_name': container_log.get('container_name', ''),
+                    'timestamp': timestamp, 'log': container_log['log']}
+                   for container_log in containers_logs if container_log.get('log')]
+    if not log_objects:
+        return True
     try:
-        for aws_ec2_instance in aws_ec2_instances_object:
-            mongo_query = {'instance_name': asdict(aws_ec2_instance)[INSTANCE_NAME.lower()]}
-            existing_data_object = aws_discovered_ec2_instances.find_one(mongo_query)
-            if not existing_data_object:
-                result = aws_discovered_ec2_instances.insert_one(asdict(aws_ec2_instance))
-                logger.info(result.acknowledged)
-                if result.inserted_id:
-                    logger.info(f'aws_ec2_instance was inserted properly')
-                else:
-                    logger.error(f'aws_ec2_instance was not inserted properly')
+        k8s_agent_logs.insert_many(log_objects, ordered=False)
+        logger.info(f'{len(log_objects)} containers logs of {cluster_name} were inserted properly')
         return True
-    except:
-        logger.error(f'aws_ec2_instance was not inserted properly')
+    except Exception as e:
+        logger.error(f'containers logs of {cluster_name} were not inserted properly with error: {e}')
+        return False
+
+
+def build_job_dedup_key(job_type: str, job_args: dict) -> str:
+    return hashlib.sha256(json.dumps([job_type, job_args], sort_keys=True, default=str).encode()).hexdigest()
+
+
+def build_job_view(job_object: dict) -> dict:
+    """
+    @return: The job as served by the jobs endpoints, identified by its job_id
+    """
+    job_object['job_id'] = str(job_object.pop('_id'))
+    job_object.pop('dedup_key', None)
+    job_object.pop('enqueue_token', None)
+    return job_object
+
+
+def enqueue_job(job_type: str, job_args: dict, priority: int = JOB_PRIORITY_USER, requested_by: str = '',
+                max_runtime: int = 0) -> tuple:
+    """
+    Queues a job unless an identical one (same type and arguments) is already pending, in which case that job is
+    returned and moved up to the given priority if it's a higher one
+    @param job_type: The type of the job, see the JOBS section of the variables
+    @param job_args: The keyword arguments of the job, never credentials as they are stored with the job
+    @param priority: JOB_PRIORITY_USER or JOB_PRIORITY_SCHEDULED, lower runs first
+    @param requested_by: The user the job runs for, or the scheduler
+    @param max_runtime: Seconds after which a running job is failed. Unbounded by default
+    @return: The queued job and whether it was an already pending one
+    """
+    enqueue_token = str(uuid.uuid4())
+    dedup_key = build_job_dedup_key(job_type, job_args)
+    # Two identical jobs queued at once can both try to insert, the pending dedup_key unique index lets one in
+    for _ in range(2):
+        try:
+            job_object = jobs.find_one_and_update(
+                {'dedup_key': dedup_key, 'status': JOB_PENDING},
+                {'$setOnInsert': {'job_type': job_type, 'job_args': job_args, 'requested_by': requested_by,
+                                  'created_at': int(time.time()), 'attempts': 0, 'stage': 'queued',
+                                  'max_runtime': max_runtime, 'enqueue_token': enqueue_token},
+                 '$min': {'priority': priority}},
+                upsert=True, return_document=ReturnDocument.AFTER)
+            break
+        except DuplicateKeyError:
+            continue
+    else:
+        job_object = jobs.find_one({'dedup_key': dedup_key, 'status': JOB_PENDING})
+    is_deduplicated = job_object['enqueue_token'] != enqueue_token
+    logger.info(f'The {job_type} job {job_object["_id"]} with {job_args} arguments is pending'
+                f'{" already" if is_deduplicated else ""} at the {job_object["priority"]} priority')
+    return build_job_view(job_object), is_deduplicated
+
+
+def claim_next_job(worker_id: str, max_priority: int = None, excluded_job_types: list = None) -> dict:
+    """
+    Atomically hands the most urgent pending job to the worker, the oldest first within a priority
+    @param worker_id: The claiming worker, which has to keep heartbeating the job until it's finished
+    @param max_priority: Only claim the jobs of this priority or a more urgent one. Any job by default
+    @param excluded_job_types: Job types the worker can't run at the moment
+    @return: The claimed job, empty if there is none pending
+    """
+    mongo_query = {'status': JOB_PENDING}
+    if max_priority is not None:
+        mongo_query['priority'] = {'$lte': max_priority}
+    if excluded_job_types:
+        mongo_query['job_type'] = {'$nin': excluded_job_types}
+    current_time = int(time.time())
+    job_object = jobs.find_one_and_update(
+        mongo_query,
+        {'$set': {'status': JOB_RUNNING, 'worker_id': worker_id, 'stage': 'claimed', 'started_at': current_time,
+                  'heartbeat_at': current_time},
+         '$inc': {'attempts': 1}},
+        sort=[('priority', ASCENDING), ('_id', ASCENDING)], return_document=ReturnDocument.AFTER)
+    if not job_object:
+        return {}
+    logger.info(f'The {job_object["job_type"]} job {job_object["_id"]} was claimed by {worker_id}')
+    return build_job_view(job_object)
+
+
+def update_job_stage(job_id: str, worker_id: str, stage: str) -> bool:
+    """
+    @return: False if the job is no longer run by the worker, e.g. it was requeued after missing its heartbeats
+    """
+    result = jobs.update_one({'_id': ObjectId(job_id), 'worker_id': worker_id, 'status': JOB_RUNNING},
+                             {'$set': {'stage': stage, 'heartbeat_at': int(time.time())}})
+    return result.matched_count == 1
+
+
+def heartbeat_jobs(worker_id: str, job_ids: list) -> int:
+    """
+    @param job_ids: The jobs the worker runs at the moment. A job it failed to finish is left to go stale
+    @return: The amount of jobs the worker still runs
+    """
+    if not job_ids:
+        return 0
+    result = jobs.update_many({'_id': {'$in': [ObjectId(job_id) for job_id in job_ids]}, 'worker_id': worker_id,
+                               'status': JOB_RUNNING},
+                              {'$set': {'heartbeat_at': int(time.time())}})
+    return result.matched_count
+
+
+def finish_job(job_id: str, worker_id: str, is_succeeded: bool, error: str = '') -> bool:
+    job_update = {'status': JOB_SUCCEEDED if is_succeeded else JOB_FAILED, 'stage': 'finished',
+                  'finished_at': int(time.time())}
+    if error:
+        job_update['error'] = error
+    result = jobs.update_one({'_id': ObjectId(job_id), 'worker_id': worker_id, 'status': JOB_RUNNING},
+                             {'$set': job_update})
+    if result.matched_count != 1:
+        logger.warning(f'The {job_id} job is no longer run by {worker_id}, its result is dropped')
+        return False
+    logger.info(f'The {job_id} job {job_update["status"]}')
+    return True
+
+
+def requeue_stale_jobs(stale_timeout: int, max_attempts: int) -> int:
+    """
+    Hands the running jobs whose worker stopped heartbeating for stale_timeout seconds back to the queue, or fails
+    them once they were attempted max_attempts times
+    @return: The amount of jobs that were requeued or failed
+    """
+    stale_query = {'status': JOB_RUNNING, 'heartbeat_at': {'$lt': int(time.time()) - stale_timeout}}
+    stale_jobs_count = 0
+    for job_object in jobs.find(stale_query, {'attempts': 1, 'worker_id': 1}):
+        job_query = {**stale_query, '_id': job_object['_id']}
+        error = f'The {job_object.get("worker_id")} worker stopped heartbeating'
+        job_update = {'status': JOB_FAILED, 'stage': 'finished', 'finished_at': int(time.time()), 'error': error}
+        if job_object.get('attempts', 0) < max_attempts:
+            job_update = {'status': JOB_PENDING, 'stage': 'requeued', 'error': error}
+        try:
+            result = jobs.update_one(job_query, {'$set': job_update, '$unset': {'worker_id': ''}})
+        except DuplicateKeyError:
+            # An identical job was queued since, which replaces this one
+            result = jobs.update_one(job_query, {'$set': {'status': JOB_FAILED, 'stage': 'finished',
+                                                          'finished_at': int(time.time()), 'error': error}})
+        if result.modified_count:
+            stale_jobs_count += 1
+            logger.warning(f'The {job_object["_id"]} job is {job_update["status"]} as {error}')
+    return stale_jobs_count
+
+
+def fail_overrun_jobs() -> int:
+    """
+    Fails the running jobs that exceeded their max_runtime. A job thread can't be stopped, so its result is dropped
+    once it ends
+    @return: The amount of failed jobs
+    """
+    current_time = int(time.time())
+    result = jobs.update_many(
+        {'status': JOB_RUNNING, 'max_runtime': {'$gt': 0},
+         '$expr': {'$lt': [{'$add': ['$started_at', '$max_runtime']}, current_time]}},
+        {'$set': {'status': JOB_FAILED, 'stage': 'finished', 'finished_at': current_time,
+                  'error': 'The job exceeded its max runtime'}})
+    if result.modified_count:
+        logger.warning(f'{result.modified_count} jobs exceeded their max runtime and were failed')
+    return result.modified_count
+
+
+def retrieve_job(job_id: str) -> dict:
+    try:
+        job_object = jobs.find_one({'_id': ObjectId(job_id)})
+    except (InvalidId, TypeError):
+        return {}
+    if not job_object:
+        return {}
+    return build_job_view(job_object)
+
+
+def retrieve_jobs_page(status: str = '', job_type: str = '', requested_by: str = '', limit: int = 0,
+                       cursor: str = '', fields: list = None) -> tuple:
+    """
+    @param status: Narrow the jobs down to a status
+    @param job_type: Narrow the jobs down to a job type
+    @param requested_by: Narrow the jobs down to the ones the user queued
+    @param limit: The page size, JOBS_PAGE_SIZE by default
+    @param cursor: The cursor returned with the previous page
+    @param fields: The fields to return. All the fields are returned by default
+    @return: A page of jobs, the newest first, and the cursor of the next page
+    """
+    mongo_query = {}
+    for field, value in (('status', status), ('job_type', job_type), ('requested_by', requested_by)):
+        if value:
+            mongo_query[field] = value
+    limit = limit or JOBS_PAGE_SIZE
+    listing_stages, sort_field = build_listing_stages(limit, cursor, '-_id', fields,
+                                                      excluded_fields=['dedup_key', 'enqueue_token'])
+    pipeline = [{'$match': mongo_query}, *listing_stages, {'$addFields': {'job_id': {'$toString': '$_id'}}}]
+    return page_listing(list(jobs.aggregate(pipeline)), limit, sort_field, fields)
+
+
+def claim_due_schedule(task_name: str, next_run_at: int) -> bool:
+    """
+    Atomically moves a due scheduled task to its next run, so a single scheduler out of all the running ones queues
+    every run. A task that was never scheduled is due
+    @param task_name: The scheduled task
+    @param next_run_at: The timestamp of the run after this one
+    @return: Whether the task was due and is now up to the caller to queue
+    """
+    current_time = int(time.time())
+    try:
+        result = schedules.update_one({'_id': task_name, 'next_run_at': {'$lte': current_time}},
+                                      {'$set': {'next_run_at': next_run_at, 'claimed_at': current_time}},
+                                      upsert=True)
+    except DuplicateKeyError:
+        # The task is scheduled and not due yet
+        return False
+    return bool(result.modified_count or result.upserted_id)
+
+
+def record_scheduled_job(task_name: str, job_id: str):
+    schedules.update_one({'_id': task_name}, {'$set': {'last_job_id': job_id}})
+
+
+def retrieve_schedules() -> list:
+    """
+    @return: Every scheduled task with its next run and the status of the job of its last run
+    """
+    schedule_objects = list(schedules.find().sort('_id', ASCENDING))
+    last_jobs_ids = [ObjectId(schedule_object['last_job_id']) for schedule_object in schedule_objects
+                     if schedule_object.get('last_job_id')]
+    last_jobs = {str(job_object['_id']): job_object for job_object in
+                 jobs.find({'_id': {'$in': last_jobs_ids}}, {'status': 1, 'stage': 1, 'started_at': 1,
+                                                             'finished_at': 1, 'error': 1})}
+    for schedule_object in schedule_objects:
+        schedule_object['task_name'] = schedule_object.pop('_id')
+        last_job = last_jobs.get(schedule_object.get('last_job_id'))
+        if last_job:
+            last_job.pop('_id')
+            schedule_object['last_job'] = last_job
+    return schedule_objects
+
+
+def build_lease_key(provider: str, task: str, account: str = '') -> str:
+    """
+    @param account: The account/project the task writes the data of. Empty for the tasks writing shared data
+    """
+    return ':'.join(str(key_part) for key_part in (provider, task, account) if key_part)
+
+
+class LeaseLostError(Exception):
+    pass
+
+
+class Lease:
+    """
+    A lease on a task, so a single worker out of all the processes and nodes runs it. The lease expires ttl seconds
+    after its last renewal, which a heartbeat thread does every third of the ttl while it's held.
+    Every acquisition gets a higher fencing token. A holder that lost its lease, e.g. after a long GC pause, is
+    flagged as lost by its heartbeats and finds out with is_held/fence before every write phase. The check is not
+    atomic with the writes that follow it, so it narrows the window of a stalled holder rather than closing it.
+    Expiry is checked against the clock of the Mongo server, not of the nodes
+    """
+
+    def __init__(self, lease_key: str, ttl: int = LEASE_TTL):
+        self.lease_key = lease_key
+        self.ttl = ttl
+        self.holder = f'{platform.node()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self.token = 0
+        self.renewed_at = 0.0
+        self.stop_event = Event()
+        self.lost_event = Event()
+
+    @property
+    def is_acquired(self) -> bool:
+        return bool(self.token)
+
+    def acquire(self) -> bool:
+        """
+        @return: Whether the lease was free, expired or already held by this holder, and is now held
+        """
+        try:
+            lease_object = leases.find_one_and_update(
+                {'_id': self.lease_key,
+                 '$or': [{'holder': self.holder}, {'$expr': {'$lte': ['$expires_at', '$$NOW']}}]},
+                [{'$set': {'holder': self.holder, 'token': {'$add': [{'$ifNull': ['$token', 0]}, 1]},
+                           'acquired_at': '$$NOW', 'expires_at': {'$add': ['$$NOW', self.ttl * 1000]}}}],
+                upsert=True, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # Held by another holder and not expired
+            return False
+        self.token = lease_object['token']
+        self.renewed_at = time.monotonic()
+        logger.info(f'The {self.lease_key} lease was acquired by {self.holder} with the {self.token} token')
+        return True
+
+    def renew(self) -> bool:
+        """
+        @return: False once the lease was taken over
+        """
+        result = leases.update_one({'_id': self.lease_key, 'holder': self.holder, 'token': self.token},
+                                   [{'$set': {'expires_at': {'$add': ['$$NOW', self.ttl * 1000]}}}])
+        if result.matched_count:
+            self.renewed_at = time.monotonic()
+        else:
+            self.lost_event.set()
+        return bool(result.matched_count)
+
+    def release(self):
+        # Expired rather than removed, so the next holder takes it over right away with a higher token
+        leases.update_one({'_id': self.lease_key, 'holder': self.holder, 'token': self.token},
+                          [{'$set': {'expires_at': '$$NOW'}}])
+        logger.info(f'The {self.lease_key} lease was released by {self.holder}')
+
+    def is_held(self) -> bool:
+        """
+        The fencing check to run before writing the results of the task
+        """
+        if not self.token or self.lost_event.is_set():
+            return False
+        is_held = time.monotonic() - self.renewed_at <= self.ttl and bool(leases.count_documents(
+            {'_id': self.lease_key, 'holder': self.holder, 'token': self.token,
+             '$expr': {'$gt': ['$expires_at', '$$NOW']}}, limit=1))
+        if not is_held:
+            self.lost_event.set()
+            logger.warning(f'The {self.lease_key} lease of {self.holder} was lost, dropping its writes')
+        return is_held
+
+    def fence(self):
+        """
+        Aborts the task once its lease was lost, to be called between its write phases
+        """
+        if not self.is_held():
+            raise LeaseLostError(f'The {self.lease_key} lease with the {self.token} token was lost')
+
+    def run_heartbeats(self):
+        while not self.stop_event.wait(self.ttl / 3):
+            try:
+                if not self.renew():
+                    logger.warning(f'The {self.lease_key} lease of {self.holder} was taken over')
+                    return
+            except Exception as e:
+                logger.error(f'Failed to renew the {self.lease_key} lease with error: {e}')
+                if time.monotonic() - self.renewed_at > self.ttl:
+                    # Expired by now, another worker may take it over
+                    self.lost_event.set()
+                    return
+
+    def __enter__(self):
+        if self.acquire():
+            Thread(target=self.run_heartbeats, name=f'{self.lease_key}-lease', daemon=True).start()
+        else:
+            logger.info(f'The {self.lease_key} lease is held by another worker')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop_event.set()
+        if self.token:
+            try:
+                self.release()
+            except Exception as e:
+                logger.error(f'Failed to release the {self.lease_key} lease with error: {e}')
+
+
+def bulk_upsert_instances(collection: Collection, instances_object: list, key_fields: list, scope: dict,
+                          discovery_run_id: str = '', is_marking_stale: bool = True) -> bool:
+    """
+    @param collection: The discovered instances collection to write to
+    @param instances_object: The discovered instances, as dataclasses or plain dicts
+    @param key_fields: The fields that identify an instance in the collection
+    @param scope: The query of the account/project the run discovered, the stale instances are only looked for in it
+    @param discovery_run_id: The id of the discovery run. Instances not seen by this run are marked unavailable
+    @param is_marking_stale: Whether the instances of the scope that the run didn't find are marked unavailable
+    """
+    if not scope:
+        raise ValueError(f'A discovery of {collection.name} has to be scoped to the account/project it discovered')
+    if not discovery_run_id:
+        discovery_run_id = uuid.uuid4().hex
+    requests = []
+    for instance in instances_object:
+        instance_object = asdict(instance) if is_dataclass(instance) else dict(instance)
+        mongo_query = {key_field: instance_object[key_field] for key_field in key_fields}
+        # user_name and client_name are assigned through the UI, so only a newly found instance gets the defaults
+        set_on_insert = {USER_NAME.lower(): instance_object.pop(USER_NAME.lower(), 'vacant'),
+                         CLIENT_NAME.lower(): instance_object.pop(CLIENT_NAME.lower(), 'vacant')}
+        instance_object[AVAILABILITY] = True
+        instance_object['discovery_run_id'] = discovery_run_id
+        requests.append(UpdateOne(mongo_query, {'$set': instance_object, '$setOnInsert': set_on_insert},
+                                  upsert=True))
+    for index in range(0, len(requests), BULK_WRITE_BATCH_SIZE):
+        result = collection.bulk_write(requests[index:index + BULK_WRITE_BATCH_SIZE], ordered=False)
+        logger.info(f'{collection.name}: {result.upserted_count} instances were inserted and '
+                    f'{result.modified_count} were updated')
+    if not is_marking_stale:
+        return True
+    stale_query = {**scope, AVAILABILITY: True, 'discovery_run_id': {'$ne': discovery_run_id}}
+    result = collection.update_many(stale_query, {'$set': {AVAILABILITY: False}})
+    logger.info(f'{collection.name}: {result.modified_count} stale instances were marked unavailable')
+    return True
+
+
+def insert_aws_instances_object(aws_ec2_instances_object: list, account_id: int, regions: list = None,
+                                discovery_run_id: str = '', is_marking_stale: bool = True) -> bool:
+    """
+    @param aws_ec2_instances_object: All the aws ec2 instances found by a discovery run
+    @param account_id: The account the run discovered
+    @param regions: The regions the run discovered. The instances of the other regions are never marked stale
+    @param discovery_run_id: The id of the discovery run
+    @param is_marking_stale: Whether the instances the run didn't find are marked unavailable
+    """
+    scope = {ACCOUNT_ID.lower(): account_id}
+    if regions is not None:
+        scope['instance_zone'] = {'$in': regions}
+    try:
+        return bulk_upsert_instances(aws_discovered_ec2_instances, aws_ec2_instances_object,
+                                     key_fields=['instance_id'], scope=scope, discovery_run_id=discovery_run_id,
+                                     is_marking_stale=is_marking_stale)
+    except Exception as e:
+        logger.error(f'aws_ec2_instances were not inserted properly with error: {e}')
+        return False
 
 
 def insert_aws_files_object(aws_files_object: dict) -> bool:
@@ -1040,32 +1866,17 @@ def insert_eks_cluster_object(eks_cluster_object: dict) -> bool:
     """
     logger.info(f'{eks_cluster_object}')
     try:
-        mongo_query = {CLUSTER_NAME.lower(): eks_cluster_object[CLUSTER_NAME.lower()]}
-        existing_data_object = aws_discovered_eks_clusters.find_one(mongo_query)
-        if existing_data_object:
-            result = aws_discovered_eks_clusters.replace_one(existing_data_object, eks_cluster_object)
-            logger.info(f'aws_discovered_eks_clusters was updated properly')
-            return result.raw_result['updatedExisting']
-        else:
-            result = aws_discovered_eks_clusters.insert_one(eks_cluster_object)
-            logger.info(result.acknowledged)
-            if result.inserted_id:
-                logger.info(f'aws_discovered_eks_clusters was inserted properly')
-                return True
-            else:
-                logger.error(f'aws_discovered_eks_clusters was not inserted properly')
-                return False
+        mongo_query = build_cluster_query(EKS, eks_cluster_object[CLUSTER_NAME.lower()], discovered=True)
+        eks_cluster_object.update(mongo_query)
+        result = clusters.replace_one(mongo_query, eks_cluster_object, upsert=True)
+        logger.info(f'discovered eks cluster was upserted properly')
+        return result.acknowledged
     except:
-        logger.error(f'aws_discovered_eks_clusters was not inserted properly')
+        logger.error(f'discovered eks cluster was not inserted properly')
 
 
 def drop_discovered_clusters(cluster_type: str = '') -> bool:
-    if cluster_type == GKE:
-        gcp_discovered_gke_clusters.drop()
-    elif cluster_type == EKS:
-        aws_discovered_eks_clusters.drop()
-    elif cluster_type == AKS:
-        az_discovered_aks_clusters.drop()
+    clusters.delete_many({CLUSTER_TYPE: cluster_type, DISCOVERED: True})
     return True
 
 
@@ -1075,23 +1886,13 @@ def insert_discovered_gke_cluster_object(gke_cluster_object: dict) -> bool:
     """
     logger.info(f'{gke_cluster_object}')
     try:
-        mongo_query = {CLUSTER_NAME.lower(): gke_cluster_object[CLUSTER_NAME.lower()]}
-        existing_data_object = gcp_discovered_gke_clusters.find_one(mongo_query)
-        if existing_data_object:
-            result = gcp_discovered_gke_clusters.replace_one(existing_data_object, gke_cluster_object)
-            logger.info(f'aws_discovered_eks_clusters was updated properly')
-            return result.raw_result['updatedExisting']
-        else:
-            result = gcp_discovered_gke_clusters.insert_one(gke_cluster_object)
-            logger.info(result.acknowledged)
-            if result.inserted_id:
-                logger.info(f'gcp_discovered_gke_clusters was inserted properly')
-                return True
-            else:
-                logger.error(f'gcp_discovered_gke_clusters was not inserted properly')
-                return False
+        mongo_query = build_cluster_query(GKE, gke_cluster_object[CLUSTER_NAME.lower()], discovered=True)
+        gke_cluster_object.update(mongo_query)
+        result = clusters.replace_one(mongo_query, gke_cluster_object, upsert=True)
+        logger.info(f'discovered gke cluster was upserted properly')
+        return result.acknowledged
     except:
-        logger.error(f'gcp_discovered_gke_clusters was not inserted properly')
+        logger.error(f'discovered gke cluster was not inserted properly')
 
 
 def update_discovered_gke_cluster_object(gke_cluster_object: dict) -> bool:
@@ -1100,59 +1901,54 @@ def update_discovered_gke_cluster_object(gke_cluster_object: dict) -> bool:
     """
     logger.info(f'{gke_cluster_object}')
     try:
-        mongo_query = {CLUSTER_NAME.lower(): gke_cluster_object[CLUSTER_NAME.lower()]}
-        existing_data_object = gke_clusters.find_one(mongo_query)
+        mongo_query = build_cluster_query(GKE, gke_cluster_object[CLUSTER_NAME.lower()])
+        existing_data_object = clusters.find_one(mongo_query)
         gke_cluster_object['user_name'] = existing_data_object['user_name']
         gke_cluster_object['expiration_timestamp'] = existing_data_object['expiration_timestamp']
         gke_cluster_object['human_expiration_timestamp'] = existing_data_object['human_expiration_timestamp']
         gke_cluster_object['kubeconfig'] = existing_data_object['kubeconfig']
-        if existing_data_object:
-            result = gke_clusters.replace_one(existing_data_object, gke_cluster_object)
-            logger.info(f'aws_discovered_eks_clusters was updated properly')
-            return result.raw_result['updatedExisting']
-        else:
-            result = gke_clusters.insert_one(gke_cluster_object)
-            logger.info(result.acknowledged)
-            if result.inserted_id:
-                logger.info(f'gcp_discovered_gke_clusters was inserted properly')
-                return True
-            else:
-                logger.error(f'gcp_discovered_gke_clusters was not inserted properly')
-                return False
+        gke_cluster_object.update(mongo_query)
+        result = clusters.replace_one(mongo_query, gke_cluster_object)
+        logger.info(f'gke cluster was updated properly')
+        return result.raw_result['updatedExisting']
     except:
-        logger.error(f'gcp_discovered_gke_clusters was not inserted properly')
+        logger.error(f'gke cluster was not updated properly')
 
 
-def insert_gcp_vm_instances_object(gcp_vm_instances_object: list) -> bool:
+def insert_gcp_vm_instances_object(gcp_vm_instances_object: list, project_name: str,
+                                   discovery_run_id: str = '') -> bool:
     """
-    @param gcp_vm_instances_object: The gcp vm instances object to save
+    @param gcp_vm_instances_object: All the gcp vm instances found by a discovery run
+    @param project_name: The project the run discovered
+    @param discovery_run_id: The id of the discovery run
     """
     try:
-        if len(gcp_vm_instances_object) == 0:
-            gcp_already_discovered_vm_instances_object = gcp_discovered_vm_instances.find()
-            for gcp_discovered_vm_instance in gcp_already_discovered_vm_instances_object:
-                myquery = {INSTANCE_NAME.lower(): gcp_discovered_vm_instance['instance_name']}
-                newvalues = {"$set": {AVAILABILITY.lower(): False}}
-                gcp_discovered_vm_instances.update_one(myquery, newvalues)
-            return True
-        else:
-            for gcp_vm_instance in gcp_vm_instances_object:
-                mongo_query = {'instance_name': asdict(gcp_vm_instance)[INSTANCE_NAME.lower()]}
-                gcp_discovered_vm_instances_object = gcp_discovered_vm_instances.find_one(mongo_query)
-                if not gcp_discovered_vm_instances_object:
-                    result = gcp_discovered_vm_instances.insert_one(asdict(gcp_vm_instance))
-                    logger.info(result.acknowledged)
-                    if result.inserted_id:
-                        logger.info(f'gcp_vm_instances_object was inserted properly')
-                    else:
-                        logger.error(f'gcp_vm_instances_object was not inserted properly')
-                else:
-                    myquery = {INSTANCE_NAME.lower(): gcp_discovered_vm_instances_object['instance_name']}
-                    newvalues = {"$set": {AVAILABILITY.lower(): True}}
-                    gcp_discovered_vm_instances.update_one(myquery, newvalues)
-            return True
-    except:
-        logger.error(f'gcp_vm_instances_object was not inserted properly')
+        return bulk_upsert_instances(gcp_discovered_vm_instances, gcp_vm_instances_object,
+                                     key_fields=[INSTANCE_NAME.lower()], scope={'project_name': project_name},
+                                     discovery_run_id=discovery_run_id)
+    except Exception as e:
+        logger.error(f'gcp_vm_instances were not inserted properly with error: {e}')
+        return False
+
+
+def build_agent_ec2_instances(ec2_object: dict) -> list:
+    """
+    @param ec2_object: The ec2Object of an AWS agent report, its instances keyed by their name
+    @return: The reported instances in the shape of the discovered ones
+    """
+    instances_object = []
+    for reported_instance in ec2_object.get('ec2_instances') or []:
+        for instance_name, instance_data in reported_instance.items():
+            instances_object.append({
+                'timestamp': ec2_object.get('timestamp'),
+                ACCOUNT_ID.lower(): ec2_object.get(ACCOUNT_ID.lower()),
+                INSTANCE_NAME.lower(): instance_name,
+                'instance_id': instance_data['instance_id'],
+                'machine_type': instance_data.get('instance_type', ''),
+                'instance_zone': instance_data.get('aws_region', ''),
+                'tags': {tag['Key'].lower(): tag['Value'].lower() for tag in instance_data.get('instance_tags') or []}
+            })
+    return instances_object
 
 
 def insert_aws_agent_data_object(agent_data_object: dict) -> bool:
@@ -1160,7 +1956,10 @@ def insert_aws_agent_data_object(agent_data_object: dict) -> bool:
     @param agent_data_object: The filename of the image to save
     """
     if agent_data_object['ec2Object']:
-        insert_aws_instances_object(agent_data_object['ec2Object'])
+        # An agent report doesn't tell which instances are gone, so none is marked unavailable
+        insert_aws_instances_object(build_agent_ec2_instances(agent_data_object['ec2Object']),
+                                    account_id=agent_data_object['ec2Object'].get(ACCOUNT_ID.lower()),
+                                    is_marking_stale=False)
     if agent_data_object['s3FilesObject']:
         insert_aws_files_object(agent_data_object['s3FilesObject'])
     if agent_data_object['s3BucketsObject']:
@@ -1294,27 +2093,12 @@ def add_data_to_cluster(object_type: str, cluster_type: str = '', cluster_name:
     @return:
     """
 
-    myquery = {CLUSTER_NAME.lower(): cluster_name}
+    myquery = build_cluster_query(cluster_type, cluster_name, discovered)
     if assigned_object == USER:
         newvalues = {"$set": {USER_NAME.lower(): user_name}}
     elif assigned_object == CLIENT:
         newvalues = {"$set": {CLIENT_NAME.lower(): client_name}}
-    if cluster_type == GKE:
-        if discovered:
-            result = gcp_discovered_gke_clusters.update_one(myquery, newvalues)
-        else:
-            result = gke_clusters.update_one(myquery, newvalues)
-    elif cluster_type == GKE_AUTOPILOT:
-        result = gke_autopilot_clusters.update_one(myquery, newvalues)
-    elif cluster_type == EKS:
-        if discovered:
-            result = aws_discovered_eks_clusters.update_one(myquery, newvalues)
-        else:
-            result = eks_clusters.update_one(myquery, newvalues)
-    elif cluster_type == AKS:
-        result = aks_clusters.update_one(myquery, newvalues)
-    else:
-        result = gke_clusters.update_one(myquery, newvalues)
+    result = clusters.update_one(myquery, newvalues)
     return result.raw_result['updatedExisting']
 
 
@@ -37,15 +37,17 @@ logging.basicConfig(
 logger.info(f'App runs in the DOCKER_ENV: {DOCKER_ENV}')
 
 if DOCKER_ENV:
-    from mongo_handler.mongo_utils import insert_cache_object
+    from mongo_handler.mongo_utils import insert_cache_object, insert_cache_objects, Lease, build_lease_key
+    from cache_index_builder import build_machine_types_indexes
     from mongo_handler.mongo_objects import AWSCacheObject, AWSMachineTypeObject, AWSMachinesCacheObject, \
         AWSRegionsAndMachineSeriesObject, AWSSeriesAndMachineTypesObject
-    from variables.variables import EKS
+    from variables.variables import EKS, AWS
 else:
-    from web.mongo_handler.mongo_utils import insert_cache_object
+    from web.mongo_handler.mongo_utils import insert_cache_object, insert_cache_objects, Lease, build_lease_key
+    from web.scripts.cache_index_builder import build_machine_types_indexes
     from web.mongo_handler.mongo_objects import AWSCacheObject, AWSMachineTypeObject, AWSMachinesCacheObject, \
         AWSRegionsAndMachineSeriesObject, AWSSeriesAndMachineTypesObject
-    from web.variables.variables import EKS
+    from web.variables.variables import EKS, AWS
 
 LOCAL_USER = gt.getuser()
 
@@ -113,41 +115,39 @@ def fetch_subnets(zones_list: list, ec2) -> dict:
     return subnets_dict
 
 
-def fetch_machine_types_per_region(region: str, ec2) -> list:
-    logger.info(f'A request to fetch machine_types per region has arrived')
+def fetch_machine_types_per_region(region: str, ec2_region) -> tuple:
+    """
+    @param region: The region to fetch the machine types of
+    @param ec2_region: An ec2 client of that region. describe_instance_types only returns the types offered in the
+    region of the client, so a single paginated sweep replaces a call per offered machine type
+    @return: The region and its list of AWSMachineTypeObject
+    """
+    logger.info(f'A request to fetch machine_types of {region} region has arrived')
     machine_types_list = []
-    machine_types_list_ = []
-    machine_types_response = ec2.describe_instance_type_offerings(
-        LocationType='availability-zone'
-    )
-    for instance_response in machine_types_response['InstanceTypeOfferings']:
-        machine_types_list_.append(instance_response['InstanceType'])
-    for machine in machine_types_list_:
-        logger.info(
-            f'Adding a machine number: {len(machine_types_list)} out of {len(machine_types_list_)} in {region} region')
-        try:
-            machine_type_response = ec2.describe_instance_types(
-                InstanceTypes=[
-                    machine
-                ]
-            )
-        except:
-            pass
-        machine_type_object = AWSMachineTypeObject(region=region,
-                                                   machine_type=machine,
-                                                   machine_series=machine.split('.')[0],
-                                                   vCPU=machine_type_response['InstanceTypes'][0]['VCpuInfo'][
-                                                       'DefaultVCpus'],
-                                                   memory=machine_type_response['InstanceTypes'][0]['MemoryInfo'][
-                                                       'SizeInMiB'])
-        machine_types_list.append(machine_type_object)
-    return machine_types_list
-
-
-def main(aws_access_key_id, aws_secret_access_key):
+    paginator = ec2_region.get_paginator('describe_instance_types')
+    for page in paginator.paginate():
+        for instance_type in page['InstanceTypes']:
+            machine = instance_type['InstanceType']
+            machine_type_object = AWSMachineTypeObject(region=region,
+                                                       machine_type=machine,
+                                                       machine_series=machine.split('.')[0],
+                                                       vCPU=instance_type['VCpuInfo']['DefaultVCpus'],
+                                                       memory=instance_type['MemoryInfo']['SizeInMiB'])
+            machine_types_list.append(machine_type_object)
+    logger.info(f'Fetched {len(machine_types_list)} machine types in {region} region')
+    return region, machine_types_list
+
+
+def run_caching(aws_access_key_id, aws_secret_access_key, lease: Lease):
+    """
+    @param aws_access_key_id: The access key id, the one of the environment when empty
+    @param aws_secret_access_key: The secret access key, the one of the environment when empty
+    @param lease: The caching lease, fenced before every insert so a run that lost it stops writing
+    """
     start_time = time.monotonic()
-    logger.info(f'aws_access_key_id is: {aws_access_key_id}')
-    logger.info(f'aws_secret_access_key is: {aws_secret_access_key}')
+    # The scheduled runs never carry credentials, they use the ones of the environment
+    aws_access_key_id = aws_access_key_id or os.getenv('AWS_ACCESS_KEY_ID')
+    aws_secret_access_key = aws_secret_access_key or os.getenv('AWS_SECRET_ACCESS_KEY')
     if aws_access_key_id and aws_secret_access_key:
         if not os.path.exists(FETCHED_CREDENTIALS_DIR_PATH):
             os.makedirs(FETCHED_CREDENTIALS_DIR_PATH)
@@ -168,7 +168,7 @@ def main(aws_access_key_id, aws_secret_access_key):
             logger.error(f'Trouble connecting to AWS: {e}')
     else:
         logger.error('AWS Credentials were not passed correctly')
-        sys.exit(0)
+        sys.exit('AWS Credentials were not passed correctly')
 
     # add kubernetes versions
     try:
@@ -177,22 +177,27 @@ def main(aws_access_key_id, aws_secret_access_key):
         machines_for_zone_dict = {}
         # regions_list = ['us-east-1', 'us-east-2']
         regions_list = fetch_regions(ec2)
+        # boto3 clients are thread safe once created, but creating them is not
+        regional_clients = {region: boto3.client('ec2', region_name=region, aws_access_key_id=aws_access_key_id,
+                                                 aws_secret_access_key=aws_secret_access_key)
+                            for region in regions_list}
         with concurrent.futures.ThreadPoolExecutor() as executor:
             # Submit the tasks to the executor
-            future_results = [executor.submit(fetch_machine_types_per_region, region, ec2) for region in regions_list]
+            future_results = [executor.submit(fetch_machine_types_per_region, region, regional_clients[region])
+                              for region in regions_list]
             for future in concurrent.futures.as_completed(future_results):
                 try:
-                    result = future.result()
-                    machines_for_zone_dict[result[0].region] = result
+                    region, machine_types_list = future.result()
+                    machines_for_zone_dict[region] = machine_types_list
                 except Exception as e:
                     logger.error(f"An error occurred: {e}")
 
-        for region in machines_for_zone_dict:
-            aws_machines_caching_object = AWSMachinesCacheObject(
-                region=region,
-                machines_list=machines_for_zone_dict[region]
-            )
-            insert_cache_object(caching_object=asdict(aws_machines_caching_object), provider=EKS, machine_types=True)
+        aws_machines_caching_objects = [asdict(AWSMachinesCacheObject(
+            region=region,
+            machines_list=machines_for_zone_dict[region]
+        )) for region in machines_for_zone_dict]
+        lease.fence()
+        insert_cache_objects(caching_objects=aws_machines_caching_objects, provider=EKS, machine_types=True)
 
         # Fetching Zones
         logger.info('Attempt to fetch zones_list')
@@ -215,51 +220,42 @@ def main(aws_access_key_id, aws_secret_access_key):
             regions_zones_dict=regions_zones_dict
         )
         logger.info('Attempting to insert an EKS cache_object')
+        lease.fence()
         insert_cache_object(caching_object=asdict(aws_caching_object), provider=EKS)
 
+        regions_and_series_dict, series_and_machine_types_dict, _ = build_machine_types_indexes(machines_for_zone_dict)
+
         # Inserting AWS Regions and Machine Series Object
-        series_list = []
-        for region in machines_for_zone_dict:
-            for machine_type in machines_for_zone_dict[region]:
-                if not machine_type.machine_series in series_list:
-                    series_list.append(machine_type.machine_series)
-
-            aws_regions_and_machine_series_object = AWSRegionsAndMachineSeriesObject(
-                region=region,
-                series_list=series_list
-            )
-            insert_cache_object(caching_object=asdict(aws_regions_and_machine_series_object), provider=EKS,
-                                aws_regions_and_series=True)
+        aws_regions_and_machine_series_objects = [asdict(AWSRegionsAndMachineSeriesObject(
+            region=region,
+            series_list=regions_and_series_dict[region]
+        )) for region in regions_and_series_dict]
+        lease.fence()
+        insert_cache_objects(caching_objects=aws_regions_and_machine_series_objects, provider=EKS,
+                             aws_regions_and_series=True)
 
         # Inserting a AWS Machine Series and Machine Types Object
-        machines_series_list = []
-        for region in machines_for_zone_dict:
-            for machine_type in machines_for_zone_dict[region]:
-                if machine_type.machine_series not in machines_series_list:
-                    machines_series_list.append(machine_type.machine_series)
-
-        series_and_machine_types_dict = {}
-        for region in machines_for_zone_dict:
-            for machine_series in machines_series_list:
-                for machine_type in machines_for_zone_dict[region]:
-                    if machine_series not in series_and_machine_types_dict.keys():
-                        if machine_type.machine_series == machine_series:
-                            series_and_machine_types_dict[machine_series] = [machine_type.machine_type]
-                    else:
-                        if machine_type.machine_series == machine_series:
-                            if machine_type.machine_type not in series_and_machine_types_dict[machine_series]:
-                                series_and_machine_types_dict[machine_series].append(machine_type.machine_type)
-        for machine_series in series_and_machine_types_dict:
-            aws_series_and_machine_types_object = AWSSeriesAndMachineTypesObject(
-                machine_series=machine_series,
-                machines_list=series_and_machine_types_dict[machine_series]
-            )
-            insert_cache_object(caching_object=asdict(aws_series_and_machine_types_object), provider=EKS,
-                                aws_series_and_machine_types=True)
+        aws_series_and_machine_types_objects = [asdict(AWSSeriesAndMachineTypesObject(
+            machine_series=machine_series,
+            machines_list=series_and_machine_types_dict[machine_series]
+        )) for machine_series in series_and_machine_types_dict]
+        lease.fence()
+        insert_cache_objects(caching_objects=aws_series_and_machine_types_objects, provider=EKS,
+                             aws_series_and_machine_types=True)
         end_time = time.monotonic()
         logger.info(timedelta(seconds=end_time - start_time))
     except Exception as e:
         logger.error(f'Trouble connecting to AWS {e}')
+        raise
+
+
+def main(aws_access_key_id, aws_secret_access_key):
+    # The caches are shared by all the accounts, so a single caching runs at a time
+    with Lease(build_lease_key(AWS, 'caching')) as lease:
+        if not lease.is_acquired:
+            logger.info('Another worker runs the AWS caching, skipping it')
+            return
+        run_caching(aws_access_key_id, aws_secret_access_key, lease)
 
 
 if __name__ == '__main__':
@@ -1,12 +1,12 @@
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import concurrent.futures
 import datetime
-import getpass as gt
+import functools
 import logging
 import os
-import platform
 import sys
 from dataclasses import asdict
-from subprocess import run, PIPE
+from threading import Lock
 import time
 
 import boto3
@@ -18,14 +18,18 @@ if DOCKER_ENV:
     from mongo_handler.mongo_objects import AWSS3FilesObject, AWSS3BucketsObject, \
         AWSEC2InstanceDataObject
     from mongo_handler.mongo_utils import insert_aws_instances_object, insert_aws_files_object, \
-        insert_aws_buckets_object, insert_eks_cluster_object, retrieve_instances, retrieve_available_clusters, \
-        retrieve_compute_per_machine_type
+        insert_aws_buckets_object, insert_eks_cluster_object, \
+        retrieve_machine_types_index, Lease, build_lease_key
+    from variables.variables import EKS, AWS
+    from kubeconfig_handler.kubeconfig_utils import build_eks_kubeconfig
 else:
     from web.mongo_handler.mongo_objects import AWSS3FilesObject, AWSS3BucketsObject, \
         AWSEC2InstanceDataObject
     from web.mongo_handler.mongo_utils import insert_aws_instances_object, insert_aws_files_object, \
-        insert_aws_buckets_object, insert_eks_cluster_object, retrieve_instances, retrieve_available_clusters, \
-        retrieve_compute_per_machine_type
+        insert_aws_buckets_object, insert_eks_cluster_object, \
+        retrieve_machine_types_index, Lease, build_lease_key
+    from web.variables.variables import EKS, AWS
+    from web.kubeconfig_handler.kubeconfig_utils import build_eks_kubeconfig
 
 log_file_name = 'server.log'
 if DOCKER_ENV:
@@ -50,34 +54,74 @@ load_dotenv(os.path.join(project_folder, '.env'))
 
 FETCH_INTERVAL = int(os.environ.get('FETCH_INTERVAL', "30"))
 DEFAULT_AWS_REGION = os.environ.get('DEFAULT_AWS_REGION', "us-east-1")
-try:
-    EC2_CLIENT = boto3.client('ec2', region_name=DEFAULT_AWS_REGION)
-    S3_CLIENT = boto3.client('s3')
-    EKS_CLIENT = boto3.client('eks', region_name=DEFAULT_AWS_REGION)
-    ACCOUNT_ID = int(boto3.client('sts').get_caller_identity().get('Account'))
-except Exception as e:
-    logger.error(f'AWS was not installed on this machine')
+DISCOVERY_WORKERS = int(os.environ.get('DISCOVERY_WORKERS', "8"))
 
 TS = int(time.time())
 TS_IN_20_YEARS = TS + 60 * 60 * 24 * 365 * 20
-LOCAL_USER = gt.getuser()
-if 'Darwin' in platform.system():
-    KUBECONFIG_PATH = f'/Users/{LOCAL_USER}/.kube/config'  # path to the GCP credentials
-else:
-    KUBECONFIG_PATH = '/root/.kube/config'
-
 
-def generate_kubeconfig(cluster_name: str, cluster_region: str) -> str:
-    kubeconfig_generate_command = f'aws eks --region {cluster_region} update-kubeconfig --name {cluster_name}'
-    run(kubeconfig_generate_command, stdout=PIPE, stderr=PIPE, text=True, shell=True)
-    with open(KUBECONFIG_PATH, "r") as f:
-        kubeconfig = f.read()
-        logging.info(f'The kubeconfig content is: {kubeconfig}')
-        return kubeconfig
+# boto3 clients per (service, region), created once per process and shared by the discovery threads
+REGIONAL_CLIENTS = {}
+REGIONAL_CLIENTS_LOCK = Lock()
+
+
+def fetch_regional_client(service_name: str, region_name: str):
+    """
+    @param service_name: The boto3 service name. Ex: ec2/eks
+    @param region_name: The AWS region of the client
+    @return: A cached boto3 client. Creating the client is locked since boto3 sessions are not thread safe
+    """
+    with REGIONAL_CLIENTS_LOCK:
+        if (service_name, region_name) not in REGIONAL_CLIENTS:
+            REGIONAL_CLIENTS[(service_name, region_name)] = boto3.client(service_name, region_name=region_name)
+        return REGIONAL_CLIENTS[(service_name, region_name)]
+
+
+@functools.lru_cache(maxsize=None)
+def fetch_account_id() -> int:
+    """
+    @return: The account of the configured AWS credentials, looked up on first use instead of on import
+    """
+    return int(fetch_regional_client('sts', DEFAULT_AWS_REGION).get_caller_identity().get('Account'))
+
+
+def timed_region_call(region_function, aws_region: str, region_kwargs: dict) -> tuple:
+    start_time = time.monotonic()
+    result = region_function(aws_region, **region_kwargs)
+    return result, time.monotonic() - start_time
+
+
+def fan_out_regions(region_function, aws_regions: list, workers: int = DISCOVERY_WORKERS,
+                    region_kwargs: dict = None) -> tuple:
+    """
+    @param region_function: A function that takes a region name and returns a list of discovered objects
+    @param aws_regions: The regions to run the function in. Duplicated regions are queried once
+    @param workers: The max amount of regions that are queried concurrently
+    @param region_kwargs: Extra keyword arguments passed to every region_function call
+    @return: The concatenated results of the regions that succeeded, and the regions that failed
+    """
+    results = []
+    failed_regions = []
+    region_timings = {}
+    region_kwargs = region_kwargs or {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        future_results = {executor.submit(timed_region_call, region_function, aws_region, region_kwargs): aws_region
+                          for aws_region in dict.fromkeys(aws_regions)}
+        for future in concurrent.futures.as_completed(future_results):
+            aws_region = future_results[future]
+            try:
+                region_results, region_timings[aws_region] = future.result()
+                results.extend(region_results)
+            except Exception as e:
+                logger.error(f'{region_function.__name__} failed in {aws_region} region: {e}')
+                failed_regions.append(aws_region)
+    logger.info(f'{region_function.__name__} per region timings: ')
+    for aws_region, elapsed in sorted(region_timings.items(), key=lambda item: item[1], reverse=True):
+        logger.info(f'{aws_region}: {elapsed:.2f}s')
+    return results, failed_regions
 
 
 def fetch_regions() -> list:
-    response = EC2_CLIENT.describe_regions()
+    response = fetch_regional_client('ec2', DEFAULT_AWS_REGION).describe_regions()
     regions_list = []
     for region_response in response['Regions']:
         regions_list.append(region_response['RegionName'])
@@ -86,11 +130,11 @@ def fetch_regions() -> list:
 
 
 def fetch_buckets() -> AWSS3BucketsObject:
-    response = S3_CLIENT.list_buckets()
+    response = fetch_regional_client('s3', None).list_buckets()
     buckets_list = []
     for bucket in response['Buckets']:
         buckets_list.append(bucket["Name"])
-    return AWSS3BucketsObject(timestamp=TS, account_id=ACCOUNT_ID,
+    return AWSS3BucketsObject(timestamp=TS, account_id=fetch_account_id(),
                               buckets=buckets_list)
 
 
@@ -100,154 +144,158 @@ def fetch_files(aws_buckets: AWSS3BucketsObject) -> AWSS3FilesObject:
     for aws_bucket in aws_buckets.buckets:
         aws_buckets_list.append(aws_bucket)
     files_list = []
+    s3_client = fetch_regional_client('s3', None)
     for bucket in aws_buckets_list:
-        for file in S3_CLIENT.list_objects(Bucket=bucket)['Contents']:
+        for file in s3_client.list_objects(Bucket=bucket)['Contents']:
             file_object = {
                 file['Key']: {'size': file['Size'], 'owner': file['Owner']['DisplayName'],
                               'last_modified': int(file['LastModified'].timestamp())}}
             files_list.append(file_object)
         aws_files_dict[bucket] = files_list
         files_list = []
-    return AWSS3FilesObject(timestamp=TS, account_id=ACCOUNT_ID,
+    return AWSS3FilesObject(timestamp=TS, account_id=fetch_account_id(),
                             files=aws_files_dict)
 
 
-def list_all_instances():
+def fetch_region_instances(aws_region: str) -> list:
     instances_object = []
-    aws_regions = fetch_regions()
-    for aws_region in aws_regions:
-        ecs_resource = boto3.resource('ec2', region_name=aws_region)
-        if len(list(ecs_resource.instances.all())) > 0:
-            for instance in ecs_resource.instances.all():
-                if instance.state['Name'] == 'running':
-                    instance_name = ''
-                    tags = {}
-                    for i, tag in enumerate(instance.tags):
-                        if tag['Key'] == 'Name':
-                            instance_name = tag['Value']
-                        key = instance.tags[i]['Key'].lower()
-                        value = instance.tags[i]['Value'].lower()
-                        tags[key] = value
-                    aws_ec2_instance = AWSEC2InstanceDataObject(timestamp=TS, account_id=ACCOUNT_ID,
-                                                                instance_id=instance.id,
-                                                                instance_name=instance_name,
-                                                                internal_ip=instance.network_interfaces[
-                                                                    0].private_ip_address,
-                                                                external_ip=instance.network_interfaces[
-                                                                    0].private_ip_address,
-                                                                instance_zone=aws_region,
-                                                                machine_type=instance.instance_type,
-                                                                tags=tags, client_name='vacant', user_name='vacant',
-                                                                availability=True)
-                    instances_object.append(aws_ec2_instance)
+    ec2_client = fetch_regional_client('ec2', aws_region)
+    paginator = ec2_client.get_paginator('describe_instances')
+    running_filter = [{'Name': 'instance-state-name', 'Values': ['running']}]
+    for page in paginator.paginate(Filters=running_filter):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                instance_name = ''
+                tags = {}
+                for tag in instance.get('Tags', []):
+                    if tag['Key'] == 'Name':
+                        instance_name = tag['Value']
+                    tags[tag['Key'].lower()] = tag['Value'].lower()
+                aws_ec2_instance = AWSEC2InstanceDataObject(timestamp=TS, account_id=fetch_account_id(),
+                                                            instance_id=instance['InstanceId'],
+                                                            instance_name=instance_name,
+                                                            internal_ip=instance.get('PrivateIpAddress', ''),
+                                                            external_ip=instance.get('PublicIpAddress', ''),
+                                                            instance_zone=aws_region,
+                                                            machine_type=instance['InstanceType'],
+                                                            tags=tags, client_name='vacant', user_name='vacant',
+                                                            availability=True)
+                instances_object.append(aws_ec2_instance)
     return instances_object
 
 
-def fetch_eks_clusters() -> list:
+def list_all_instances(workers: int = DISCOVERY_WORKERS) -> tuple:
+    """
+    @return: The instances of all the regions, and the regions they were listed in. A region that failed is left
+    out, so its instances are not taken for stale ones
+    """
     aws_regions = fetch_regions()
+    instances_object, failed_regions = fan_out_regions(fetch_region_instances, aws_regions, workers)
+    return instances_object, [aws_region for aws_region in dict.fromkeys(aws_regions)
+                              if aws_region not in failed_regions]
+
+
+def fetch_eks_cluster(eks_client, cluster_name: str, aws_region: str, machine_types_index: dict) -> dict:
+    cluster_object = {}
+    cluster_data = eks_client.describe_cluster(name=cluster_name)
+    if cluster_data['cluster']['status'] != 'ACTIVE':
+        return cluster_object
+    totalVCPU = 0
+    totalNodes = 0
+    machines_list = []
+    for page in eks_client.get_paginator('list_nodegroups').paginate(clusterName=cluster_name):
+        for node_group in page['nodegroups']:
+            node_groups_response = eks_client.describe_nodegroup(clusterName=cluster_name,
+                                                                 nodegroupName=node_group)
+            machines_amount = node_groups_response['nodegroup']['scalingConfig']['desiredSize']
+            totalNodes += machines_amount
+            machine_type = node_groups_response['nodegroup']['instanceTypes'][0]
+            machines_list.append(machine_type)
+            if machine_type not in machine_types_index:
+                logger.warning(f'{machine_type} machine type of {cluster_name} cluster was not found in the cache')
+            totalVCPU += machine_types_index.get(machine_type, {'vCPU': 0, 'memory': 0})['vCPU'] * machines_amount
+    cluster_object['vCPU'] = totalVCPU
+    cluster_object['num_nodes'] = totalNodes
+    cluster_object['machine_type'] = machines_list
+    cluster_object['cluster_name'] = cluster_name
+    cluster_object['user_name'] = 'vacant'
+    cluster_object['created_timestamp'] = int(cluster_data['cluster']['createdAt'].timestamp())
+    cluster_object['human_created_timestamp'] = cluster_data['cluster']['createdAt'].strftime(
+        '%d-%m-%Y %H:%M:%S')
+    cluster_object['expiration_timestamp'] = TS_IN_20_YEARS
+    cluster_object['human_expiration_timestamp'] = datetime.datetime.fromtimestamp(
+        TS_IN_20_YEARS).strftime(
+        '%d-%m-%Y %H:%M:%S')
+    cluster_object['cluster_version'] = cluster_data['cluster']['version']
+    cluster_object['region_name'] = cluster_data['cluster']['arn'].split(":")[3]
+    cluster_object['tags'] = cluster_data['cluster']['tags']
+    cluster_object['availability'] = True
+    cluster_object['kubeconfig'] = build_eks_kubeconfig(cluster_data['cluster'])
+    cluster_object['nodes_names'] = []
+    cluster_object['nodes_ips'] = []
+    return cluster_object
+
+
+def fetch_region_eks_clusters(aws_region: str, machine_types_index: dict) -> list:
     eks_clusters_object = []
-    eks_clusters_names = []
-    for aws_region in aws_regions:
-        eks_client = boto3.client('eks', region_name=aws_region)
-        response = eks_client.list_clusters()
-        if len(response['clusters']) > 0:
-            for cluster in response['clusters']:
-                eks_clusters_names.append(cluster)
-            for cluster_name in eks_clusters_names:
-                cluster_object = {}
-                cluster_data = eks_client.describe_cluster(name=cluster_name)
-                if cluster_data['cluster']['status'] == 'ACTIVE':
-                    response = eks_client.list_nodegroups(clusterName=cluster_name)
-                    machine_types = []
-                    totalVCPU = 0
-                    totalNodes = 0
-                    machines_list = []
-                    for node_group in response['nodegroups']:
-                        node_groups_response = eks_client.describe_nodegroup(clusterName=cluster_name,
-                                                                             nodegroupName=node_group)
-                        machines_amount = node_groups_response['nodegroup']['scalingConfig']['desiredSize']
-                        totalNodes += machines_amount
-                        machine_type = node_groups_response['nodegroup']['instanceTypes'][0]
-                        machines_list.append(machine_type)
-                        vCPU = retrieve_compute_per_machine_type('eks', machine_type)['vCPU']
-                        machine_types.append({'machine_type': machine_type,
-                                              'machines_amount': machines_amount,
-                                              'vCPU': vCPU
-                                              })
-                        for machine_type_ in machine_types:
-                            totalVCPU += machine_type_['vCPU']
-                    cluster_object['vCPU'] = totalVCPU
-                    cluster_object['num_nodes'] = totalNodes
-                    cluster_object['machine_type'] = machines_list
-                    cluster_object['cluster_name'] = cluster_name
-                    cluster_object['user_name'] = 'vacant'
-                    cluster_object['created_timestamp'] = int(cluster_data['cluster']['createdAt'].timestamp())
-                    cluster_object['human_created_timestamp'] = cluster_data['cluster']['createdAt'].strftime(
-                        '%d-%m-%Y %H:%M:%S')
-                    cluster_object['expiration_timestamp'] = TS_IN_20_YEARS
-                    cluster_object['human_expiration_timestamp'] = datetime.datetime.fromtimestamp(
-                        TS_IN_20_YEARS).strftime(
-                        '%d-%m-%Y %H:%M:%S')
-                    cluster_object['cluster_version'] = cluster_data['cluster']['version']
-                    cluster_object['region_name'] = cluster_data['cluster']['arn'].split(":")[3]
-                    cluster_object['tags'] = cluster_data['cluster']['tags']
-                    cluster_object['availability'] = True
-                    cluster_object['kubeconfig'] = generate_kubeconfig(cluster_name=cluster_name,
-                                                                       cluster_region=aws_region)
-                    cluster_object['nodes_names'] = []
-                    cluster_object['nodes_ips'] = []
-                    eks_clusters_object.append(cluster_object)
+    eks_client = fetch_regional_client('eks', aws_region)
+    cluster_names = []
+    for page in eks_client.get_paginator('list_clusters').paginate():
+        cluster_names.extend(page['clusters'])
+    for cluster_name in dict.fromkeys(cluster_names):
+        cluster_object = fetch_eks_cluster(eks_client, cluster_name, aws_region, machine_types_index)
+        if cluster_object:
+            eks_clusters_object.append(cluster_object)
     return eks_clusters_object
 
 
-def main(is_fetching_files: bool = False, is_fetching_buckets: bool = False, is_fetching_ec2_instances: bool = False,
-         is_fetching_eks_clusters: bool = False):
-    global aws_buckets_data_object
-    if is_fetching_eks_clusters:
-        already_discovered_clusters_to_test = []
-        discovered_clusters_to_add = []
-
-        already_discovered_eks_clusters = retrieve_available_clusters('eks')
-        eks_discovered_clusters = fetch_eks_clusters()
-
-        for already_discovered_cluster in already_discovered_eks_clusters:
-            already_discovered_clusters_to_test.append(already_discovered_cluster['cluster_name'])
+def fetch_eks_clusters(workers: int = DISCOVERY_WORKERS) -> list:
+    machine_types_index = retrieve_machine_types_index(EKS)
+    eks_clusters_object, _ = fan_out_regions(fetch_region_eks_clusters, fetch_regions(), workers,
+                                             region_kwargs={'machine_types_index': machine_types_index})
+    return eks_clusters_object
 
-        for eks_discovered_cluster in eks_discovered_clusters:
-            if eks_discovered_cluster['cluster_name'] not in already_discovered_clusters_to_test:
-                discovered_clusters_to_add.append(eks_discovered_cluster)
 
-        print('List of discovered EKS clusters: ')
-        print(eks_discovered_clusters)
-        for eks_discovered_cluster in eks_discovered_clusters:
-            insert_eks_cluster_object(eks_discovered_cluster)
+def main(is_fetching_files: bool = False, is_fetching_buckets: bool = False, is_fetching_ec2_instances: bool = False,
+         is_fetching_eks_clusters: bool = False, workers: int = DISCOVERY_WORKERS):
+    """
+    Every discovery of the account runs under a lease, a discovery another worker already runs is skipped
+    """
+    account_id = fetch_account_id()
+    if is_fetching_eks_clusters:
+        with Lease(build_lease_key(AWS, 'clusters_discovery', account_id)) as lease:
+            if lease.is_acquired:
+                eks_discovered_clusters = fetch_eks_clusters(workers)
+                print('List of discovered EKS clusters: ')
+                print(eks_discovered_clusters)
+                if lease.is_held():
+                    for eks_discovered_cluster in eks_discovered_clusters:
+                        insert_eks_cluster_object(eks_discovered_cluster)
     if is_fetching_ec2_instances:
-        already_discovered_vm_instances_to_test = []
-        discovered_vm_instances_to_add = []
-
-        already_discovered_vm_instances = retrieve_instances('aws')
-        aws_discovered_vm_instances_object = list_all_instances()
-
-        for already_discovered_vm in already_discovered_vm_instances:
-            already_discovered_vm_instances_to_test.append(already_discovered_vm['instance_name'])
-
-        for aws_discovered_vm_instance in aws_discovered_vm_instances_object:
-            if aws_discovered_vm_instance.instance_name not in already_discovered_vm_instances_to_test:
-                discovered_vm_instances_to_add.append(aws_discovered_vm_instance)
-
-        print('List of discovered EC2 instances: ')
-        print(discovered_vm_instances_to_add)
-        insert_aws_instances_object(discovered_vm_instances_to_add)
-    if is_fetching_buckets:
-        aws_buckets_data_object = fetch_buckets()
-        print('List of discovered S3 buckets: ')
-        print(asdict(aws_buckets_data_object))
-        insert_aws_buckets_object(asdict(aws_buckets_data_object))
-    if is_fetching_files:
-        aws_files_data_object = fetch_files(aws_buckets_data_object)
-        print('List of discovered S3 files: ')
-        print(asdict(aws_files_data_object))
-        insert_aws_files_object(asdict(aws_files_data_object))
+        with Lease(build_lease_key(AWS, 'instances_discovery', account_id)) as lease:
+            if lease.is_acquired:
+                aws_discovered_vm_instances_object, discovered_regions = list_all_instances(workers)
+                print('List of discovered EC2 instances: ')
+                print(aws_discovered_vm_instances_object)
+                if lease.is_held():
+                    insert_aws_instances_object(aws_discovered_vm_instances_object, account_id,
+                                                regions=discovered_regions)
+    if is_fetching_buckets or is_fetching_files:
+        # The files are listed out of the buckets, so both run under the same lease
+        with Lease(build_lease_key(AWS, 'storage_discovery', account_id)) as lease:
+            if lease.is_acquired:
+                aws_buckets_data_object = fetch_buckets()
+            if lease.is_acquired and is_fetching_buckets:
+                print('List of discovered S3 buckets: ')
+                print(asdict(aws_buckets_data_object))
+                if lease.is_held():
+                    insert_aws_buckets_object(asdict(aws_buckets_data_object))
+            if lease.is_acquired and is_fetching_files:
+                aws_files_data_object = fetch_files(aws_buckets_data_object)
+                print('List of discovered S3 files: ')
+                print(asdict(aws_files_data_object))
+                if lease.is_held():
+                    insert_aws_files_object(asdict(aws_files_data_object))
 
 
 if __name__ == '__main__':
@@ -256,6 +304,9 @@ if __name__ == '__main__':
     parser.add_argument('--fetch-buckets', action='store_true', default=True, help='Fetch buckets or not')
     parser.add_argument('--fetch-ec2-instances', action='store_true', default=True, help='Fetch EC2 instances or not')
     parser.add_argument('--fetch-eks-clusters', action='store_true', default=True, help='Fetch EKS clusters or not')
+    parser.add_argument('--workers', type=int, default=DISCOVERY_WORKERS,
+                        help='Amount of regions to discover concurrently')
     args = parser.parse_args()
     main(is_fetching_files=args.fetch_files, is_fetching_buckets=args.fetch_buckets,
-         is_fetching_ec2_instances=args.fetch_ec2_instances, is_fetching_eks_clusters=args.fetch_eks_clusters)
+         is_fetching_ec2_instances=args.fetch_ec2_instances, is_fetching_eks_clusters=args.fetch_eks_clusters,
+         workers=args.workers)
@@ -0,0 +1,20 @@
+def build_machine_types_indexes(machines_per_zone: dict) -> tuple:
+    """
+    @param machines_per_zone: A zone (or region) -> list of GKEMachineTypeObject/AWSMachineTypeObject dictionary
+    @return: The zone -> series, series -> machine types and zone -> machine types dictionaries, built in a single
+    pass. The lists keep the order the series and machine types were first seen in
+    """
+    zones_and_series = {}
+    series_and_machine_types = {}
+    zones_and_machine_types = {}
+    for zone, machine_types in machines_per_zone.items():
+        zone_series = zones_and_series.setdefault(zone, {})
+        zone_machine_types = zones_and_machine_types.setdefault(zone, {})
+        for machine_type in machine_types:
+            zone_series[machine_type.machine_series] = None
+            zone_machine_types[machine_type.machine_type] = None
+            series_and_machine_types.setdefault(machine_type.machine_series, {})[machine_type.machine_type] = None
+    # dictionaries serve as insertion ordered sets, the caches store lists
+    return ({zone: list(series) for zone, series in zones_and_series.items()},
+            {series: list(machine_types) for series, machine_types in series_and_machine_types.items()},
+            {zone: list(machine_types) for zone, machine_types in zones_and_machine_types.items()})
@@ -0,0 +1,70 @@
+import os
+import timeit
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+DOCKER_ENV = os.getenv('DOCKER_ENV', False)
+
+if DOCKER_ENV:
+    from cache_index_builder import build_machine_types_indexes
+    from mongo_handler.mongo_objects import GKEMachineTypeObject
+else:
+    from web.scripts.cache_index_builder import build_machine_types_indexes
+    from web.mongo_handler.mongo_objects import GKEMachineTypeObject
+
+
+def build_synthetic_catalogue(zones: int, machine_types: int, series: int) -> dict:
+    machines_per_zone = {}
+    for zone_index in range(zones):
+        zone = f'zone-{zone_index}'
+        machines_per_zone[zone] = [GKEMachineTypeObject(zone=zone,
+                                                        machine_series=f'series{type_index % series}',
+                                                        machine_type=f'series{type_index % series}-{type_index}',
+                                                        vCPU=type_index % 64 + 1,
+                                                        memory=(type_index % 64 + 1) * 4096)
+                                   for type_index in range(machine_types)]
+    return machines_per_zone
+
+
+def legacy_series_and_machine_types(machines_per_zone: dict) -> dict:
+    """
+    The zones x series x machines loop the caching scripts ran before build_machine_types_indexes
+    """
+    machines_series_list = []
+    for zone in machines_per_zone:
+        for machine_type in machines_per_zone[zone]:
+            if machine_type.machine_series not in machines_series_list:
+                machines_series_list.append(machine_type.machine_series)
+    series_and_machine_types_dict = {}
+    for zone in machines_per_zone:
+        for machine_series in machines_series_list:
+            for machine_type in machines_per_zone[zone]:
+                if machine_series not in series_and_machine_types_dict.keys():
+                    if machine_type.machine_series == machine_series:
+                        series_and_machine_types_dict[machine_series] = [machine_type.machine_type]
+                else:
+                    if machine_type.machine_series == machine_series:
+                        if machine_type.machine_type not in series_and_machine_types_dict[machine_series]:
+                            series_and_machine_types_dict[machine_series].append(machine_type.machine_type)
+    return series_and_machine_types_dict
+
+
+def main(zones: int = 100, machine_types: int = 500, series: int = 25, repeats: int = 3):
+    machines_per_zone = build_synthetic_catalogue(zones, machine_types, series)
+    if legacy_series_and_machine_types(machines_per_zone) != build_machine_types_indexes(machines_per_zone)[1]:
+        raise SystemExit('The series -> machine types indexes differ')
+    legacy_time = min(timeit.repeat(lambda: legacy_series_and_machine_types(machines_per_zone),
+                                    number=1, repeat=repeats))
+    index_time = min(timeit.repeat(lambda: build_machine_types_indexes(machines_per_zone), number=1, repeat=repeats))
+    print(f'Catalogue of {zones} zones x {machine_types} machine types in {series} series')
+    print(f'Nested loops: {legacy_time * 1000:.1f}ms')
+    print(f'build_machine_types_indexes: {index_time * 1000:.1f}ms ({legacy_time / index_time:.0f}x faster)')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('--zones', type=int, default=100, help='Amount of synthetic zones')
+    parser.add_argument('--machine-types', type=int, default=500, help='Amount of machine types per zone')
+    parser.add_argument('--series', type=int, default=25, help='Amount of machine series')
+    parser.add_argument('--repeats', type=int, default=3, help='Amount of timing repeats')
+    args = parser.parse_args()
+    main(zones=args.zones, machine_types=args.machine_types, series=args.series, repeats=args.repeats)
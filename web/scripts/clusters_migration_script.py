@@ -0,0 +1,97 @@
+import logging
+import os
+import sys
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+from pymongo import ReplaceOne, UpdateOne
+
+DOCKER_ENV = os.getenv('DOCKER_ENV', False)
+
+log_file_name = 'server.log'
+if DOCKER_ENV:
+    log_file_path = f'{os.getcwd()}/web/{log_file_name}'
+else:
+    log_file_path = f'{os.getcwd()}/{log_file_name}'
+
+logger = logging.getLogger(__name__)
+
+file_handler = logging.FileHandler(filename=log_file_path)
+stdout_handler = logging.StreamHandler(stream=sys.stdout)
+handlers = [file_handler, stdout_handler]
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='[%(asctime)s] {%(filename)s:%(lineno)d} %(levelname)s - %(message)s',
+    handlers=handlers
+)
+
+if DOCKER_ENV:
+    from mongo_handler.mongo_utils import clusters, gke_clusters, gke_autopilot_clusters, eks_clusters, \
+        aks_clusters, gcp_discovered_gke_clusters, aws_discovered_eks_clusters, az_discovered_aks_clusters, \
+        build_cluster_query, ensure_indexes
+    from variables.variables import GKE, GKE_AUTOPILOT, EKS, AKS, CLUSTER_NAME, AVAILABILITY
+else:
+    from web.mongo_handler.mongo_utils import clusters, gke_clusters, gke_autopilot_clusters, eks_clusters, \
+        aks_clusters, gcp_discovered_gke_clusters, aws_discovered_eks_clusters, az_discovered_aks_clusters, \
+        build_cluster_query, ensure_indexes
+    from web.variables.variables import GKE, GKE_AUTOPILOT, EKS, AKS, CLUSTER_NAME, AVAILABILITY
+
+BATCH_SIZE = 500
+
+# legacy collection -> (cluster_type, discovered)
+LEGACY_CLUSTERS_COLLECTIONS = [
+    (gke_clusters, GKE, False),
+    (gcp_discovered_gke_clusters, GKE, True),
+    (gke_autopilot_clusters, GKE_AUTOPILOT, False),
+    (eks_clusters, EKS, False),
+    (aws_discovered_eks_clusters, EKS, True),
+    (aks_clusters, AKS, False),
+    (az_discovered_aks_clusters, AKS, True),
+]
+
+
+def migrate_collection(legacy_collection, cluster_type: str, discovered: bool) -> int:
+    """
+    @param legacy_collection: The per type collection to copy the clusters from
+    @param cluster_type: The cluster_type to stamp on the migrated documents
+    @param discovered: Whether the legacy collection holds discovered clusters
+    @return: The amount of migrated documents
+    A name keeps a single document. An available cluster replaces a deleted one of the same name, while a deleted
+    cluster is only inserted when its name is not taken, so it never overwrites an available one
+    """
+    requests = []
+    migrated = 0
+    for cluster_object in legacy_collection.find():
+        del cluster_object['_id']
+        mongo_query = build_cluster_query(cluster_type, cluster_object.get(CLUSTER_NAME.lower(), ''), discovered)
+        cluster_object.update(mongo_query)
+        if cluster_object.get(AVAILABILITY):
+            requests.append(ReplaceOne(mongo_query, cluster_object, upsert=True))
+        else:
+            requests.append(UpdateOne(mongo_query, {'$setOnInsert': cluster_object}, upsert=True))
+        if len(requests) == BATCH_SIZE:
+            clusters.bulk_write(requests)
+            migrated += len(requests)
+            requests = []
+    if requests:
+        clusters.bulk_write(requests)
+        migrated += len(requests)
+    logger.info(f'Migrated {migrated} documents from {legacy_collection.name} into the clusters collection')
+    return migrated
+
+
+def main(drop_legacy_collections: bool = False):
+    ensure_indexes()
+    for legacy_collection, cluster_type, discovered in LEGACY_CLUSTERS_COLLECTIONS:
+        migrate_collection(legacy_collection, cluster_type, discovered)
+        if drop_legacy_collections:
+            logger.info(f'Dropping the {legacy_collection.name} legacy collection')
+            legacy_collection.drop()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('--drop-legacy-collections', action='store_true', default=False,
+                        help='Drop the per type clusters collections after the migration')
+    args = parser.parse_args()
+    main(drop_legacy_collections=args.drop_legacy_collections)
@@ -1,9 +1,13 @@
+import concurrent.futures
 import json
 import logging
 import os
 import platform
 import sys
+import threading
+import time
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from contextlib import contextmanager
 from dataclasses import asdict
 import getpass as gt
 from dotenv import load_dotenv
@@ -35,20 +39,23 @@ logging.basicConfig(
 logger.info(f'App runs in the DOCKER_ENV: {DOCKER_ENV}')
 
 if DOCKER_ENV:
-    from mongo_handler.mongo_utils import insert_cache_object
+    from mongo_handler.mongo_utils import insert_cache_object, insert_cache_objects, Lease, build_lease_key
+    from cache_index_builder import build_machine_types_indexes
     from mongo_handler.mongo_objects import GKECacheObject, GKEMachineTypeObject, \
         GKESeriesAndMachineTypesObject, GKEZonesAndMachineSeriesObject, GKEMachinesCacheObject
-    from variables.variables import GKE
+    from variables.variables import GKE, GCP
 else:
-    from web.mongo_handler.mongo_utils import insert_cache_object
+    from web.mongo_handler.mongo_utils import insert_cache_object, insert_cache_objects, Lease, build_lease_key
+    from web.scripts.cache_index_builder import build_machine_types_indexes
     from web.mongo_handler.mongo_objects import GKECacheObject, GKEMachineTypeObject, \
         GKESeriesAndMachineTypesObject, GKEZonesAndMachineSeriesObject, GKEMachinesCacheObject
-    from web.variables.variables import GKE
+    from web.variables.variables import GKE, GCP
 
 project_folder = os.path.expanduser(os.getcwd())
 load_dotenv(os.path.join(project_folder, '.env'))
 
 LOCAL_USER = gt.getuser()
+CACHING_WORKERS = int(os.environ.get('CACHING_WORKERS', "16"))
 GITHUB_ACTIONS_ENV = os.getenv('GITHUB_ACTIONS_ENV')
 PLATFORM_SYSTEM = platform.system()
 logger.info(f'PLATFORM_SYSTEM is: {PLATFORM_SYSTEM}')
@@ -66,11 +73,24 @@ else:
     else:
         logger.info(f'checking the docker_env path')
         GCP_CREDENTIALS_DEFAULT_DIRECTORY = "/home/app/.gcp"
-        CREDENTIALS_PATH = f'{GCP_CREDENTIALS_DEFAULT_DIRECTORY}/gcp_credentials.json'
+        CREDENTIALS_PATH = os.getenv('GCP_CREDENTIALS_PATH',
+                                     f'{GCP_CREDENTIALS_DEFAULT_DIRECTORY}/gcp_credentials.json')
         logger.info(f'CREDENTIALS_PATH is: {CREDENTIALS_PATH}')
         FETCHED_CREDENTIALS_DIR_PATH = f'/app/.gcp'
         FETCHED_CREDENTIALS_FILE_PATH = f'{FETCHED_CREDENTIALS_DIR_PATH}/gcp_credentials.json'
 
+# googleapiclient services are not thread safe, so every caching thread builds its own compute service
+COMPUTE_SERVICES = threading.local()
+
+
+@contextmanager
+def timed_phase(phase_name: str, phase_timings: dict):
+    start_time = time.monotonic()
+    try:
+        yield
+    finally:
+        phase_timings[phase_name] = time.monotonic() - start_time
+
 
 def fetch_zones(gcp_project_id: str) -> list:
     logger.info(f'A request to fetch zones has arrived for {gcp_project_id} project_id')
@@ -131,22 +151,77 @@ def create_regions_and_zones_dict(regions_list, zones_list):
     return zones_regions_dict
 
 
-def fetch_machine_types_per_zone(zones_list: list, gcp_project_id: str, credentials) -> dict:
-    logger.info(f'A request to fetch machine types has arrived')
-    service = discovery.build('compute', 'beta', credentials=credentials)
+def fetch_compute_service(credentials):
+    if not hasattr(COMPUTE_SERVICES, 'service'):
+        COMPUTE_SERVICES.service = discovery.build('compute', 'beta', credentials=credentials)
+    return COMPUTE_SERVICES.service
+
+
+def build_machine_type_object(zone: str, machine: dict) -> GKEMachineTypeObject:
+    return GKEMachineTypeObject(zone=zone,
+                                machine_type=machine['name'],
+                                machine_series=machine['name'].split('-')[0],
+                                vCPU=machine['guestCpus'],
+                                memory=machine['memoryMb'])
+
+
+def fetch_zone_machine_types(zone: str, gcp_project_id: str, credentials) -> list:
+    service = fetch_compute_service(credentials)
     machine_types_list = []
-    machines_for_zone_dict = {}
-    for zone in zones_list:
-        request = service.machineTypes().list(project=gcp_project_id, zone=zone)
+    request = service.machineTypes().list(project=gcp_project_id, zone=zone)
+    while request is not None:
+        response = request.execute()
+        for machine in response.get('items', []):
+            machine_types_list.append(build_machine_type_object(zone, machine))
+        request = service.machineTypes().list_next(previous_request=request, previous_response=response)
+    return machine_types_list
+
+
+def fetch_aggregated_machine_types(zones_list: list, gcp_project_id: str, credentials) -> dict:
+    """
+    Fetches the machine types of all the zones with paginated aggregatedList calls instead of a call per zone
+    """
+    service = fetch_compute_service(credentials)
+    machines_for_zone_dict = {zone: [] for zone in zones_list}
+    request = service.machineTypes().aggregatedList(project=gcp_project_id)
+    while request is not None:
         response = request.execute()
-        for machine in response['items']:
-            machine_type_object = GKEMachineTypeObject(zone=zone,
-                                                       machine_type=machine['name'],
-                                                       machine_series=machine['name'].split('-')[0],
-                                                       vCPU=machine['guestCpus'],
-                                                       memory=machine['memoryMb'])
-            machine_types_list.append(machine_type_object)
-        machines_for_zone_dict[zone] = machine_types_list
+        for zone_scope, zone_response in response.get('items', {}).items():
+            zone = zone_scope.split('/')[-1]
+            if zone not in machines_for_zone_dict:
+                continue
+            for machine in zone_response.get('machineTypes', []):
+                machines_for_zone_dict[zone].append(build_machine_type_object(zone, machine))
+        request = service.machineTypes().aggregatedList_next(previous_request=request, previous_response=response)
+    return machines_for_zone_dict
+
+
+def fetch_machine_types_per_zone(zones_list: list, gcp_project_id: str, credentials, workers: int = CACHING_WORKERS,
+                                 is_aggregated: bool = True) -> dict:
+    """
+    @param zones_list: The zones to fetch the machine types for
+    @param gcp_project_id: The GCP project to fetch the machine types for
+    @param credentials: The service account credentials
+    @param workers: The max amount of zones that are fetched concurrently when not using aggregatedList
+    @param is_aggregated: Fetch all the zones with aggregatedList, falling back to concurrent per zone calls on failure
+    @return: A zone -> list of GKEMachineTypeObject dictionary
+    """
+    logger.info(f'A request to fetch machine types has arrived')
+    if is_aggregated:
+        try:
+            return fetch_aggregated_machine_types(zones_list, gcp_project_id, credentials)
+        except Exception as e:
+            logger.warning(f'aggregatedList of machine types failed, fetching them per zone: {e}')
+    machines_for_zone_dict = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        future_results = {executor.submit(fetch_zone_machine_types, zone, gcp_project_id, credentials): zone
+                          for zone in zones_list}
+        for future in concurrent.futures.as_completed(future_results):
+            zone = future_results[future]
+            try:
+                machines_for_zone_dict[zone] = future.result()
+            except Exception as e:
+                logger.error(f'Fetching machine types of {zone} zone failed: {e}')
     return machines_for_zone_dict
 
 
@@ -156,8 +231,15 @@ def fetch_vcpus_for_machine_types(machine_types_list, requested_machine_type):
             return machine.vCPU
 
 
-def main(gcp_credentials: str):
-    logger.info(f'Starting the caching flow with {gcp_credentials} credentials')
+def run_caching(gcp_credentials: str, lease: Lease, workers: int = CACHING_WORKERS, is_aggregated: bool = True):
+    """
+    @param gcp_credentials: The service account json, the one of CREDENTIALS_PATH when empty
+    @param lease: The caching lease, fenced before every insert so a run that lost it stops writing
+    @param workers: The amount of threads fetching the machine types
+    @param is_aggregated: Whether to fetch the machine types of all the zones in a single aggregated call
+    """
+    logger.info('Starting the caching flow')
+    phase_timings = {}
     if gcp_credentials:
         logger.info('gcp_credentials were found')
         if not os.path.exists(FETCHED_CREDENTIALS_DIR_PATH):
@@ -170,46 +252,52 @@ def main(gcp_credentials: str):
         f = open(FETCHED_CREDENTIALS_FILE_PATH, 'a')
         f.write(gcp_credentials)
         f.close()
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = FETCHED_CREDENTIALS_FILE_PATH
-        logger.info(f'FETCHED_CREDENTIALS_FILE_PATH is: {FETCHED_CREDENTIALS_FILE_PATH}')
+        credentials_file_path = FETCHED_CREDENTIALS_FILE_PATH
     else:
-        logger.info(f'Setting {CREDENTIALS_PATH} as the credentials_path')
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = CREDENTIALS_PATH
+        # The scheduled runs never carry credentials, they use the service account file of the deployment
+        credentials_file_path = CREDENTIALS_PATH
+    logger.info(f'Setting {credentials_file_path} as the credentials_path')
+    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials_file_path
     try:
         try:
-            with open(FETCHED_CREDENTIALS_FILE_PATH, "r") as f:
+            with open(credentials_file_path, "r") as f:
                 credentials = f.read()
                 gcp_project_id = json.loads(credentials)['project_id']
                 logger.info(f'GCP_PROJECT_ID is: {gcp_project_id}')
                 print('Success extracting GCP_PROJECT_ID parameter')
 
         except Exception as e:
-            logger.error('Problem extracting GCP_PROJECT_ID parameter')
-            print('Problem extracting GCP_PROJECT_ID parameter')
+            logger.error(f'Problem extracting GCP_PROJECT_ID parameter from {credentials_file_path}: {e}')
+            raise
         try:
-            credentials = service_account.Credentials.from_service_account_file(
-                FETCHED_CREDENTIALS_FILE_PATH)
+            credentials = service_account.Credentials.from_service_account_file(credentials_file_path)
             service = discovery.build('container', 'v1', credentials=credentials)
         except Exception as e:
             logger.error(f'Credentials were not provided with a file')
-        logger.info('Attempting to fetch zones')
-        zones_list = fetch_zones(gcp_project_id)
-        logger.info('Attempting to fetch regions')
-        regions_list = fetch_regions(gcp_project_id)
-        logger.info('Attempting to fetch gke_image_types')
-        gke_image_types = fetch_gke_image_types(zones_list=zones_list, gcp_project_id=gcp_project_id, service=service)
-        logger.info('Attempting to fetch versions_list')
-        versions_list = fetch_versions(zones_list=zones_list, gcp_project_id=gcp_project_id, service=service)
+        with timed_phase('zones and regions', phase_timings):
+            logger.info('Attempting to fetch zones')
+            zones_list = fetch_zones(gcp_project_id)
+            logger.info('Attempting to fetch regions')
+            regions_list = fetch_regions(gcp_project_id)
+        with timed_phase('gke image types and versions', phase_timings):
+            logger.info('Attempting to fetch gke_image_types')
+            gke_image_types = fetch_gke_image_types(zones_list=zones_list, gcp_project_id=gcp_project_id,
+                                                    service=service)
+            logger.info('Attempting to fetch versions_list')
+            versions_list = fetch_versions(zones_list=zones_list, gcp_project_id=gcp_project_id, service=service)
         zones_regions_dict = create_regions_and_zones_dict(regions_list=regions_list, zones_list=zones_list)
-        logger.info('Attempting to fetch machine_types_all_zones')
-        machine_types_all_zones = fetch_machine_types_per_zone(zones_list, gcp_project_id=gcp_project_id,
-                                                               credentials=credentials)
-        for zone in machine_types_all_zones:
-            gke_machines_caching_object = GKEMachinesCacheObject(
+        with timed_phase('machine types fetch', phase_timings):
+            logger.info('Attempting to fetch machine_types_all_zones')
+            machine_types_all_zones = fetch_machine_types_per_zone(zones_list, gcp_project_id=gcp_project_id,
+                                                                   credentials=credentials, workers=workers,
+                                                                   is_aggregated=is_aggregated)
+        with timed_phase('machine types insert', phase_timings):
+            gke_machines_caching_objects = [asdict(GKEMachinesCacheObject(
                 region=zone,
                 machines_list=machine_types_all_zones[zone]
-            )
-            insert_cache_object(caching_object=asdict(gke_machines_caching_object), provider=GKE, machine_types=True)
+            )) for zone in machine_types_all_zones]
+            lease.fence()
+            insert_cache_objects(caching_objects=gke_machines_caching_objects, provider=GKE, machine_types=True)
 
         # Inserting a whole GKE Cache Object
         gke_caching_object = GKECacheObject(
@@ -219,55 +307,56 @@ def main(gcp_credentials: str):
             gke_image_types=gke_image_types,
             regions_zones_dict=zones_regions_dict)
         logger.info('Attempting to insert a GKE cache object')
-        insert_cache_object(caching_object=asdict(gke_caching_object), provider=GKE, gke_full_cache=True)
+        with timed_phase('gke cache insert', phase_timings):
+            lease.fence()
+            insert_cache_object(caching_object=asdict(gke_caching_object), provider=GKE, gke_full_cache=True)
 
-        # Inserting a GKE Zones and Machine Series Object
-        series_list = []
-        for zone in machine_types_all_zones:
-            for machine_type in machine_types_all_zones[zone]:
-                if not machine_type.machine_series in series_list:
-                    series_list.append(machine_type.machine_series)
+        zones_and_series_dict, series_and_machine_types_dict, _ = build_machine_types_indexes(machine_types_all_zones)
 
-            gke_zones_and_machine_series_object = GKEZonesAndMachineSeriesObject(
+        # Inserting a GKE Zones and Machine Series Object
+        with timed_phase('zones and series', phase_timings):
+            gke_zones_and_machine_series_objects = [asdict(GKEZonesAndMachineSeriesObject(
                 zone=zone,
-                series_list=series_list
-            )
-            insert_cache_object(caching_object=asdict(gke_zones_and_machine_series_object), provider=GKE,
-                                gke_zones_and_series=True)
+                series_list=zones_and_series_dict[zone]
+            )) for zone in zones_and_series_dict]
+            lease.fence()
+            insert_cache_objects(caching_objects=gke_zones_and_machine_series_objects, provider=GKE,
+                                 gke_zones_and_series=True)
 
         # Inserting a GKE Series and Machine Types Object
-        machines_series_list = []
-        for zone in machine_types_all_zones:
-            for machine_type in machine_types_all_zones[zone]:
-                if machine_type.machine_series not in machines_series_list:
-                    machines_series_list.append(machine_type.machine_series)
-
-        series_and_machine_types_dict = {}
-        for zone in machine_types_all_zones:
-            for machine_series in machines_series_list:
-                for machine_type in machine_types_all_zones[zone]:
-                    if machine_series not in series_and_machine_types_dict.keys():
-                        if machine_type.machine_series == machine_series:
-                            series_and_machine_types_dict[machine_series] = [machine_type.machine_type]
-                    else:
-                        if machine_type.machine_series == machine_series:
-                            if machine_type.machine_type not in series_and_machine_types_dict[machine_series]:
-                                series_and_machine_types_dict[machine_series].append(machine_type.machine_type)
-        for machine_series in series_and_machine_types_dict:
-            gke_series_and_machine_types_object = GKESeriesAndMachineTypesObject(
+        with timed_phase('series and machine types', phase_timings):
+            gke_series_and_machine_types_objects = [asdict(GKESeriesAndMachineTypesObject(
                 machine_series=machine_series,
                 machines_list=series_and_machine_types_dict[machine_series]
-            )
-            insert_cache_object(caching_object=asdict(gke_series_and_machine_types_object), provider=GKE,
-                                gke_series_and_machine_types=True)
-
+            )) for machine_series in series_and_machine_types_dict]
+            lease.fence()
+            insert_cache_objects(caching_objects=gke_series_and_machine_types_objects, provider=GKE,
+                                 gke_series_and_machine_types=True)
 
     except Exception as e:
         logger.error(f'Trouble connecting to GCP: {e}')
+        raise
+    finally:
+        logger.info('GCP caching wall-clock per phase: ')
+        for phase_name, elapsed in phase_timings.items():
+            logger.info(f'{phase_name}: {elapsed:.2f}s')
+
+
+def main(gcp_credentials: str, workers: int = CACHING_WORKERS, is_aggregated: bool = True):
+    # The caches are shared by all the accounts, so a single caching runs at a time
+    with Lease(build_lease_key(GCP, 'caching')) as lease:
+        if not lease.is_acquired:
+            logger.info('Another worker runs the GCP caching, skipping it')
+            return
+        run_caching(gcp_credentials, lease, workers, is_aggregated)
 
 
 if __name__ == '__main__':
     parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
     parser.add_argument('--credentials', type=str, help='GCP Credentials')
+    parser.add_argument('--workers', type=int, default=CACHING_WORKERS,
+                        help='Amount of zones to fetch concurrently when not using aggregatedList')
+    parser.add_argument('--per-zone', action='store_true', default=False,
+                        help='Fetch the machine types zone by zone instead of with aggregatedList')
     args = parser.parse_args()
-    main(args.credentials)
+    main(args.credentials, workers=args.workers, is_aggregated=not args.per_zone)
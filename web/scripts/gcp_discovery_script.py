@@ -10,7 +10,6 @@ import platform
 from collections import defaultdict
 from dataclasses import asdict
 from pathlib import Path
-from subprocess import run, PIPE
 import time
 
 from cryptography.fernet import Fernet
@@ -41,17 +40,19 @@ if DOCKER_ENV:
     from mongo_handler.mongo_objects import GCPBucketsObject, GCPFilesObject, GCPInstanceDataObject
     from mongo_handler.mongo_utils import insert_discovered_gke_cluster_object, update_discovered_gke_cluster_object, \
         insert_gcp_vm_instances_object, \
-        insert_gcp_buckets_object, insert_gcp_files_object, retrieve_available_clusters, retrieve_instances, \
-        retrieve_compute_per_machine_type, retrieve_provider_data_object, drop_discovered_clusters
+        insert_gcp_buckets_object, insert_gcp_files_object, retrieve_available_clusters, \
+        retrieve_machine_types_index, retrieve_provider_data_object, drop_discovered_clusters, Lease, build_lease_key
     from variables.variables import GKE, GCP
+    from kubeconfig_handler.kubeconfig_utils import build_gke_kubeconfig
 else:
     from web.mongo_handler.mongo_objects import GCPBucketsObject, GCPFilesObject, GCPInstanceDataObject
     from web.mongo_handler.mongo_utils import insert_discovered_gke_cluster_object, \
         update_discovered_gke_cluster_object, \
         insert_gcp_vm_instances_object, \
-        insert_gcp_buckets_object, insert_gcp_files_object, retrieve_available_clusters, retrieve_instances, \
-        retrieve_compute_per_machine_type, retrieve_provider_data_object, drop_discovered_clusters
+        insert_gcp_buckets_object, insert_gcp_files_object, retrieve_available_clusters, \
+        retrieve_machine_types_index, retrieve_provider_data_object, drop_discovered_clusters, Lease, build_lease_key
     from web.variables.variables import GKE, GCP
+    from web.kubeconfig_handler.kubeconfig_utils import build_gke_kubeconfig
 
 from google.cloud import storage
 from google.oauth2 import service_account
@@ -66,12 +67,10 @@ LOCAL_USER = gt.getuser()
 GCP_PROJECT_NAME = os.environ.get('GCP_PROJECT_NAME', 'trolley-361905')
 
 if 'Darwin' in platform.system():
-    KUBECONFIG_PATH = f'/Users/{LOCAL_USER}/.kube/config'  # path to the GCP credentials
     CREDENTIALS_DEFAULT_PATH = f'/Users/{LOCAL_USER}/.gcp/gcp_credentials.json'
     GCP_CREDENTIALS_TEMP_DIRECTORY = f'{os.getcwd()}/.gcp'
     CREDENTIALS_PATH_TO_SAVE = f'{GCP_CREDENTIALS_TEMP_DIRECTORY}/gcp_credentials.json'
 else:
-    KUBECONFIG_PATH = '/root/.kube/config'
     os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = '/app/.gcp/gcp_credentials.json'
     GCP_CREDENTIALS_TEMP_DIRECTORY = "/home/app/.gcp"
     GCP_CREDENTIALS_DEFAULT_DIRECTORY = "/home/app/.gcp"
@@ -81,20 +80,6 @@ else:
 logger.info(f"CREDENTIALS_PATH_TO_SAVE is: {CREDENTIALS_PATH_TO_SAVE}")
 
 
-def generate_kubeconfig(cluster_name: str, zone: str) -> str:
-    if os.path.exists(KUBECONFIG_PATH):
-        os.remove(KUBECONFIG_PATH)
-    os.environ['KUBECONFIG'] = KUBECONFIG_PATH
-    kubeconfig_generate_command = f'gcloud container clusters get-credentials {cluster_name} --zone={zone}'
-    file = Path(KUBECONFIG_PATH)
-    file.touch(exist_ok=True)
-    run(kubeconfig_generate_command, stdout=PIPE, stderr=PIPE, text=True, shell=True)
-    with open(KUBECONFIG_PATH, "r") as f:
-        kubeconfig = f.read()
-        logger.info(f'The kubeconfig content is: {kubeconfig}')
-        return kubeconfig
-
-
 def list_all_instances(project_id: str, ) -> list:
     """
     Returns a list of all instances present in a project, grouped by their zone.
@@ -107,18 +92,12 @@ def list_all_instances(project_id: str, ) -> list:
     """
     if os.path.exists(CREDENTIALS_PATH_TO_SAVE):
         try:
-            with open(CREDENTIALS_PATH_TO_SAVE, "r") as f:
-                credentials = f.read()
-                print(f'The credentials file content is: {credentials}')
             instance_client = compute_v1.InstancesClient.from_service_account_file(CREDENTIALS_PATH_TO_SAVE)
         except Exception as e:
             print(
                 f'There was an issue getting the info with the credentials file on {CREDENTIALS_PATH_TO_SAVE} path: {e}')
     else:
         try:
-            with open(CREDENTIALS_DEFAULT_PATH, "r") as f:
-                credentials = f.read()
-                print(f'The credentials file content is: {credentials}')
             instance_client = compute_v1.InstancesClient.from_service_account_file(CREDENTIALS_DEFAULT_PATH)
         except Exception as e:
             print(
@@ -187,6 +166,7 @@ def fetch_files(credentials, gcp_buckets: GCPBucketsObject):
 def fetch_gke_clusters(service) -> list:
     gcp_projects = [GCP_PROJECT_NAME]
     gke_clusters_object = []
+    machine_types_index = retrieve_machine_types_index(GKE)
     for project in gcp_projects:
         request = service.projects().zones().clusters().list(projectId=project, zone='-')
         response = request.execute()
@@ -228,23 +208,26 @@ def fetch_gke_clusters(service) -> list:
                     cluster_object['node_pools'] = cluster['nodePools']
                     cluster_object['discovered'] = True
                     try:
-                        cluster_object['kubeconfig'] = generate_kubeconfig(cluster_name=cluster['name'],
-                                                                           zone=cluster['zone'])
-                    except:
-                        print("failed to work with gcloud")
+                        cluster_object['kubeconfig'] = build_gke_kubeconfig(project_name=project, cluster=cluster)
+                    except KeyError as e:
+                        logger.warning(f'{cluster["name"]} cluster is missing {e} to build its kubeconfig')
                         cluster_object['kubeconfig'] = ""
                     num_nodes = 0
+                    total_vCPU = 0
+                    total_memory = 0
                     for node_pool in cluster['nodePools']:
                         num_nodes += node_pool['initialNodeCount']
                         machine_type = node_pool['config']['machineType']
-                        vCPU = retrieve_compute_per_machine_type('gke', machine_type, cluster['locations'][0])['vCPU']
-                        memory = retrieve_compute_per_machine_type('gke', machine_type, cluster['locations'][0])[
-                            'memory']
-                        cluster_object['totalvCPU'] = vCPU * num_nodes
-                        total_memory = memory * num_nodes * 1024
+                        if machine_type not in machine_types_index:
+                            logger.warning(f'{machine_type} machine type of {cluster["name"]} cluster was not '
+                                           f'found in the cache')
+                        machine_compute = machine_types_index.get(machine_type, {'vCPU': 0, 'memory': 0})
+                        total_vCPU += machine_compute['vCPU'] * node_pool['initialNodeCount']
+                        total_memory += machine_compute['memory'] * node_pool['initialNodeCount'] * 1024
+                        cluster_object['totalvCPU'] = total_vCPU
                         cluster_object['total_memory'] = size(total_memory)
                         cluster_object['machine_type'] = machine_type
-                        cluster_object['vCPU'] = vCPU
+                        cluster_object['vCPU'] = machine_compute['vCPU']
                     cluster_object['num_nodes'] = num_nodes
                     gke_clusters_object.append(cluster_object)
     return gke_clusters_object
@@ -259,71 +242,66 @@ def main(is_fetching_files: bool = False, is_fetching_buckets: bool = False, is_
     if not credentials:
         sys.exit("provider credentials were not found")
     service = discovery.build('container', 'v1', credentials=credentials)
-    global gcp_discovered_buckets
+    # Every discovery of the project runs under a lease, a discovery another worker already runs is skipped
     if is_fetching_gke_clusters:
-        discovered_clusters_to_add = []
-        discovered_clusters_to_update = []
-        trolley_built_clusters = retrieve_available_clusters('gke')
-        gke_discovered_clusters = fetch_gke_clusters(service)
-        for gke_discovered_cluster in gke_discovered_clusters:
-            for trolley_built_cluster in trolley_built_clusters:
-                if gke_discovered_cluster['cluster_name'] != trolley_built_cluster['cluster_name']:
-                    discovered_clusters_to_add.append(gke_discovered_cluster)
-                else:
-                    discovered_clusters_to_update.append(gke_discovered_cluster)
-            if gke_discovered_cluster not in trolley_built_clusters:
-                discovered_clusters_to_add.append(gke_discovered_cluster)
-        print(f'List of discovered GKE clusters: {gke_discovered_clusters}')
-        print(f'List of trolley built GKE clusters: {trolley_built_clusters}')
-        print(f'List of discovered clusters to add: {discovered_clusters_to_add}')
-        if not gke_discovered_clusters:
-            drop_discovered_clusters(cluster_type=GKE)
-        for discovered_cluster_to_add in discovered_clusters_to_add:
-            insert_discovered_gke_cluster_object(discovered_cluster_to_add)
-        for discovered_cluster_to_update in discovered_clusters_to_update:
-            update_discovered_gke_cluster_object(discovered_cluster_to_update)
+        with Lease(build_lease_key(GCP, 'clusters_discovery', GCP_PROJECT_NAME)) as lease:
+            if lease.is_acquired:
+                discovered_clusters_to_add = []
+                discovered_clusters_to_update = []
+                trolley_built_clusters = retrieve_available_clusters('gke')
+                gke_discovered_clusters = fetch_gke_clusters(service)
+                for gke_discovered_cluster in gke_discovered_clusters:
+                    for trolley_built_cluster in trolley_built_clusters:
+                        if gke_discovered_cluster['cluster_name'] != trolley_built_cluster['cluster_name']:
+                            discovered_clusters_to_add.append(gke_discovered_cluster)
+                        else:
+                            discovered_clusters_to_update.append(gke_discovered_cluster)
+                    if gke_discovered_cluster not in trolley_built_clusters:
+                        discovered_clusters_to_add.append(gke_discovered_cluster)
+                print(f'List of discovered GKE clusters: {gke_discovered_clusters}')
+                print(f'List of trolley built GKE clusters: {trolley_built_clusters}')
+                print(f'List of discovered clusters to add: {discovered_clusters_to_add}')
+                if lease.is_held():
+                    if not gke_discovered_clusters:
+                        drop_discovered_clusters(cluster_type=GKE)
+                    for discovered_cluster_to_add in discovered_clusters_to_add:
+                        insert_discovered_gke_cluster_object(discovered_cluster_to_add)
+                    for discovered_cluster_to_update in discovered_clusters_to_update:
+                        update_discovered_gke_cluster_object(discovered_cluster_to_update)
     if is_fetching_vm_instances:
-        already_discovered_vm_instances_to_test = []
-        discovered_vm_instances_to_add = []
-
-        already_discovered_vm_instances = retrieve_instances(GCP)
-        gcp_discovered_vm_instances_object = list_all_instances(project_id=GCP_PROJECT_NAME)
-
-        for already_discovered_vm in already_discovered_vm_instances:
-            if already_discovered_vm in gcp_discovered_vm_instances_object:
-                discovered_vm_instances_to_add.append(already_discovered_vm['instance_name'])
-
-        for gcp_discovered_vm_instance in gcp_discovered_vm_instances_object:
-            if gcp_discovered_vm_instance.instance_name not in already_discovered_vm_instances_to_test:
-                discovered_vm_instances_to_add.append(gcp_discovered_vm_instance)
-
-        print('List of discovered VM Instances: ')
-        print(gcp_discovered_vm_instances_object)
-        print('List of discovered VMs to add: ')
-        print(discovered_vm_instances_to_add)
-        insert_gcp_vm_instances_object(discovered_vm_instances_to_add)
-    if is_fetching_buckets:
-        gcp_discovered_buckets = fetch_buckets(credentials)
-        print('List of discovered GCP Buckets: ')
-        print(asdict(gcp_discovered_buckets))
-        insert_gcp_buckets_object(asdict(gcp_discovered_buckets))
-    if is_fetching_files:
-        gcp_discovered_files_object = fetch_files(credentials, gcp_discovered_buckets)
-        print('List of discovered GCP Files: ')
-        print(asdict(gcp_discovered_files_object))
-        insert_gcp_files_object(asdict(gcp_discovered_files_object))
+        with Lease(build_lease_key(GCP, 'instances_discovery', GCP_PROJECT_NAME)) as lease:
+            if lease.is_acquired:
+                gcp_discovered_vm_instances_object = list_all_instances(project_id=GCP_PROJECT_NAME)
+                print('List of discovered VM Instances: ')
+                print(gcp_discovered_vm_instances_object)
+                if lease.is_held():
+                    insert_gcp_vm_instances_object(gcp_discovered_vm_instances_object, GCP_PROJECT_NAME)
+    if is_fetching_buckets or is_fetching_files:
+        # The files are listed out of the buckets, so both run under the same lease
+        with Lease(build_lease_key(GCP, 'storage_discovery', GCP_PROJECT_NAME)) as lease:
+            if lease.is_acquired:
+                gcp_discovered_buckets = fetch_buckets(credentials)
+            if lease.is_acquired and is_fetching_buckets:
+                print('List of discovered GCP Buckets: ')
+                print(asdict(gcp_discovered_buckets))
+                if lease.is_held():
+                    insert_gcp_buckets_object(asdict(gcp_discovered_buckets))
+            if lease.is_acquired and is_fetching_files:
+                gcp_discovered_files_object = fetch_files(credentials, gcp_discovered_buckets)
+                print('List of discovered GCP Files: ')
+                print(asdict(gcp_discovered_files_object))
+                if lease.is_held():
+                    insert_gcp_files_object(asdict(gcp_discovered_files_object))
     print('Finished the discovery script')
 
 
 def get_credentials(user_email: str):
     provider_data = retrieve_provider_data_object(user_email, 'gcp')
-    print(f"provider_data {provider_data}")
     if provider_data:
         try:
             google_creds = provider_data['google_creds_json']
             decrypted_credentials_ = crypter.decrypt(google_creds)
             decrypted_credentials = json.loads(decrypted_credentials_)
-            print(f"decrypted_credentials {decrypted_credentials}")
             with open(CREDENTIALS_PATH_TO_SAVE, 'w') as fp:
                 json.dump(decrypted_credentials, fp)
         except:
@@ -0,0 +1,78 @@
+import json
+import os
+import re
+import subprocess
+import sys
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from collections import defaultdict
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# import time:       self [us] |  cumulative | imported package
+IMPORT_TIME_LINE_PATTERN = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s+)(\S+)$')
+
+
+def measure_import_times(module_name: str, pythonpath: str) -> list:
+    """
+    Imports the module in a fresh interpreter with -X importtime
+    @return: (imported module, self microseconds, cumulative microseconds, nesting level) of every import
+    """
+    import_env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [pythonpath,
+                                                                             os.environ.get('PYTHONPATH')]))}
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module_name}'],
+                            cwd=REPOSITORY_PATH, env=import_env, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(f'Importing {module_name} failed:\n{result.stderr[-2000:]}')
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE_PATTERN.match(line)
+        if match:
+            self_us, cumulative_us, indentation, imported_module = match.groups()
+            imports.append((imported_module, int(self_us), int(cumulative_us), (len(indentation) - 1) // 2))
+    return imports
+
+
+def build_report(imports: list, module_name: str) -> dict:
+    """
+    @return: The total import time of the module and the self time of every top level package it pulled in, in ms
+    """
+    packages = defaultdict(int)
+    for imported_module, self_us, _, _ in imports:
+        packages[imported_module.split('.')[0]] += self_us
+    total_us = next((cumulative_us for imported_module, _, cumulative_us, nesting_level in imports
+                     if imported_module == module_name and nesting_level == 0), sum(packages.values()))
+    return {'module': module_name, 'total_ms': total_us / 1000,
+            'packages_ms': {package: package_us / 1000 for package, package_us in
+                            sorted(packages.items(), key=lambda item: item[1], reverse=True)}}
+
+
+def main(module_name: str = 'main', pythonpath: str = 'web', runs: int = 3, top: int = 20, output_path: str = '',
+         baseline_path: str = ''):
+    # The fastest run is the least disturbed by the disk cache and the machine load
+    report = min((build_report(measure_import_times(module_name, pythonpath), module_name) for _ in range(runs)),
+                 key=lambda run_report: run_report['total_ms'])
+    baseline = {}
+    if baseline_path:
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+    print(f"Importing {module_name} takes {report['total_ms']:.1f}ms"
+          + (f" (was {baseline['total_ms']:.1f}ms)" if baseline else ''))
+    for package, package_ms in list(report['packages_ms'].items())[:top]:
+        baseline_ms = baseline.get('packages_ms', {}).get(package)
+        change = f' (was {baseline_ms:.1f}ms)' if baseline_ms is not None else ' (new)' if baseline else ''
+        print(f'{package}: {package_ms:.1f}ms{change}')
+    if output_path:
+        with open(output_path, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('--module', type=str, default='main', help='The module to import, the web app by default')
+    parser.add_argument('--pythonpath', type=str, default='web', help='Added to the PYTHONPATH of the import')
+    parser.add_argument('--runs', type=int, default=3, help='Amount of imports, the fastest one is reported')
+    parser.add_argument('--top', type=int, default=20, help='Amount of packages to list')
+    parser.add_argument('--output', type=str, default='', help='Save the report as JSON, to be used as a baseline')
+    parser.add_argument('--baseline', type=str, default='', help='A saved report to compare against')
+    args = parser.parse_args()
+    main(module_name=args.module, pythonpath=args.pythonpath, runs=args.runs, top=args.top, output_path=args.output,
+         baseline_path=args.baseline)
@@ -0,0 +1,115 @@
+import logging
+import os
+import sys
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+DOCKER_ENV = os.getenv('DOCKER_ENV', False)
+
+log_file_name = 'server.log'
+if DOCKER_ENV:
+    log_file_path = f'{os.getcwd()}/web/{log_file_name}'
+else:
+    log_file_path = f'{os.getcwd()}/{log_file_name}'
+
+logger = logging.getLogger(__name__)
+
+file_handler = logging.FileHandler(filename=log_file_path)
+stdout_handler = logging.StreamHandler(stream=sys.stdout)
+handlers = [file_handler, stdout_handler]
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='[%(asctime)s] {%(filename)s:%(lineno)d} %(levelname)s - %(message)s',
+    handlers=handlers
+)
+
+if DOCKER_ENV:
+    from mongo_handler.mongo_utils import clusters, users, k8s_agent_data, deployment_yamls, \
+        gke_zones_and_series_cache, gke_machines_types_cache, gke_series_and_machine_types_cache, \
+        aws_regions_and_series_cache, aws_series_and_machine_types_cache, aws_discovered_ec2_instances, \
+        gcp_discovered_vm_instances, providers_data, github_data, clients_data, k8s_agent_logs, jobs, ensure_indexes
+else:
+    from web.mongo_handler.mongo_utils import clusters, users, k8s_agent_data, deployment_yamls, \
+        gke_zones_and_series_cache, gke_machines_types_cache, gke_series_and_machine_types_cache, \
+        aws_regions_and_series_cache, aws_series_and_machine_types_cache, aws_discovered_ec2_instances, \
+        gcp_discovered_vm_instances, providers_data, github_data, clients_data, k8s_agent_logs, jobs, ensure_indexes
+
+# The shapes of the hot queries the app runs. The values don't matter to the query planner
+HOT_QUERIES = [
+    (clusters, {'cluster_type': 'gke', 'availability': True, 'user_name': 'vacant'}),
+    (clusters, {'cluster_type': 'eks', 'availability': True, 'client_name': 'vacant'}),
+    (clusters, {'cluster_type': 'gke', 'discovered': False, 'cluster_name': 'cluster'}),
+    (users, {'user_email': 'user@trolley.com'}),
+    (users, {'user_name': 'user'}),
+    (k8s_agent_data, {'cluster_name': 'cluster'}),
+    (k8s_agent_logs, {'cluster_name': 'cluster', 'namespace': 'default', 'pod': 'pod',
+                      'container_name': 'container'}),
+    (deployment_yamls, {'cluster_type': 'gke', 'cluster_name': 'cluster'}),
+    (gke_zones_and_series_cache, {'zone': 'us-central1-a'}),
+    (gke_machines_types_cache, {'region': 'us-central1-a'}),
+    (gke_series_and_machine_types_cache, {'machine_series': 'e2'}),
+    (aws_regions_and_series_cache, {'region': 'us-east-1'}),
+    (aws_series_and_machine_types_cache, {'machine_series': 't3'}),
+    (aws_discovered_ec2_instances, {'instance_id': 'i-0'}),
+    (aws_discovered_ec2_instances, {'instance_name': 'instance'}),
+    (aws_discovered_ec2_instances, {'availability': True, 'user_name': 'vacant'}),
+    (gcp_discovered_vm_instances, {'instance_name': 'instance'}),
+    (gcp_discovered_vm_instances, {'availability': True, 'client_name': 'vacant'}),
+    (providers_data, {'provider': 'gcp', 'user_email': 'user@trolley.com'}),
+    (github_data, {'user_email': 'user@trolley.com'}),
+    (clients_data, {'availability': True}),
+    (jobs, {'status': 'pending', 'priority': {'$lte': 0}}),
+    (jobs, {'status': 'running', 'heartbeat_at': {'$lt': 0}}),
+    (jobs, {'requested_by': 'scheduler'}),
+]
+
+
+def find_stages(plan: dict) -> list:
+    """
+    @param plan: A (possibly nested) explain() plan stage
+    @return: The names of all the stages in the plan
+    """
+    stages = []
+    if not isinstance(plan, dict):
+        return stages
+    if 'stage' in plan:
+        stages.append(plan['stage'])
+    for key in ('inputStage', 'queryPlan', 'winningPlan'):
+        if key in plan:
+            stages.extend(find_stages(plan[key]))
+    for input_stage in plan.get('inputStages', []):
+        stages.extend(find_stages(input_stage))
+    return stages
+
+
+def collection_scans_report() -> list:
+    """
+    This function explains every query from HOT_QUERIES and returns the ones that still run a COLLSCAN
+    """
+    collection_scans = []
+    for collection, mongo_query in HOT_QUERIES:
+        explain_object = collection.find(mongo_query).explain()
+        stages = find_stages(explain_object.get('queryPlanner', {}))
+        if 'COLLSCAN' in stages:
+            logger.warning(f'{collection.name} {mongo_query} runs a COLLSCAN')
+            collection_scans.append({'collection': collection.name, 'query': mongo_query, 'stages': stages})
+        else:
+            logger.info(f'{collection.name} {mongo_query} runs {" <- ".join(stages)}')
+    return collection_scans
+
+
+def main(is_ensuring_indexes: bool = False):
+    if is_ensuring_indexes:
+        ensure_indexes()
+    collection_scans = collection_scans_report()
+    print(f'{len(collection_scans)} out of {len(HOT_QUERIES)} hot queries run a COLLSCAN')
+    for collection_scan in collection_scans:
+        print(f"{collection_scan['collection']}: {collection_scan['query']}")
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('--ensure-indexes', action='store_true', default=False,
+                        help='Create the missing indexes before building the report')
+    args = parser.parse_args()
+    main(is_ensuring_indexes=args.ensure_indexes)
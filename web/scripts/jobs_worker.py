@@ -0,0 +1,283 @@
+import importlib
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+DOCKER_ENV = os.getenv('DOCKER_ENV', False)
+
+log_file_name = 'server.log'
+if DOCKER_ENV:
+    log_file_path = f'{os.getcwd()}/web/{log_file_name}'
+else:
+    log_file_path = f'{os.getcwd()}/{log_file_name}'
+
+logger = logging.getLogger(__name__)
+
+file_handler = logging.FileHandler(filename=log_file_path)
+stdout_handler = logging.StreamHandler(stream=sys.stdout)
+handlers = [file_handler, stdout_handler]
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='[%(asctime)s] {%(filename)s:%(lineno)d} %(levelname)s - %(message)s',
+    handlers=handlers
+)
+
+if DOCKER_ENV:
+    from mongo_handler.mongo_utils import claim_next_job, update_job_stage, heartbeat_jobs, finish_job, \
+        requeue_stale_jobs, fail_overrun_jobs, enqueue_job, claim_due_schedule, record_scheduled_job
+    from variables.variables import AWS_DISCOVERY_JOB, GCP_DISCOVERY_JOB, AWS_CACHING_JOB, GCP_CACHING_JOB, \
+        JOB_PRIORITY_USER, JOB_PRIORITY_SCHEDULED
+else:
+    from web.mongo_handler.mongo_utils import claim_next_job, update_job_stage, heartbeat_jobs, finish_job, \
+        requeue_stale_jobs, fail_overrun_jobs, enqueue_job, claim_due_schedule, record_scheduled_job
+    from web.variables.variables import AWS_DISCOVERY_JOB, GCP_DISCOVERY_JOB, AWS_CACHING_JOB, GCP_CACHING_JOB, \
+        JOB_PRIORITY_USER, JOB_PRIORITY_SCHEDULED
+
+JOBS_WORKERS = int(os.getenv('JOBS_WORKERS', 2))
+# Workers that only run the jobs users asked for, so a long scheduled sweep never holds every worker
+JOBS_USER_LANE_WORKERS = int(os.getenv('JOBS_USER_LANE_WORKERS', 1))
+JOBS_POLL_INTERVAL = float(os.getenv('JOBS_POLL_INTERVAL', 2))
+JOBS_HEARTBEAT_INTERVAL = int(os.getenv('JOBS_HEARTBEAT_INTERVAL', 15))
+JOBS_STALE_TIMEOUT = int(os.getenv('JOBS_STALE_TIMEOUT', 120))
+JOBS_MAX_ATTEMPTS = int(os.getenv('JOBS_MAX_ATTEMPTS', 2))
+SCHEDULER_TICK = int(os.getenv('SCHEDULER_TICK', 30))
+# Every run is delayed by up to this share of the task interval, so the replicas and the tasks drift apart
+SCHEDULER_JITTER_RATIO = float(os.getenv('SCHEDULER_JITTER_RATIO', 0.1))
+GCP_DISCOVERY_USER_EMAIL = os.getenv('GCP_DISCOVERY_USER_EMAIL', '')
+# The AWS runs and the GCP caching use the credentials of the environment, so they are off by default without them
+IS_AWS_CONFIGURED = bool(os.getenv('AWS_ACCESS_KEY_ID') and os.getenv('AWS_SECRET_ACCESS_KEY'))
+IS_GCP_CONFIGURED = os.path.exists(os.getenv('GCP_CREDENTIALS_PATH', '/home/app/.gcp/gcp_credentials.json'))
+
+# job type -> the script whose main runs it with the job arguments
+JOB_SCRIPTS = {
+    AWS_DISCOVERY_JOB: 'aws_discovery_script',
+    GCP_DISCOVERY_JOB: 'gcp_discovery_script',
+    AWS_CACHING_JOB: 'aws_caching_script',
+    GCP_CACHING_JOB: 'gcp_caching_script',
+}
+
+
+def build_scheduled_task(job_type: str, job_args: dict, default_interval: int, default_max_runtime: int) -> dict:
+    """
+    The interval and max runtime of a task are set by the <JOB_TYPE>_INTERVAL and <JOB_TYPE>_MAX_RUNTIME
+    environment variables, in seconds. A 0 interval disables the task
+    """
+    return {'job_type': job_type, 'job_args': job_args,
+            'interval': int(os.getenv(f'{job_type.upper()}_INTERVAL', default_interval)),
+            'max_runtime': int(os.getenv(f'{job_type.upper()}_MAX_RUNTIME', default_max_runtime))}
+
+
+# The periodic discovery and caching runs. A task that never ran, e.g. on the first deployment, is due right away
+SCHEDULED_TASKS = {
+    AWS_DISCOVERY_JOB: build_scheduled_task(AWS_DISCOVERY_JOB,
+                                            {'is_fetching_files': True, 'is_fetching_buckets': True,
+                                             'is_fetching_ec2_instances': True, 'is_fetching_eks_clusters': True},
+                                            default_interval=3600 if IS_AWS_CONFIGURED else 0,
+                                            default_max_runtime=3600),
+    # The GCP discovery runs with the provider credentials a user stored
+    GCP_DISCOVERY_JOB: build_scheduled_task(GCP_DISCOVERY_JOB,
+                                            {'is_fetching_files': True, 'is_fetching_buckets': True,
+                                             'is_fetching_vm_instances': True, 'is_fetching_gke_clusters': True,
+                                             'user_email': GCP_DISCOVERY_USER_EMAIL},
+                                            default_interval=3600 if GCP_DISCOVERY_USER_EMAIL else 0,
+                                            default_max_runtime=3600),
+    # Credentials are never stored with a job, the caching scripts fall back to the ones of the environment
+    AWS_CACHING_JOB: build_scheduled_task(AWS_CACHING_JOB, {'aws_access_key_id': '', 'aws_secret_access_key': ''},
+                                          default_interval=86400 if IS_AWS_CONFIGURED else 0,
+                                          default_max_runtime=7200),
+    GCP_CACHING_JOB: build_scheduled_task(GCP_CACHING_JOB, {'gcp_credentials': ''},
+                                          default_interval=86400 if IS_GCP_CONFIGURED else 0,
+                                          default_max_runtime=7200),
+}
+
+# The scripts keep module level state and set the provider credentials in os.environ, so every job runs in a fresh
+# process of its own
+JOB_PROCESS_CONTEXT = multiprocessing.get_context('spawn')
+# A process runs a single job of every type at a time, another one would only wait on the lease of the first
+running_job_types = set()
+# The jobs the heartbeats keep alive
+running_job_ids = set()
+running_job_types_lock = threading.Lock()
+
+
+def load_job_script(job_type: str):
+    """
+    Imports the script of the job type on its first use, the scripts sit next to this one in the Docker image
+    """
+    script_name = JOB_SCRIPTS[job_type]
+    return importlib.import_module(script_name if DOCKER_ENV else f'web.scripts.{script_name}')
+
+
+def run_job_script(job_type: str, job_args: dict, result_writer):
+    """
+    Runs the script of the job in the job process and sends back its error, an empty one when it succeeded
+    """
+    try:
+        load_job_script(job_type).main(**job_args)
+    except SystemExit as e:
+        # A script exits on its own when e.g. the provider credentials are missing
+        result_writer.send(f'The script exited with: {e.code}' if e.code not in (0, None) else '')
+    except Exception as e:
+        result_writer.send(str(e) or repr(e))
+    else:
+        result_writer.send('')
+
+
+def run_job(job: dict, worker_id: str):
+    """
+    Runs the script of the job in a process of its own and records its result. The scripts don't report their own
+    progress, so the job stage only tells that it runs
+    """
+    job_id = job['job_id']
+    logger.info(f'Running the {job["job_type"]} job {job_id} with {job["job_args"]} arguments')
+    update_job_stage(job_id, worker_id, 'running')
+    result_reader, result_writer = JOB_PROCESS_CONTEXT.Pipe(duplex=False)
+    # Daemonic, so it is stopped along with the worker. Its job is requeued once the heartbeats stop
+    job_process = JOB_PROCESS_CONTEXT.Process(target=run_job_script, args=(job['job_type'], job['job_args'],
+                                                                           result_writer),
+                                              name=f'job-{job_id}', daemon=True)
+    job_process.start()
+    result_writer.close()
+    try:
+        error = result_reader.recv()
+    except EOFError:
+        # The process died before sending its result, e.g. it was killed
+        error = None
+    job_process.join()
+    result_reader.close()
+    if error is None:
+        error = f'The job process exited with: {job_process.exitcode}'
+    if error:
+        logger.error(f'The {job["job_type"]} job {job_id} failed with error: {error}')
+        finish_job(job_id, worker_id, False, error)
+        return
+    finish_job(job_id, worker_id, True)
+
+
+def run_worker(worker_id: str, max_priority: int, stop_event: threading.Event):
+    """
+    Claims and runs jobs one at a time until the stop event is set
+    @param max_priority: Only run the jobs of this priority or a more urgent one, any job when None
+    """
+    while not stop_event.is_set():
+        try:
+            with running_job_types_lock:
+                job = claim_next_job(worker_id, max_priority, excluded_job_types=list(running_job_types))
+                if job:
+                    running_job_types.add(job['job_type'])
+                    running_job_ids.add(job['job_id'])
+        except Exception as e:
+            logger.error(f'Failed to claim a job with error: {e}')
+            job = {}
+        if not job:
+            stop_event.wait(JOBS_POLL_INTERVAL)
+            continue
+        try:
+            run_job(job, worker_id)
+        except Exception as e:
+            # Most likely Mongo failed while recording the result. The job is requeued once its heartbeats stop
+            logger.error(f'Failed to record the result of the {job["job_type"]} job {job["job_id"]} with error: {e}')
+        finally:
+            with running_job_types_lock:
+                running_job_types.discard(job['job_type'])
+                running_job_ids.discard(job['job_id'])
+
+
+def run_heartbeats(worker_id: str, stop_event: threading.Event):
+    """
+    Keeps the jobs of the process alive and requeues the ones of the workers that died
+    """
+    while not stop_event.wait(JOBS_HEARTBEAT_INTERVAL):
+        try:
+            with running_job_types_lock:
+                job_ids = list(running_job_ids)
+            heartbeat_jobs(worker_id, job_ids)
+            requeue_stale_jobs(JOBS_STALE_TIMEOUT, JOBS_MAX_ATTEMPTS)
+            fail_overrun_jobs()
+        except Exception as e:
+            logger.error(f'Failed to heartbeat the jobs of {worker_id} with error: {e}')
+
+
+def schedule_due_tasks() -> list:
+    """
+    Queues a job for every scheduled task that is due, in the lane of the scheduled jobs
+    @return: The queued jobs
+    """
+    scheduled_jobs = []
+    for task_name, scheduled_task in SCHEDULED_TASKS.items():
+        interval = scheduled_task['interval']
+        if not interval:
+            continue
+        next_run_at = int(time.time() + interval + random.uniform(0, interval * SCHEDULER_JITTER_RATIO))
+        if not claim_due_schedule(task_name, next_run_at):
+            continue
+        job, _ = enqueue_job(scheduled_task['job_type'], scheduled_task['job_args'], JOB_PRIORITY_SCHEDULED,
+                             requested_by='scheduler', max_runtime=scheduled_task['max_runtime'])
+        record_scheduled_job(task_name, job['job_id'])
+        logger.info(f'The {task_name} scheduled task queued the {job["job_id"]} job, next run at {next_run_at}')
+        scheduled_jobs.append(job)
+    return scheduled_jobs
+
+
+def run_scheduler(stop_event: threading.Event):
+    # Right away on start, so the tasks that came due while no scheduler ran are queued first
+    while True:
+        try:
+            schedule_due_tasks()
+        except Exception as e:
+            logger.error(f'Failed to schedule the due tasks with error: {e}')
+        if stop_event.wait(SCHEDULER_TICK):
+            return
+
+
+def start_workers(workers: int = JOBS_WORKERS, user_lane_workers: int = JOBS_USER_LANE_WORKERS,
+                  is_scheduling: bool = True) -> threading.Event:
+    """
+    Starts the bounded pool of worker threads of the current process
+    @param workers: The amount of jobs the process runs at once
+    @param user_lane_workers: How many of the workers only run the jobs users asked for
+    @param is_scheduling: Whether the process also queues the scheduled tasks. Any amount of processes can, as every
+    due run is claimed atomically by a single one of them
+    @return: The event that stops the workers once set
+    """
+    worker_id = f'{socket.gethostname()}-{os.getpid()}'
+    stop_event = threading.Event()
+    user_lane_workers = min(user_lane_workers, workers)
+    for worker_index in range(workers):
+        max_priority = JOB_PRIORITY_USER if worker_index < user_lane_workers else None
+        threading.Thread(target=run_worker, args=(worker_id, max_priority, stop_event),
+                         name=f'jobs-worker-{worker_index}', daemon=True).start()
+    threading.Thread(target=run_heartbeats, args=(worker_id, stop_event), name='jobs-heartbeat', daemon=True).start()
+    if is_scheduling:
+        threading.Thread(target=run_scheduler, args=(stop_event,), name='jobs-scheduler', daemon=True).start()
+    logger.info(f'{worker_id} runs {workers} jobs workers, {user_lane_workers} of them for the user jobs only')
+    return stop_event
+
+
+def main(workers: int = JOBS_WORKERS, user_lane_workers: int = JOBS_USER_LANE_WORKERS, is_scheduling: bool = True):
+    stop_event = start_workers(workers, user_lane_workers, is_scheduling)
+    # The running jobs are dropped on exit and requeued by the other workers once their heartbeats stop
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: stop_event.set())
+    try:
+        stop_event.wait()
+    except KeyboardInterrupt:
+        stop_event.set()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=JOBS_WORKERS, help='Amount of jobs to run at once')
+    parser.add_argument('--user-lane-workers', type=int, default=JOBS_USER_LANE_WORKERS,
+                        help='Amount of the workers that only run the jobs users asked for')
+    parser.add_argument('--no-scheduler', action='store_true', default=False,
+                        help="Only run the queued jobs, without queueing the scheduled tasks")
+    args = parser.parse_args()
+    main(workers=args.workers, user_lane_workers=args.user_lane_workers, is_scheduling=not args.no_scheduler)
@@ -0,0 +1,70 @@
+import statistics
+import time
+import urllib.error
+import urllib.request
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+JSON_ENDPOINTS = ['/get_clusters_data?cluster_type=gke', '/get_clusters_data?cluster_type=eks',
+                  '/get_instances_data?provider=aws', '/get_instances_data?provider=gcp',
+                  '/fetch_regions?cluster_type=gke', '/users']
+
+
+def timed_request(url: str, headers: dict) -> tuple:
+    """
+    @return: The status, the bytes received on the wire, the ETag and the latency of the request
+    """
+    request = urllib.request.Request(url, headers=headers)
+    start_time = time.monotonic()
+    try:
+        with urllib.request.urlopen(request) as response:
+            # urllib doesn't decode the Content-Encoding, so this is the size that was sent
+            body = response.read()
+            status = response.status
+            etag = response.headers.get('ETag', '')
+    except urllib.error.HTTPError as e:
+        body = e.read()
+        status = e.code
+        etag = e.headers.get('ETag', '')
+    return status, len(body), etag, time.monotonic() - start_time
+
+
+def run_scenario(server_url: str, endpoint: str, session_cookie: str, requests_amount: int,
+                 is_revalidating: bool) -> tuple:
+    """
+    @param is_revalidating: Send Accept-Encoding: gzip and the ETag of the previous response, like a dashboard
+    re-polling the endpoint. Otherwise every request asks for the full, uncompressed body
+    @return: The total bytes received and the p95 latency in seconds
+    """
+    headers = {'Cookie': f'session={session_cookie}'}
+    if is_revalidating:
+        headers['Accept-Encoding'] = 'gzip'
+    else:
+        headers['Accept-Encoding'] = 'identity'
+    received_bytes = 0
+    latencies = []
+    for _ in range(requests_amount):
+        status, body_size, etag, latency = timed_request(f'{server_url}{endpoint}', headers)
+        received_bytes += body_size
+        latencies.append(latency)
+        if is_revalidating and etag:
+            headers['If-None-Match'] = etag
+    p95_latency = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0]
+    return received_bytes, p95_latency
+
+
+def main(server_url: str, session_cookie: str, requests_amount: int = 50):
+    for endpoint in JSON_ENDPOINTS:
+        full_bytes, full_p95 = run_scenario(server_url, endpoint, session_cookie, requests_amount, False)
+        revalidated_bytes, revalidated_p95 = run_scenario(server_url, endpoint, session_cookie, requests_amount, True)
+        print(f'{endpoint}: {full_bytes} -> {revalidated_bytes} bytes, '
+              f'p95 {full_p95 * 1000:.1f}ms -> {revalidated_p95 * 1000:.1f}ms over {requests_amount} requests')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('--server-url', type=str, default='http://localhost', help='The trolley server URL')
+    parser.add_argument('--session-cookie', type=str, required=True,
+                        help='The session cookie of a logged in user')
+    parser.add_argument('--requests', type=int, default=50, help='Amount of requests per endpoint and scenario')
+    args = parser.parse_args()
+    main(server_url=args.server_url, session_cookie=args.session_cookie, requests_amount=args.requests)
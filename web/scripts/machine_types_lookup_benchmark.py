@@ -0,0 +1,91 @@
+import logging
+import os
+import sys
+import time
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+from pymongo import monitoring
+
+DOCKER_ENV = os.getenv('DOCKER_ENV', False)
+
+log_file_name = 'server.log'
+if DOCKER_ENV:
+    log_file_path = f'{os.getcwd()}/web/{log_file_name}'
+else:
+    log_file_path = f'{os.getcwd()}/{log_file_name}'
+
+logger = logging.getLogger(__name__)
+
+file_handler = logging.FileHandler(filename=log_file_path)
+stdout_handler = logging.StreamHandler(stream=sys.stdout)
+handlers = [file_handler, stdout_handler]
+
+logging.basicConfig(
+    level=logging.WARNING,
+    format='[%(asctime)s] {%(filename)s:%(lineno)d} %(levelname)s - %(message)s',
+    handlers=handlers
+)
+
+
+class FindCommandsCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.find_commands = 0
+
+    def started(self, event):
+        if event.command_name == 'find':
+            self.find_commands += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+# The listener has to be registered before mongo_utils creates its MongoClient
+FIND_COMMANDS_COUNTER = FindCommandsCounter()
+monitoring.register(FIND_COMMANDS_COUNTER)
+
+if DOCKER_ENV:
+    from mongo_handler.mongo_utils import retrieve_compute_per_machine_type, retrieve_machine_types_index
+    from variables.variables import GKE, EKS
+else:
+    from web.mongo_handler.mongo_utils import retrieve_compute_per_machine_type, retrieve_machine_types_index
+    from web.variables.variables import GKE, EKS
+
+
+def run_lookups(provider: str, machine_types: list, is_using_index: bool) -> tuple:
+    """
+    @param provider: gke/eks
+    @param machine_types: The machine type of every node group the discovery run resolves
+    @param is_using_index: Resolve through a per-run index instead of a cache read per node group
+    @return: The amount of find commands sent to Mongo and the elapsed seconds
+    """
+    find_commands_before = FIND_COMMANDS_COUNTER.find_commands
+    start_time = time.monotonic()
+    if is_using_index:
+        machine_types_index = retrieve_machine_types_index(provider)
+        for machine_type in machine_types:
+            machine_types_index.get(machine_type)
+    else:
+        for machine_type in machine_types:
+            retrieve_compute_per_machine_type(provider, machine_type)
+    return FIND_COMMANDS_COUNTER.find_commands - find_commands_before, time.monotonic() - start_time
+
+
+def main(provider: str = EKS, node_groups: int = 500):
+    machine_types = list(retrieve_machine_types_index(provider))
+    if not machine_types:
+        sys.exit(f'The {provider} machines cache is empty, run the caching script first')
+    workload = [machine_types[index % len(machine_types)] for index in range(node_groups)]
+    for title, is_using_index in (('Lookup per node group', False), ('Per-run index', True)):
+        find_commands, elapsed = run_lookups(provider, workload, is_using_index)
+        print(f'{title}: {find_commands} find commands, {elapsed:.3f}s for {node_groups} node groups')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('--provider', type=str, default=EKS, choices=[GKE, EKS], help='The machines cache to use')
+    parser.add_argument('--node-groups', type=int, default=500, help='Amount of node groups to resolve')
+    args = parser.parse_args()
+    main(provider=args.provider, node_groups=args.node_groups)
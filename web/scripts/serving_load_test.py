@@ -0,0 +1,116 @@
+import http.client
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+SERVER_HOST = '127.0.0.1'
+SERVER_START_TIMEOUT = 60
+
+
+def build_default_workers_counts() -> list:
+    workers_counts = [1]
+    while workers_counts[-1] * 2 <= multiprocessing.cpu_count():
+        workers_counts.append(workers_counts[-1] * 2)
+    return workers_counts
+
+
+def start_server(port: int, workers: int, threads: int) -> subprocess.Popen:
+    """
+    Starts the web app in the production serving mode, with the given amount of workers
+    """
+    server_env = {**os.environ, 'WEB_WORKERS': str(workers), 'WEB_THREADS': str(threads)}
+    server_process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--config', 'web/gunicorn.conf.py',
+                                       '--pythonpath', 'web', '--bind', f'{SERVER_HOST}:{port}', '--accesslog',
+                                       '/dev/null', 'main:app'],
+                                      cwd=REPOSITORY_PATH, env=server_env, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection(SERVER_HOST, port, timeout=1)
+            connection.request('GET', '/')
+            connection.getresponse().read()
+            return server_process
+        except OSError:
+            time.sleep(0.5)
+    server_process.kill()
+    sys.exit(f'The server did not start within {SERVER_START_TIMEOUT} seconds')
+
+
+def stop_server(server_process: subprocess.Popen):
+    server_process.send_signal(signal.SIGTERM)
+    server_process.wait()
+
+
+def run_client(port: int, path: str, session_cookie: str, duration: float) -> tuple:
+    """
+    Sends requests over a keep-alive connection until the duration passes
+    @return: The amount of successful and failed requests
+    """
+    headers = {'Cookie': f'session={session_cookie}'} if session_cookie else {}
+    connection = http.client.HTTPConnection(SERVER_HOST, port, timeout=30)
+    succeeded = failed = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        try:
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status < 400:
+                succeeded += 1
+            else:
+                failed += 1
+        except (OSError, http.client.HTTPException):
+            failed += 1
+            connection.close()
+            connection = http.client.HTTPConnection(SERVER_HOST, port, timeout=30)
+    connection.close()
+    return succeeded, failed
+
+
+def measure_throughput(port: int, path: str, session_cookie: str, concurrency: int, duration: float) -> tuple:
+    """
+    @return: The successful requests per second and the amount of failed requests
+    """
+    with multiprocessing.Pool(concurrency) as clients_pool:
+        results = clients_pool.starmap(run_client, [(port, path, session_cookie, duration)] * concurrency)
+    return sum(succeeded for succeeded, _ in results) / duration, sum(failed for _, failed in results)
+
+
+def main(path: str = '/login', session_cookie: str = '', workers_counts: list = None, threads: int = 4,
+         concurrency: int = 0, duration: float = 10, port: int = 8090):
+    workers_counts = workers_counts or build_default_workers_counts()
+    concurrency = concurrency or max(workers_counts) * threads
+    print(f'{multiprocessing.cpu_count()} cores, {concurrency} keep-alive clients, {duration}s per run on {path}')
+    baseline = None
+    for workers in workers_counts:
+        server_process = start_server(port, workers, threads)
+        try:
+            requests_per_second, failed = measure_throughput(port, path, session_cookie, concurrency, duration)
+        finally:
+            stop_server(server_process)
+        baseline = baseline or requests_per_second
+        print(f'{workers} workers x {threads} threads: {requests_per_second:.0f} requests/s '
+              f'(x{requests_per_second / baseline:.2f}), {failed} failed requests')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('--path', type=str, default='/login', help='The endpoint to load')
+    parser.add_argument('--session-cookie', type=str, default='',
+                        help='The session cookie of a logged in user, for the endpoints behind a login')
+    parser.add_argument('--workers', type=str, default='',
+                        help='Comma separated workers counts to compare, powers of 2 up to the cores count by default')
+    parser.add_argument('--threads', type=int, default=4, help='Threads per worker')
+    parser.add_argument('--concurrency', type=int, default=0,
+                        help='Amount of client processes, the maximal workers count x threads by default')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to load the server for every run')
+    parser.add_argument('--port', type=int, default=8090, help='The port to run the server on')
+    args = parser.parse_args()
+    main(path=args.path, session_cookie=args.session_cookie,
+         workers_counts=[int(workers) for workers in args.workers.split(',') if workers],
+         threads=args.threads, concurrency=args.concurrency, duration=args.duration, port=args.port)
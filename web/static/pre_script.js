@@ -1974,7 +1974,7 @@ $(document).ready(function() {
         xhr.open("POST", url, true);
         xhr.setRequestHeader("Content-Type", "application/json");
         xhr.onreadystatechange = function() {
-            if (xhr.readyState === 4 && xhr.status === 200) {
+            if (xhr.readyState === 4 && (xhr.status === 200 || xhr.status === 202)) {
                 var json = JSON.parse(xhr.responseText);
             }
         };
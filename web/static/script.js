@@ -1974,7 +1974,7 @@ $(document).ready(function() {
         xhr.open("POST", url, true);
         xhr.setRequestHeader("Content-Type", "application/json");
         xhr.onreadystatechange = function() {
-            if (xhr.readyState === 4 && xhr.status === 200) {
+            if (xhr.readyState === 4 && (xhr.status === 200 || xhr.status === 202)) {
                 var json = JSON.parse(xhr.responseText);
             }
         };
@@ -2487,17 +2487,19 @@ $(document).ready(function() {
             trigger_cloud_provider_discovery(provider, objectType = 'instance')
         } else if (this.innerText === "Copy Kubeconfig") {
             clusterName = window.localStorage.getItem("currentClusterName");
-            kubeconfig_data = window.localStorage.getItem("kubeconfigs")
-            var kubeconfig_data_jsond = JSON.parse(kubeconfig_data);
-            let clusterObj = kubeconfig_data_jsond.find(o => o.key === clusterName);
-            kubeconfig_to_copy_clipboard = clusterObj.value
-            copyToClipboard(kubeconfig_to_copy_clipboard);
-            Swal.fire({
-                position: 'top-end',
-                icon: 'success',
-                title: 'A Kubeconfig was copied to your clipboard!',
-                showConfirmButton: false,
-                timer: 1000
+            $.ajax({
+                url: trolley_url + "/get_cluster_details?cluster_type=" + clusterType + "&cluster_name=" + clusterName + "&fields=kubeconfig",
+                type: 'GET',
+                success: function(response) {
+                    copyToClipboard(response['kubeconfig']);
+                    Swal.fire({
+                        position: 'top-end',
+                        icon: 'success',
+                        title: 'A Kubeconfig was copied to your clipboard!',
+                        showConfirmButton: false,
+                        timer: 1000
+                    })
+                },
             })
         }
     })
@@ -14,9 +14,6 @@ else:
     from web.mongo_handler.mongo_utils import retrieve_cluster_details, retrieve_deployment_yaml
     from web.variables.variables import KUBECONFIG
 
-from kubernetes import client, config, utils
-from kubernetes.client import ApiException
-
 DOCKER_ENV = os.getenv('DOCKER_ENV', False)
 
 log_file_name = 'server.log'
@@ -48,6 +45,9 @@ def random_string(length=8):
 
 
 def apply_yaml(cluster_type: str, cluster_name: str, cluster_deployment_yaml: dict = None) -> bool:
+    # kubernetes is only needed for the deployments, it's imported on their first use to keep the app startup fast
+    from kubernetes import client, config, utils
+    from kubernetes.client import ApiException
     cluster_object = retrieve_cluster_details(cluster_type, cluster_name)
     kubeconfig = cluster_object[KUBECONFIG]
     with open(KUBECONFIG_PATH, 'a') as the_file:
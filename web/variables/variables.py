@@ -103,4 +103,28 @@ GKE_IMAGE_TYPES = 'gke_image_types'
 #GITHUB
 
 GITHUB_REPOSITORY = 'github_repository'
-GITHUB_ACTIONS_TOKEN = 'github_actions_token'
\ No newline at end of file
+GITHUB_ACTIONS_TOKEN = 'github_actions_token'
+# TROLLEY AGENT
+# The fields identifying a row in every cluster inventory section. The namespaces rows are plain names
+AGENT_INVENTORY_KEY_FIELDS = {
+    'namespaces': [],
+    'pods': ['namespace', 'pod'],
+    'containers': ['namespace', 'pod', 'container_name'],
+    'deployments': ['namespace', 'deployment'],
+    'daemonsets': ['namespace', 'daemonsets'],
+    'stateful_sets': ['namespace', 'stateful_set'],
+    'services': ['namespace', 'service'],
+}
+
+# JOBS
+AWS_DISCOVERY_JOB = 'aws_discovery'
+GCP_DISCOVERY_JOB = 'gcp_discovery'
+AWS_CACHING_JOB = 'aws_caching'
+GCP_CACHING_JOB = 'gcp_caching'
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+# Lower runs first, so the runs users asked for go ahead of the scheduled ones
+JOB_PRIORITY_USER = 0
+JOB_PRIORITY_SCHEDULED = 10